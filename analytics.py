@@ -0,0 +1,144 @@
+"""Offline analytics on the Parquet export, w/ Arrow compute kernels
+
+The aggregates, train list and train statistics of the web interface,
+computed from the export of export.py instead of the live database: whole
+columns are processed at once and the database is never locked. Requires
+pyarrow.
+"""
+
+import json
+
+import click
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = pc = ds = None
+
+import make_train_list
+import rollups
+from config import settings
+
+
+def load(path, columns=None):
+    """Arrow table of the exported results"""
+    return ds.dataset(path, format='parquet', partitioning='hive').to_table(columns=columns)
+
+
+def count(table, keys):
+    """Rows of the counts of `table` grouped by `keys`, as dicts"""
+    rows = table.group_by(keys).aggregate([([], 'count_all')]).to_pylist()
+    for row in rows:
+        row['count'] = row.pop('count_all')
+    return rows
+
+
+def get_buckets(table, frequency):
+    """Column of the buckets of each result for an aggregate frequency"""
+    if frequency in rollups.PREFIXES:
+        return pc.utf8_slice_codeunits(table['date'], 0, rollups.PREFIXES[frequency])
+    if frequency == 'hour_overall':
+        return pc.utf8_slice_codeunits(table['date'], 11, 13)
+    return table['weekday']
+
+
+def get_train_buckets(table, dimension):
+    """Column of the per train buckets of each result, see rollups.get_train_buckets"""
+    if dimension == 'weekday':
+        return pc.cast(table['weekday'], pa.string())
+    if dimension == 'hour':
+        return pc.utf8_slice_codeunits(table['date'], 11, 13)
+    minutes = pc.divide(pc.fill_null(table['delay'], 0), 60)
+    return pc.cast(pc.min_element_wise(minutes, rollups.DELAY_MAX), pa.string())
+
+
+def aggregate(table, frequency, since=None):
+    """Aggregate results by type on given frequency, as `rollups.query`"""
+    if since:
+        table = table.filter(pc.greater(table['date'], since))
+    buckets = pa.table({'date': get_buckets(table, frequency), 'type': table['type']})
+    return rollups.convert(rollups.merge(count(buckets, ['date', 'type'])), frequency)
+
+
+def get_trains(table):
+    """Distinct train list for a typical day, as `make_train_list.get_trains`"""
+    counts = pa.table({
+        'num': table['num'],
+        'hour': pc.utf8_slice_codeunits(table['date'], 11, 16),
+        'weekday': table['weekday'],
+    })
+    normal = table.filter(pc.equal(table['type'], 'NORMAL')) \
+        .select(['id', 'num', 'from_gare', 'to_gare']).sort_by('id')
+    # first NORMAL occurrence of each train
+    directions = normal.group_by('num', use_threads=False) \
+        .aggregate([('from_gare', 'first'), ('to_gare', 'first')]).sort_by('num').to_pylist()
+    return make_train_list.build_trains(
+        count(counts, ['num', 'hour', 'weekday']),
+        [{'num': row['num'], 'from_gare': row['from_gare_first'],
+          'to_gare': row['to_gare_first']} for row in directions]
+    )
+
+
+def get_train_stats(table, num=None):
+    """Statistics of every train, or of one w/ its breakdowns, as the rollups"""
+    if num is not None:
+        table = table.filter(pc.equal(table['num'], num))
+    trains = {}
+    for dimension in rollups.TRAIN_DIMENSIONS:
+        buckets = pa.table({
+            'num': table['num'],
+            'bucket': get_train_buckets(table, dimension),
+            'type': table['type'],
+        })
+        for row in count(buckets, ['num', 'bucket', 'type']):
+            trains.setdefault(row['num'], []).append(dict(row, dimension=dimension))
+    stats = []
+    for train, rows in sorted(trains.items()):
+        stats.append(dict(rollups.summarize(rows), num=train))
+        # the breakdowns of a single train only, as the API
+        if num is None:
+            del stats[-1]['weekday'], stats[-1]['hour']
+    return stats
+
+
+@click.group()
+@click.option('--input', 'path', default=None, help='Export directory (default: EXPORT_DIR)')
+@click.pass_context
+def run(ctx, path):
+    """Compute statistics from the Parquet export"""
+    if pa is None:
+        raise click.UsageError('pyarrow is required: pip install pyarrow')
+    ctx.obj = path or settings.EXPORT_DIR
+
+
+@run.command('aggregate')
+@click.argument('frequency', type=click.Choice(sorted(rollups.FREQUENCIES)))
+@click.option('--since', default=None, help='ISO date, e.g. 2016-01-01')
+@click.pass_obj
+def aggregate_command(path, frequency, since):
+    """Aggregate the results by type on a frequency"""
+    table = load(path, columns=['date', 'weekday', 'type'])
+    click.echo(json.dumps(aggregate(table, frequency, since), indent=2))
+
+
+@run.command('train-list')
+@click.pass_obj
+def train_list_command(path):
+    """Write the train list to trains.json"""
+    table = load(path, columns=['id', 'num', 'date', 'weekday', 'type', 'from_gare', 'to_gare'])
+    make_train_list.write(get_trains(table))
+
+
+@run.command('train-stats')
+@click.argument('num', required=False)
+@click.pass_obj
+def train_stats_command(path, num):
+    """Punctuality of every train, or of one w/ its breakdowns"""
+    table = load(path, columns=['num', 'date', 'weekday', 'type', 'delay'])
+    click.echo(json.dumps(get_train_stats(table, num), indent=2))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
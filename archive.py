@@ -0,0 +1,151 @@
+"""Monthly archives of the old results, and the retention command
+
+Results older than RETENTION_MONTHS are moved to a SQLite file per month,
+in ARCHIVE_DIR, so that the hot queries only touch recent data. The
+rollups are left untouched: aggregates still cover all time, and `query`
+reads the archives for the few that are computed from the results.
+"""
+
+import glob
+import os
+import sqlite3
+from datetime import datetime
+
+import click
+
+import database
+import queries
+from config import settings
+from utils import get_datestring, get_datetime_from_iso, get_timestamp
+
+
+def get_path(month):
+    """Path of the archive of a `YYYY-MM` month"""
+    return os.path.join(settings.ARCHIVE_DIR, 'results-%s.db' % month)
+
+
+def get_files(since_month=''):
+    """`(month, path)` of the archives, from `since_month` on"""
+    files = []
+    for path in sorted(glob.glob(get_path('[0-9]' * 4 + '-[0-9][0-9]'))):
+        month = os.path.basename(path)[len('results-'):-len('.db')]
+        if month >= since_month:
+            files.append((month, path))
+    return files
+
+
+def get_next_month(month):
+    """`YYYY-MM` month following a month"""
+    year, month = int(month[:4]), int(month[5:7])
+    return '%04d-%02d' % (year + month // 12, month % 12 + 1)
+
+
+def get_cutoff(now, months):
+    """First month to keep, `months` months before the month of `now`"""
+    index = now.year * 12 + now.month - 1 - months
+    return '%04d-%02d' % (index // 12, index % 12 + 1)
+
+
+def get_horizon(db):
+    """ISO date before which results are archived, None if none is"""
+    if 'meta' not in db:
+        return None
+    res = next(db.query(queries.GET_META, key='archived_before'), None)
+    return res and get_datestring(datetime.fromtimestamp(res['value']))
+
+
+def get_columns(conn, schema):
+    """`{name: type}` of the `results` table of an attached schema"""
+    return {
+        row[1]: row[2]
+        for row in conn.exec_driver_sql('PRAGMA %s.table_info(results)' % schema)
+    }
+
+
+def move(db, month):
+    """Move the results of a month to its archive, return the count of rows
+
+    Rows are copied w/ their ids before being deleted, so that a move
+    interrupted in between is completed by the next one.
+    """
+    since, until = month + '-01', get_next_month(month) + '-01'
+    os.makedirs(settings.ARCHIVE_DIR, exist_ok=True)
+    # no ATTACH within a transaction
+    db.executable.exec_driver_sql('ATTACH DATABASE ? AS archive', (get_path(month),))
+    try:
+        with db as tx:
+            conn = tx.executable
+            columns = get_columns(conn, 'main')
+            conn.exec_driver_sql(
+                'CREATE TABLE IF NOT EXISTS archive.results (id INTEGER PRIMARY KEY)'
+            )
+            # archives follow the migrations of `results`
+            archived = get_columns(conn, 'archive')
+            for name, column_type in columns.items():
+                if name not in archived:
+                    conn.exec_driver_sql(
+                        'ALTER TABLE archive.results ADD COLUMN %s %s' % (name, column_type)
+                    )
+            names = ', '.join(columns)
+            conn.exec_driver_sql(
+                'INSERT OR IGNORE INTO archive.results (%s) SELECT %s FROM main.results '
+                'WHERE date >= ? AND date < ?' % (names, names), (since, until)
+            )
+            return conn.execute(queries.ARCHIVE_DELETE, since=since, until=until).rowcount
+    finally:
+        db.executable.exec_driver_sql('DETACH DATABASE archive')
+
+
+def archive(db, months, now=None):
+    """Archive the results older than `months` months
+
+    Return the count of archived rows by month.
+    """
+    cutoff = get_cutoff(now or datetime.now(), months)
+    moved = {}
+    for res in list(db.query(queries.ARCHIVE_MONTHS, before=cutoff)):
+        moved[res['month']] = move(db, res['month'])
+    horizon = get_datetime_from_iso(cutoff + '-01 00:00:00')
+    with db as tx:
+        current = get_horizon(tx)
+        if current is None or get_datestring(horizon) > current:
+            tx.query(queries.SET_META, key='archived_before', value=get_timestamp(horizon))
+        if moved:
+            database.bump_generation(tx)
+    return moved
+
+
+def query(statement, since_month='', **params):
+    """Run a SELECT of queries.py on the archives from `since_month` on
+
+    Return the rows of all the archives, as dicts.
+    """
+    rows = []
+    for _, path in get_files(since_month):
+        conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows.extend(dict(row) for row in conn.execute(str(statement), params))
+        finally:
+            conn.close()
+    return rows
+
+
+@click.command()
+@click.option('--months', default=None, type=int,
+              help='Months of results to keep (default: RETENTION_MONTHS)')
+@click.option('--vacuum', is_flag=True, help='Reclaim the space of the archived rows')
+def run(months, vacuum):
+    """Move the old results to their monthly archives"""
+    if months is None:
+        months = settings.RETENTION_MONTHS
+    db = database.get()
+    moved = archive(db, months)
+    for month, count in moved.items():
+        click.echo('Archived %s results of %s to %s' % (count, month, get_path(month)))
+    if vacuum and moved:
+        db.query('VACUUM')
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
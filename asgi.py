@@ -0,0 +1,288 @@
+"""Async web API, for many concurrent clients
+
+An ASGI app serving `/api` and `/api/aggregate/<frequency>` as web.py does:
+same payloads, response cache and ETags. Clients waiting on the DB only
+cost a coroutine: the queries run in a pool of ASGI_THREADS threads, so
+that long ones do not tie up the process. Once the server is started, the
+write generation is polled for all the clients (see feed.GenerationWatcher)
+and cached responses are served w/o any query, up to STREAM_INTERVAL
+seconds late. NDJSON responses are streamed, NDJSON_BATCH rows at a time.
+The frontend and the other endpoints are served by web.py.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5001
+"""
+
+import asyncio
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import click
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import BadRequest, HTTPException, MethodNotAllowed, NotFound
+from werkzeug.http import parse_etags
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+import database
+import feed
+import rollups
+import routes
+import rows
+from config import settings
+import web
+from utils import get_datestring
+
+
+executor = ThreadPoolExecutor(settings.ASGI_THREADS, thread_name_prefix='asgi')
+generation_watcher = feed.GenerationWatcher(settings.STREAM_INTERVAL)
+# rows per query of a streamed NDJSON response
+NDJSON_BATCH = 1000
+
+
+class Request(object):
+    """Path, args and headers of an HTTP request, from its ASGI scope"""
+
+    def __init__(self, scope):
+        self.path = scope['path']
+        self.args = MultiDict(parse_qsl(
+            scope['query_string'].decode('latin-1'), keep_blank_values=True
+        ))
+        self.headers = {
+            name.decode('latin-1'): value.decode('latin-1')
+            for name, value in scope['headers']
+        }
+
+    def get_int_arg(self, name):
+        """Get an optional integer arg"""
+        value = self.args.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise BadRequest()
+
+    def get_route(self):
+        """Route of the `route` arg, the default one w/o"""
+        route = routes.get_route(self.args.get('route'))
+        if route is None:
+            raise NotFound()
+        return route
+
+
+def encode(payload):
+    """JSON body of a payload, as `jsonify`"""
+    return json.dumps(
+        payload, default=rows.to_json, separators=(',', ':'), sort_keys=True
+    ).encode('utf-8')
+
+
+def get_cached(request, default_days_ago, generation):
+    """Response of a request cached for a generation, None if not cached"""
+    key = web.get_cache_key(request.path, request.args, default_days_ago)
+    etag = web.response_cache.get_etag(key, generation)
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        web.response_cache.count('not_modified')
+        return 304, etag, b''
+    payload = web.response_cache.get(key, generation)
+    if payload is None:
+        return None
+    return 200, etag, payload
+
+
+def respond(request, default_days_ago, view, checked=None):
+    """Response of a JSON view, from the cache if up to date (see
+    `web.cached`), w/ a read only connector
+
+    Runs in the pool: `view` is called w/ the connector and returns the
+    payload. The cache is not looked up again for the `checked` generation.
+    """
+    res_db = database.get(read_only=True)
+    try:
+        generation = database.get_generation(res_db)
+        if generation is None:
+            return 200, None, encode(view(res_db))
+        if generation != checked:
+            response = get_cached(request, default_days_ago, generation)
+            if response is not None:
+                return response
+        key = web.get_cache_key(request.path, request.args, default_days_ago)
+        payload = encode(view(res_db))
+        web.response_cache.set(key, generation, payload)
+        return 200, web.response_cache.get_etag(key, generation), payload
+    finally:
+        database.release(res_db)
+
+
+def read_batch(route, since, limit, cursor):
+    """Lines of the next NDJSON_BATCH rows (at most) of `web.iter_ndjson`,
+    and the id of the last one, w/ a read only connector
+    """
+    size = NDJSON_BATCH if limit is None else min(limit, NDJSON_BATCH)
+    res_db = database.get(read_only=True)
+    try:
+        lines = list(web.iter_ndjson(res_db, route, since, size, cursor))
+    finally:
+        database.release(res_db)
+    return lines, json.loads(lines[-1])['id'] if lines else cursor
+
+
+async def offload(func, *args):
+    """Run a blocking call in the pool"""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def iter_batches(batch, route, since, limit):
+    """Body of an NDJSON response from its first batch, the next ones read
+    in the pool as sent
+
+    Each batch is a query after the last row of the previous one, as w/
+    the `cursor` arg: the connection is not held between batches.
+    """
+    while True:
+        lines, cursor = batch
+        if lines:
+            yield ''.join(lines).encode('utf-8')
+        if limit is not None:
+            limit -= len(lines)
+        if len(lines) < NDJSON_BATCH or limit == 0:
+            return
+        batch = await offload(read_batch, route, since, limit, cursor)
+
+
+async def respond_cached(request, default_days_ago, view):
+    """`respond` in the pool, unless cached for the watched generation"""
+    generation = generation_watcher.generation
+    if generation is not None:
+        response = get_cached(request, default_days_ago, generation)
+        if response is not None:
+            return response
+    return await offload(respond, request, default_days_ago, view, generation)
+
+
+async def api(request):
+    """List last results of a route, as web.api"""
+    route = request.get_route()
+    since = web.parse_since(request.args.get('since'))
+    if request.args.get('format') == 'ndjson':
+        limit, cursor = request.get_int_arg('limit'), request.get_int_arg('cursor')
+        # read before the response starts, BadRequest on bad args
+        batch = await offload(read_batch, route, since, limit, cursor)
+        return 200, 'application/x-ndjson', None, iter_batches(batch, route, since, limit)
+
+    after_rev = request.get_int_arg('after_rev')
+    since = web.round_since(since)
+    status, etag, body = await respond_cached(request, 1, lambda res_db: web.get_trains(
+        res_db, route, since, after_rev
+    ))
+    return status, 'application/json', etag, body
+
+
+async def api_aggregate(request, frequency):
+    """Aggregate trains by type on given frequency, as web.api_aggregate"""
+    if frequency not in rollups.FREQUENCIES:
+        raise BadRequest()
+    since = web.round_since(web.parse_since(request.args.get('since'), default_days_ago=None))
+    if since:
+        since = get_datestring(since)
+    route = request.get_route().key if 'route' in request.args else ''
+    status, etag, body = await respond_cached(request, None, lambda res_db: rollups.query(
+        res_db, frequency, since, route=route
+    ))
+    return status, 'application/json', etag, body
+
+
+async def metrics_endpoint(request): # pylint: disable=W0613
+    """Metrics of the process, in the Prometheus text format"""
+    return 200, 'text/plain; version=0.0.4', None, web.render_metrics().encode('utf-8')
+
+
+# (rule, pattern, view), the rule labels the metrics as in web.py
+RULES = [
+    ('/api', re.compile(r'^/api$'), api),
+    ('/api/aggregate/<frequency>', re.compile(r'^/api/aggregate/(?P<frequency>[^/]+)$'),
+     api_aggregate),
+    ('/metrics', re.compile(r'^/metrics$'), metrics_endpoint),
+]
+
+
+def match(path):
+    """Rule, view and keyword args of a path, None if unknown"""
+    for rule, pattern, view in RULES:
+        found = pattern.match(path)
+        if found:
+            return rule, view, found.groupdict()
+    return 'unmatched', None, {}
+
+
+async def lifespan(receive, send):
+    """Watch the generation, shut the pool down w/ the server"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            generation_watcher.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    start = time.perf_counter()
+    rule, view, kwargs = match(scope['path'])
+    etag = None
+    try:
+        if view is None:
+            raise NotFound()
+        if scope['method'] != 'GET':
+            raise MethodNotAllowed()
+        status, mimetype, etag, body = await view(Request(scope), **kwargs)
+    except HTTPException as exc:
+        status, mimetype, body = exc.code, 'text/plain', exc.name.encode('utf-8')
+
+    headers = [
+        (b'content-type', mimetype.encode('latin-1')),
+        (b'access-control-allow-origin', b'*'),
+    ]
+    if isinstance(body, bytes):
+        headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    if etag is not None:
+        headers.append((b'etag', ('"%s"' % etag).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    if isinstance(body, bytes):
+        await send({'type': 'http.response.body', 'body': body})
+    else:
+        # streamed, w/o content-length
+        async for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    web.HTTP_REQUESTS.inc(route=rule, status=status)
+    web.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route=rule)
+
+
+@click.command()
+@click.option('--host', default='0.0.0.0', help='Interface to listen on')
+@click.option('--port', default=5001, help='Port to listen on')
+def run(host, port):
+    """Serve the async web API (requires uvicorn)"""
+    if uvicorn is None:
+        raise click.UsageError('uvicorn is required: pip install uvicorn')
+    uvicorn.run(app, host=host, port=port)
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
@@ -0,0 +1 @@
+"""Benchmarks, to run from the project root, e.g. `python -m benchmarks.indexes`"""
@@ -0,0 +1,134 @@
+"""Synthetic history of train results"""
+
+import random
+from datetime import datetime, timedelta
+
+import click
+import dataset
+from stuf import stuf
+
+import rollups
+import schema
+from utils import get_timestamp
+
+
+FIRST_DEPARTURE = 5 * 60
+LAST_DEPARTURE = 24 * 60 - 1
+
+
+def get_timetable(pairs, trains_per_day):
+    """A fixed daily timetable per station pair and direction"""
+    timetable = []
+    for pair in range(pairs):
+        stations = (str(87380000 + 2 * pair), str(87380001 + 2 * pair))
+        for direction, (from_gare, to_gare) in enumerate((stations, stations[::-1])):
+            for idx in range(trains_per_day):
+                minutes = FIRST_DEPARTURE + \
+                    idx * (LAST_DEPARTURE - FIRST_DEPARTURE) // trains_per_day
+                timetable.append({
+                    'num': '%d%d%03d' % (pair + 1, direction, idx),
+                    'miss': 'M%03d' % (idx % 40),
+                    'term': int(to_gare),
+                    'from_gare': from_gare,
+                    'to_gare': to_gare,
+                    'minutes': minutes,
+                    # fewer trains on week-ends
+                    'weekend': idx % 3 == 0,
+                })
+    return timetable
+
+
+def iter_history(days, pairs=1, trains_per_day=60, start=None, seed=0,
+                 suppr_rate=0.03, retard_rate=0.08, incident_rate=0.02):
+    """Yield `results` rows, as recorded by `flag.record`, for `days` days
+
+    On incident days (strikes, works, ...), the trains leaving a station
+    get 10 times more cancellations and delays.
+    """
+    rnd = random.Random(seed)
+    if start is None:
+        start = datetime.now() - timedelta(days=days)
+    start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    timetable = get_timetable(pairs, trains_per_day)
+    for day in range(days):
+        day_start = start + timedelta(days=day)
+        weekday = day_start.isoweekday()
+        incidents = {
+            train['from_gare'] for train in timetable if rnd.random() < incident_rate
+        }
+        for train in timetable:
+            if weekday >= 6 and not train['weekend']:
+                continue
+            draw = rnd.random()
+            if train['from_gare'] in incidents:
+                draw /= 10
+            etat, train_type, delay = '', 'NORMAL', None
+            if draw < suppr_rate:
+                etat, train_type = 'Supprimé', 'SUPPR'
+            elif draw < suppr_rate + retard_rate:
+                # mostly a few minutes, sometimes a lot more
+                etat, train_type = 'Retardé', 'RETARD'
+                delay = 60 * (1 + int(rnd.expovariate(1 / 4.)))
+            date = day_start + timedelta(minutes=train['minutes'])
+            yield {
+                'date': str(date),
+                'ts': get_timestamp(date),
+                'num': train['num'],
+                'miss': train['miss'],
+                'term': train['term'],
+                'etat': etat,
+                'type': train_type,
+                'from_gare': train['from_gare'],
+                'to_gare': train['to_gare'],
+                'delay': delay,
+                'weekday': weekday,
+            }
+
+
+def generate(db, rows, chunk_size=20000):
+    """Bulk insert rows into `results`, return the count"""
+    table = db['results'].table
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            with db as tx:
+                tx.executable.execute(table.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        with db as tx:
+            tx.executable.execute(table.insert(), chunk)
+        count += len(chunk)
+    return count
+
+
+def create(path, days, pairs=1, trains_per_day=60, version=None):
+    """Create a SQLite database w/ a synthetic history, migrated to `version`
+
+    The rollups of a fully migrated database are computed from the history.
+    """
+    db = dataset.connect('sqlite:///%s' % path, row_type=stuf)
+    schema.migrate(db, version=version)
+    count = generate(db, iter_history(days, pairs=pairs, trains_per_day=trains_per_day))
+    if version is None:
+        with db as tx:
+            rollups.rebuild(tx)
+            rollups.rebuild_trains(tx)
+    return db, count
+
+
+@click.command()
+@click.argument('path')
+@click.option('--days', default=365, help='Days of history')
+@click.option('--pairs', default=1, help='Station pairs')
+@click.option('--trains-per-day', default=60, help='Trains per day and direction')
+def run(path, days, pairs, trains_per_day):
+    """Create a database at PATH w/ a synthetic history"""
+    _, count = create(path, days, pairs=pairs, trains_per_day=trains_per_day)
+    click.echo('%s rows created in %s' % (count, path))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
@@ -0,0 +1,132 @@
+"""Query plans and timings of the hot `results` queries, w/ and w/o indexes"""
+
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+
+from benchmarks.history import create
+from queries import ROUTE
+from utils import get_timestamp
+
+
+# (SQL, params) of the hot queries, see queries.py
+# params ending w/ `_ago` are relative to now: epochs for `ts`, ISO for `date`
+QUERIES = {
+    'dedup': (
+        "SELECT * FROM results WHERE ts > :ts_ago AND num IN (:num)",
+        {'ts_ago': timedelta(hours=4), 'num': '10010'}
+    ),
+    'api': (
+        "SELECT * FROM results WHERE %s = :route AND ts > :ts_ago "
+        "ORDER BY ts DESC" % ROUTE,
+        {'ts_ago': timedelta(days=1), 'route': '87380000-87380001'}
+    ),
+    'train_counts': (
+        "SELECT num, substr(date, 12, 5) as hour, weekday, count(*) as count "
+        "FROM results GROUP BY num, hour, weekday",
+        {}
+    ),
+    'aggregate_day_since': (
+        "SELECT substr(date, 0, 11) AS date, type, COUNT(*) AS count FROM results "
+        "WHERE date > :date_ago GROUP BY substr(date, 0, 11), type",
+        {'date_ago': timedelta(days=7)}
+    ),
+    'aggregate_day_route_since': (
+        "SELECT substr(date, 0, 11) AS date, type, COUNT(*) AS count FROM results "
+        "WHERE %s = :route AND date > :date_ago GROUP BY substr(date, 0, 11), type" % ROUTE,
+        {'date_ago': timedelta(days=7), 'route': '87380000-87380001'}
+    ),
+    'aggregate_weekday_since': (
+        "SELECT weekday AS date, type, COUNT(*) AS count FROM results "
+        "WHERE date > :date_ago GROUP BY weekday, type",
+        {'date_ago': timedelta(days=7)}
+    ),
+}
+
+
+def resolve(params, now):
+    """Replace the relative dates of the params"""
+    resolved = {}
+    for key, value in params.items():
+        if key == 'ts_ago':
+            value = get_timestamp(now - value)
+        elif key == 'date_ago':
+            value = str(now - value)
+        resolved[key] = value
+    return resolved
+
+
+def explain(db, sql, params):
+    """SQLite query plan, one step per line"""
+    plan = db.executable.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, params)
+    return ' / '.join(row[-1] for row in plan)
+
+
+def timeit(db, sql, params, repeat):
+    """Best time of `repeat` runs, in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(db.query(sql, **params))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def get_indexes(db):
+    """DDL of the `results` indexes"""
+    return [row['sql'] for row in db.query(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'results' "
+        "AND sql IS NOT NULL"
+    )]
+
+
+@click.command()
+@click.option('--days', default=3 * 365, help='Days of history')
+@click.option('--pairs', default=16, help='Station pairs')
+@click.option('--repeat', default=5, help='Runs per query')
+@click.option('--json', 'as_json', is_flag=True, help='Machine-readable output')
+def run(days, pairs, repeat, as_json):
+    """Compare the hot queries w/o and w/ the indexes of the schema"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        db, count = create(path, days, pairs=pairs)
+        indexes = get_indexes(db)
+        for ddl in indexes:
+            db.query('DROP INDEX %s' % ddl.split()[2])
+        now = datetime.now()
+        results = {'rows': count, 'queries': {}}
+        for phase in ('before', 'after'):
+            if phase == 'after':
+                for ddl in indexes:
+                    db.query(ddl)
+                db.query('ANALYZE')
+            for name, (sql, params) in QUERIES.items():
+                params = resolve(params, now)
+                results['queries'].setdefault(name, {})[phase] = {
+                    'plan': explain(db, sql, params),
+                    'ms': timeit(db, sql, params, repeat),
+                }
+        db.close()
+    finally:
+        os.unlink(path)
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+        return
+    click.echo('%s rows' % results['rows'])
+    for name, phases in results['queries'].items():
+        click.echo('\n%s: %.1fms -> %.1fms' % (
+            name, phases['before']['ms'], phases['after']['ms']
+        ))
+        for phase in ('before', 'after'):
+            click.echo('  %-6s %s' % (phase, phases[phase]['plan']))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
@@ -0,0 +1,222 @@
+"""Load test: web.py under uwsgi vs asgi.py under uvicorn
+
+Both serve a synthetic history to a growing number of concurrent clients,
+each polling `/api` and `/api/aggregate/day` over a keep-alive connection,
+w/ a share of uncached aggregates (long queries). Requires uwsgi and
+uvicorn.
+
+The servers import this module: `wsgi_app` and `asgi_app` serve the
+database of BENCH_DATABASE_URI.
+"""
+
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+import click
+
+import asgi
+from config import settings
+import web
+from benchmarks.history import create
+
+
+if 'BENCH_DATABASE_URI' in os.environ:
+    settings.DATABASE_URI = os.environ['BENCH_DATABASE_URI']
+    settings.ROUTES = [('bench', 87380000, 87380001)]
+    web.app.debug = False
+
+wsgi_app = web.app
+asgi_app = asgi.app
+
+
+def get_commands(port, processes, threads):
+    """Server command lines, by name"""
+    return {
+        'wsgi': [
+            'uwsgi', '--http', '127.0.0.1:%s' % port, '--http-keepalive',
+            '--module', 'benchmarks.load:wsgi_app', '--pythonpath', os.getcwd(),
+            '--home', sys.prefix, '--master', '--processes', str(processes),
+            '--threads', str(threads), '--listen', '1024', '--disable-logging',
+            '--die-on-term',
+        ],
+        'asgi': [
+            sys.executable, '-m', 'uvicorn', 'benchmarks.load:asgi_app',
+            '--port', str(port), '--log-level', 'warning', '--backlog', '4096',
+        ],
+    }
+
+
+def get_port():
+    """A free local port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    """Wait for a server to answer"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urlopen('http://127.0.0.1:%s/api/aggregate/day' % port) as res:
+                res.read()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+class Client(object):
+    """HTTP/1.1 client over a keep-alive connection, reconnected as needed"""
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        """Status of a GET request, w/ the body read"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.writer.write(('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path).encode())
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+        lines = head.split('\r\n')
+        headers = dict(
+            line.lower().split(': ', 1) for line in lines[1:] if ': ' in line
+        )
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        else:
+            await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection') == 'close':
+            self.close()
+        return int(lines[0].split()[1])
+
+    def close(self):
+        """Close the connection, if any"""
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def load(port, clients, duration, uncached, timeout):
+    """Latencies (ms) of the requests of `clients` polling for `duration`
+    seconds, and the count of errors
+    """
+    latencies, errors = [], []
+    since = int(time.time()) - 365 * 24 * 3600
+    deadline = time.perf_counter() + duration
+
+    async def poll(seed):
+        rnd = random.Random(seed)
+        client = Client(port)
+        while time.perf_counter() < deadline:
+            if rnd.random() < uncached:
+                # a new cache key, the query hits the database
+                path = '/api/aggregate/hour?since=%s' % (since + rnd.randint(0, 10 ** 6) * 60)
+            else:
+                path = rnd.choice(('/api', '/api/aggregate/day'))
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(client.get(path), timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError) as exc:
+                errors.append(type(exc).__name__)
+                client.close()
+                continue
+            if status != 200:
+                errors.append(status)
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+        client.close()
+
+    await asyncio.gather(*[poll(seed) for seed in range(clients)])
+    return latencies, errors
+
+
+def get_stats(latencies, errors, duration):
+    """Throughput and latency percentiles of a run"""
+    if not latencies:
+        return {'requests_per_s': 0, 'errors': len(errors)}
+    latencies = sorted(latencies)
+    return {
+        'requests_per_s': len(latencies) / duration,
+        'median_ms': statistics.median(latencies),
+        'p95_ms': latencies[int(len(latencies) * .95)],
+        'p99_ms': latencies[int(len(latencies) * .99)],
+        'errors': len(errors),
+    }
+
+
+def run_server(name, command, path, concurrency, duration, uncached, timeout, port):
+    """Load test a server at each concurrency"""
+    env = dict(os.environ, BENCH_DATABASE_URI='sqlite:///%s' % path)
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    results = {}
+    try:
+        wait_ready(port)
+        for clients in concurrency:
+            latencies, errors = asyncio.run(load(port, clients, duration, uncached, timeout))
+            results['%s %s clients' % (name, clients)] = get_stats(latencies, errors, duration)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+@click.command()
+@click.option('--days', default=365, help='Days of history')
+@click.option('--pairs', default=8, help='Station pairs')
+@click.option('--concurrency', default='10,100,1000', help='Concurrent clients, comma separated')
+@click.option('--duration', default=10, help='Seconds per run')
+@click.option('--uncached', default=0.05, help='Share of the requests missing the cache')
+@click.option('--timeout', default=30, help='Seconds before a request fails')
+@click.option('--processes', default=1, help='uwsgi processes')
+@click.option('--threads', default=settings.ASGI_THREADS, help='uwsgi threads per process')
+@click.option('--output', type=click.Path(), default=None, help='Write the report as JSON')
+def run(days, pairs, concurrency, duration, uncached, timeout, processes, threads, output): # pylint: disable=R0913
+    """Load test the web API, sync (web.py) vs async (asgi.py)"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    concurrency = [int(clients) for clients in concurrency.split(',')]
+    report = {}
+    try:
+        db, count = create(path, days, pairs=pairs)
+        db.close()
+        click.echo('%s rows generated' % count)
+        port = get_port()
+        for name, command in get_commands(port, processes, threads).items():
+            report.update(run_server(
+                name, command, path, concurrency, duration, uncached, timeout, port
+            ))
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+    if output:
+        with open(output, 'w') as jsonfile:
+            jsonfile.write(json.dumps(report, indent=2))
+    click.echo('%-22s %10s %10s %10s %10s %8s' % (
+        'run', 'req/s', 'median', 'p95', 'p99', 'errors'
+    ))
+    for name, stats in report.items():
+        click.echo('%-22s %10.0f %8.1fms %8.1fms %8.1fms %8s' % (
+            name, stats['requests_per_s'], stats.get('median_ms', 0),
+            stats.get('p95_ms', 0), stats.get('p99_ms', 0), stats['errors']
+        ))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
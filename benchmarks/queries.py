@@ -0,0 +1,84 @@
+"""Interpolated SQL strings vs the shared parameterized statements"""
+
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+
+import queries
+from benchmarks.history import create
+from utils import get_timestamp
+
+
+def timeit(func, params):
+    """Mean duration of a call for each params, in microseconds"""
+    start = time.perf_counter()
+    for param in params:
+        list(func(*param))
+    return (time.perf_counter() - start) / len(params) * 1e6
+
+
+@click.command()
+@click.option('--days', default=90, help='Days of history')
+@click.option('--pairs', default=4, help='Station pairs')
+@click.option('--requests', 'count', default=5000, help='Queries per statement')
+def run(days, pairs, count):
+    """Time a stream of lookups w/ changing values, both ways"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        db, rows = create(path, days, pairs=pairs)
+        nums = [row.num for row in db.query('SELECT DISTINCT num FROM results')]
+        rnd = random.Random(0)
+        now = datetime.now()
+        lookups = [
+            (
+                get_timestamp(now - timedelta(hours=4, seconds=rnd.randint(0, 3600))),
+                rnd.choice(nums)
+            )
+            for _ in range(count)
+        ]
+        aggregates = [
+            (str(now - timedelta(hours=2, seconds=rnd.randint(0, 3600))), )
+            for _ in range(count)
+        ]
+        results = {
+            'dedup lookup': (
+                timeit(lambda limit_ts, num: db.query(
+                    "SELECT * FROM results WHERE ts > %s AND num IN ('%s')" % (
+                        limit_ts, num
+                    )
+                ), lookups),
+                timeit(lambda limit_ts, num: db.query(
+                    queries.RECENT_TRAINS, limit_ts=limit_ts, nums=[num]
+                ), lookups),
+            ),
+            'aggregate since': (
+                timeit(lambda since: db.query("""
+                    SELECT %(group_by)s as date, type, COUNT(*) as count
+                    FROM results WHERE date > '%(since)s'
+                    GROUP BY %(group_by)s, type;
+                """ % {
+                    'group_by': queries.FREQUENCIES['hour'], 'since': since
+                }), aggregates),
+                timeit(lambda since: db.query(
+                    queries.AGGREGATE_SINCE['hour'], since=since
+                ), aggregates),
+            ),
+        }
+        db.close()
+    finally:
+        os.unlink(path)
+
+    click.echo('%s rows, %s queries per statement' % (rows, count))
+    for name, (interpolated, prepared) in results.items():
+        click.echo('%s: interpolated %.0fus, prepared %.0fus per query' % (
+            name, interpolated, prepared
+        ))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
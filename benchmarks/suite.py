@@ -0,0 +1,220 @@
+"""Benchmark suite: ingestion, API and train list on a synthetic history
+
+Timings are printed, or written as JSON w/ `--output`, to compare runs
+across commits w/ `--compare`.
+"""
+
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+
+import database
+import flag
+import rollups
+from config import settings
+import web
+from benchmarks.history import create, get_timetable
+from make_train_list import get_trains
+from utils import get_timestamp
+
+
+# trains per API response
+RESPONSE_SIZE = 30
+
+
+def measure(func, repeat, setup=None):
+    """Durations of `repeat` calls, in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+    return {
+        'runs': repeat,
+        'min_ms': min(durations),
+        'median_ms': statistics.median(durations),
+        'mean_ms': statistics.mean(durations),
+    }
+
+
+def get_responses(pairs, trains_per_day, day, seed=0):
+    """Raw API rows of the trains of a day, by response
+
+    Three passes over the timetable: first seen, then w/ cancellations and
+    delays, then unchanged.
+    """
+    rnd = random.Random(seed)
+    timetable = get_timetable(pairs, trains_per_day)
+    passes = {'new': [], 'changed': [], 'unchanged': []}
+    for train in timetable:
+        first = date = day + timedelta(minutes=train['minutes'])
+        raw = {
+            'num': train['num'],
+            'miss': train['miss'],
+            'term': train['term'],
+            'from_gare': train['from_gare'],
+            'to_gare': train['to_gare'],
+        }
+        changed = dict(raw)
+        draw = rnd.random()
+        if draw < 0.1:
+            changed['etat'] = 'Supprimé'
+        elif draw < 0.3:
+            date += timedelta(minutes=rnd.randint(1, 15))
+        passes['new'].append(dict(raw, date=first.strftime('%d/%m/%Y %H:%M')))
+        passes['changed'].append(dict(changed, date=date.strftime('%d/%m/%Y %H:%M')))
+        passes['unchanged'].append(dict(passes['changed'][-1]))
+    return {
+        name: [rows[i:i + RESPONSE_SIZE] for i in range(0, len(rows), RESPONSE_SIZE)]
+        for name, rows in passes.items()
+    }
+
+
+def bench_ingestion(db, pairs, trains_per_day):
+    """`flag.record_many` of a day of responses, for each pass, w/ and w/o
+    the in-memory index of the poller
+    """
+    # tomorrow, so that every train is within the dedup window
+    day = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0,
+                                                      microsecond=0)
+    results = {}
+    for suffix, index in (('', None), (' indexed', flag.RecentIndex())):
+        # from the same history
+        db.query('DELETE FROM results WHERE ts >= :ts', ts=get_timestamp(day))
+        for name, responses in get_responses(pairs, trains_per_day, day).items():
+            batches = iter(responses)
+            stats = measure(
+                lambda: flag.record_many(next(batches), db=db, index=index), len(responses)
+            )
+            stats['rows_per_s'] = sum(len(r) for r in responses) / \
+                (stats['mean_ms'] * stats['runs'] / 1000)
+            results['ingestion %s%s' % (name, suffix)] = stats
+    return results
+
+
+def bench_api(repeat):
+    """API endpoints, w/ a cold and a warm response cache"""
+    client = web.app.test_client()
+    # named w/ a relative since, to compare runs
+    since = int(time.time()) - 7 * 24 * 3600
+    paths = {name: name for name in ('/api', '/api?format=ndjson', '/api/trains')}
+    for frequency in sorted(rollups.FREQUENCIES):
+        name = '/api/aggregate/%s' % frequency
+        paths[name] = name
+        paths[name + '?since=-7d'] = '%s?since=%s' % (name, since)
+    # a route out of several
+    paths['/api/aggregate/day?route=bench&since=-7d'] = \
+        '/api/aggregate/day?route=bench&since=%s' % since
+
+    def get(path):
+        res = client.get(path)
+        assert res.status_code == 200, (path, res.status_code)
+
+    results = {}
+    for name, path in paths.items():
+        results['GET %s cold' % name] = measure(
+            lambda: get(path), repeat, setup=web.response_cache.clear
+        )
+        results['GET %s warm' % name] = measure(lambda: get(path), repeat)
+    return results
+
+
+def get_commit():
+    """Current git commit, if any"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, check=True,
+            universal_newlines=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(path, days, pairs, trains_per_day, repeat):
+    """Run all the benchmarks on a new database at `path`"""
+    start = time.perf_counter()
+    db, count = create(path, days, pairs=pairs, trains_per_day=trains_per_day)
+    db.close()
+    report = {
+        'commit': get_commit(),
+        'date': datetime.now().isoformat(' '),
+        'python': platform.python_version(),
+        'params': {'days': days, 'pairs': pairs, 'trains_per_day': trains_per_day,
+                   'repeat': repeat},
+        'rows': count,
+        'generation_s': time.perf_counter() - start,
+        'results': {},
+    }
+
+    # the API serves the first pair
+    settings.DATABASE_URI = 'sqlite:///%s' % path
+    settings.ROUTES = [('bench', 87380000, 87380001)]
+    try:
+        db = database.get()
+        report['results'].update(bench_api(repeat))
+        report['results']['make_train_list'] = measure(lambda: get_trains(db), repeat)
+        report['results'].update(bench_ingestion(db, pairs, trains_per_day))
+    finally:
+        database.close()
+    return report
+
+
+def compare(old, new):
+    """Lines comparing the median timings of two reports"""
+    lines = ['%-45s %10s %10s %7s' % ('benchmark', 'before', 'after', 'ratio')]
+    for name, stats in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            lines.append('%-45s %10s %8.2fms %7s' % (name, '-', stats['median_ms'], '-'))
+            continue
+        lines.append('%-45s %8.2fms %8.2fms %6.2fx' % (
+            name, before['median_ms'], stats['median_ms'],
+            stats['median_ms'] / before['median_ms'] if before['median_ms'] else 0
+        ))
+    return lines
+
+
+@click.command()
+@click.option('--days', default=3 * 365, help='Days of history')
+@click.option('--pairs', default=16, help='Station pairs')
+@click.option('--trains-per-day', default=60, help='Trains per day and direction')
+@click.option('--repeat', default=5, help='Runs per benchmark')
+@click.option('--output', type=click.Path(), default=None, help='Write the report as JSON')
+@click.option('--compare', 'baseline', type=click.File(), default=None,
+              help='JSON report to compare to')
+def run(days, pairs, trains_per_day, repeat, output, baseline):
+    """Time ingestion, the API and the train list on a synthetic history"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        report = run_suite(path, days, pairs, trains_per_day, repeat)
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+    if output:
+        with open(output, 'w') as jsonfile:
+            jsonfile.write(json.dumps(report, indent=2))
+    click.echo('%s rows generated in %.1fs, commit %s' % (
+        report['rows'], report['generation_s'], report['commit']
+    ))
+    if baseline:
+        click.echo('\n'.join(compare(json.load(baseline), report)))
+        return
+    for name, stats in report['results'].items():
+        click.echo('%-45s %8.2fms' % (name, stats['median_ms']))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
@@ -0,0 +1,79 @@
+"""make_train_list: single pass engine vs the former per-train queries"""
+
+import os
+import tempfile
+import time
+
+import click
+
+import routes
+from make_train_list import get_trains
+from benchmarks.history import create
+
+
+def get_trains_legacy(res_db):
+    """Former implementation, w/ four queries per train"""
+    table = res_db['results']
+
+    def get_nominal_hour(train_num):
+        res = res_db.query("""
+            SELECT count(*) as count, substr(date, 12, 5) as hour
+            FROM results WHERE num = '%s'
+            GROUP BY hour ORDER BY count DESC LIMIT 1;
+        """ % train_num)
+        return next(res).hour
+
+    def get_count_days(weekdays_list, num):
+        res = res_db.query("SELECT count(*) as count from results \
+            where num = '%s' and weekday in (%s)" % (
+                num,
+                ','.join([str(w) for w in weekdays_list])
+            ))
+        return next(res).count
+
+    trains = {}
+    for train in table.find(type='NORMAL'):
+        existing = trains.get(train.num)
+        if not existing:
+            trains[train.num] = {
+                'hour': get_nominal_hour(train.num),
+                'count': len(list(table.find(num=train.num))),
+                'route': getattr(routes.find(train.from_gare, train.to_gare), 'name', None),
+                'direction': routes.get_label(train.to_gare),
+                'count_weekend': get_count_days([6, 7], train.num),
+                'count_week': get_count_days([1, 2, 3, 4, 5], train.num),
+            }
+    return [dict(v, num=k) for k, v in trains.items()]
+
+
+def timed(func, *args):
+    """Result and duration (seconds) of a call"""
+    start = time.perf_counter()
+    res = func(*args)
+    return res, time.perf_counter() - start
+
+
+@click.command()
+@click.option('--days', default=2 * 365, help='Days of history')
+@click.option('--pairs', default=4, help='Station pairs')
+def run(days, pairs):
+    """Time both engines on a synthetic history and compare their output"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        db, count = create(path, days, pairs=pairs)
+        trains, duration = timed(get_trains, db)
+        legacy, legacy_duration = timed(get_trains_legacy, db)
+        db.close()
+    finally:
+        os.unlink(path)
+
+    by_num = lambda train: train['num']
+    click.echo('%s rows, %s trains' % (count, len(trains)))
+    click.echo('legacy: %.2fs' % legacy_duration)
+    click.echo('single pass: %.2fs' % duration)
+    click.echo('identical: %s' % (sorted(trains, key=by_num) == sorted(legacy, key=by_num)))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
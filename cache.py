@@ -0,0 +1,59 @@
+"""In-process cache of API responses, invalidated by the write generation"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """LRU cache of response payloads, keyed by request
+
+    An entry is only valid for the write generation it has been computed
+    for (see `database.get_generation`).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+    @staticmethod
+    def get_etag(key, generation):
+        """ETag of the response to a request at a given generation"""
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        return '%s-%s' % (generation, digest)
+
+    def count(self, stat):
+        """Increment a counter"""
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, key, generation):
+        """Get a payload if cached for this generation, counting hits/misses"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def set(self, key, generation, payload):
+        """Cache a payload"""
+        with self.lock:
+            self.entries[key] = (generation, payload)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all the entries"""
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        """Counters and current size"""
+        with self.lock:
+            return dict(self.stats, size=len(self.entries))
@@ -0,0 +1,44 @@
+"""Settings, w/ the defaults of the optional ones
+
+settings.py only needs the stations, the database and the credentials of
+the first releases: the settings added since are set from the defaults
+below when missing, so that the settings.py of an older install keeps
+working. Modules import `settings` from here, see settings.py.sample.
+"""
+
+import settings
+
+
+DEFAULTS = {
+    'POLL_SCHEDULE': [(0, 1800), (5, 300), (6, 120), (10, 300), (16, 120), (20, 300),
+                      (23, 1800)],
+    'DATABASE_POOL_SIZE': 5,
+    'DATABASE_BUSY_TIMEOUT': 10,
+    'DATABASE_SYNCHRONOUS': 'NORMAL',
+    'RETENTION_MONTHS': 12,
+    'ARCHIVE_DIR': 'archives',
+    'EXPORT_DIR': 'export',
+    'CACHE_SIZE': 256,
+    'CACHE_SINCE_BUCKET': 60,
+    'STREAM_INTERVAL': 1,
+    'STREAM_HEARTBEAT': 15,
+    'ASGI_THREADS': 8,
+    'TRANSILIEN_API_RATE_LIMIT': 20,
+    'TRANSILIEN_API_BURST': 4,
+    'TRANSILIEN_API_RETRIES': 3,
+    'TRANSILIEN_API_BACKOFF': 2,
+    'POLLER_WORKERS': 4,
+    'NOTIFICATIONS_MAX_ATTEMPTS': 5,
+    'NOTIFICATIONS_INTERVAL': 30,
+}
+
+
+def apply(module):
+    """Set the missing settings of a settings module to their default"""
+    for name, value in DEFAULTS.items():
+        if not hasattr(module, name):
+            setattr(module, name, value)
+    return module
+
+
+apply(settings)
@@ -1,11 +1,139 @@
 """Database wrapper"""
 
+import os
+import threading
+import time
+
 import dataset
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
 from stuf import stuf
 
-import settings
+import metrics
+import queries
+import rows
+from config import settings
+
+
+# process-wide connectors, by (URI, read only)
+DATABASES = {}
+LOCK = threading.Lock()
+
+STATEMENT_SECONDS = metrics.Histogram(
+    'transilien_db_statement_seconds', 'Duration of the DB statements', ['statement']
+)
+
+
+def instrument(engine):
+    """Time the statements of an engine, by kind (SELECT, INSERT, ...)"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, parameters, context, executemany): # pylint: disable=W0613,R0913
+        conn.info['statement_start'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, parameters, context, executemany): # pylint: disable=W0613,R0913
+        kind = (statement.split(None, 1) or [''])[0].upper()
+        STATEMENT_SECONDS.observe(
+            time.perf_counter() - conn.info.pop('statement_start'), statement=kind
+        )
+
+    return engine
+
+
+def connect(uri, read_only=False):
+    """Create a DB connector w/ a pool of connections
+
+    SQLite databases are journaled w/ WAL, so that readers do not block
+    behind the writer, and wait for locks up to DATABASE_BUSY_TIMEOUT.
+    Statements are timed, see `instrument`. Read only connectors return
+    compact `rows.Row`s instead of `stuf`s.
+    """
+    row_type = rows.make_row if read_only else stuf
+    if not uri.startswith('sqlite'):
+        db = dataset.connect(uri, row_type=row_type)
+        instrument(db.engine)
+        return db
+    statements = ['PRAGMA synchronous = %s' % settings.DATABASE_SYNCHRONOUS]
+    if read_only:
+        statements.append('PRAGMA query_only = ON')
+    db = dataset.connect(
+        uri,
+        row_type=row_type,
+        sqlite_wal_mode=True,
+        on_connect_statements=statements,
+        engine_kwargs={
+            'poolclass': QueuePool,
+            'pool_size': settings.DATABASE_POOL_SIZE,
+            'connect_args': {
+                'timeout': settings.DATABASE_BUSY_TIMEOUT,
+                # pooled connections are handed over between threads
+                'check_same_thread': False,
+            },
+        }
+    )
+    instrument(db.engine)
+    return db
+
+
+def is_same(uri, other):
+    """Whether two URIs are the same database, SQLite files by resolved path"""
+    url, other = make_url(uri), make_url(other)
+    if url.get_backend_name() != other.get_backend_name():
+        return False
+    if url.get_backend_name() == 'sqlite':
+        # in memory databases are never shared
+        return bool(url.database) and url.database != ':memory:' and \
+            os.path.realpath(url.database) == os.path.realpath(other.database or '')
+    return (url.host, url.port, url.database) == (other.host, other.port, other.database)
+
+
+def get(read_only=False):
+    """Get DB connector, shared by the process"""
+    key = (settings.DATABASE_URI, read_only)
+    with LOCK:
+        if key not in DATABASES:
+            DATABASES[key] = connect(settings.DATABASE_URI, read_only=read_only)
+        return DATABASES[key]
+
+
+def release(db):
+    """Return the connection of the calling thread to the pool
+
+    dataset keeps a connection per thread otherwise.
+    """
+    with db.lock:
+        conn = db.connections.pop(threading.get_ident(), None)
+    if conn is not None:
+        conn.close()
+
+
+def close():
+    """Close all the DB connectors of the process"""
+    with LOCK:
+        for db in DATABASES.values():
+            db.close()
+        DATABASES.clear()
+
+
+def get_generation(db):
+    """Get the write generation, bumped on every write to `results`
+
+    None if the database has not been migrated yet.
+    """
+    if 'meta' not in db:
+        return None
+    res = next(db.query(queries.GET_GENERATION), None)
+    return res and res['value']
+
 
+def bump_generation(db):
+    """Bump the write generation (within the writing transaction)
 
-def get():
-    """Get DB connector"""
-    return dataset.connect(settings.DATABASE_URI, row_type=stuf)
+    Return the new generation, the `rev` of the rows written by the
+    transaction: the write lock is held from the bump on, so concurrent
+    writers get distinct generations.
+    """
+    db.query(queries.BUMP_GENERATION)
+    return get_generation(db)
@@ -0,0 +1,134 @@
+"""Columnar export of the results, to Parquet files partitioned by month
+
+For offline analyses (see analytics.py): the results, archives included,
+are streamed from SQLite in batches of columns, w/o `dataset` rows nor a
+transaction held on the live database. Requires pyarrow.
+"""
+
+import os
+import shutil
+import sqlite3
+
+import click
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+import archive
+from config import settings
+
+
+BATCH_SIZE = 10000
+
+COLUMNS = (
+    ('id', 'int64'),
+    ('date', 'string'),
+    ('num', 'string'),
+    ('miss', 'string'),
+    ('term', 'int64'),
+    ('etat', 'string'),
+    ('type', 'string'),
+    ('from_gare', 'string'),
+    ('to_gare', 'string'),
+    ('delay', 'int64'),
+    ('weekday', 'int64'),
+    ('ts', 'int64'),
+    ('rev', 'int64'),
+)
+
+
+def get_schema():
+    """Arrow schema of the exported results"""
+    return pa.schema([(name, getattr(pa, column_type)()) for name, column_type in COLUMNS])
+
+
+def get_sources():
+    """Paths of the SQLite files holding results: archives, then the live DB"""
+    if not settings.DATABASE_URI.startswith('sqlite:///'):
+        raise click.UsageError('Only SQLite databases can be exported')
+    return [path for _, path in archive.get_files()] + \
+        [settings.DATABASE_URI[len('sqlite:///'):]]
+
+
+def iter_batches(path, schema):
+    """Record batches of the results of a SQLite file, ordered by date"""
+    conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    try:
+        existing = {row[1] for row in conn.execute('PRAGMA table_info(results)')}
+        # archives may predate the latest columns
+        cursor = conn.execute('SELECT %s FROM results ORDER BY date' % ', '.join(
+            name if name in existing else 'NULL' for name in schema.names
+        ))
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            yield pa.RecordBatch.from_arrays([
+                pa.array([row[i] for row in rows], type=field.type)
+                for i, field in enumerate(schema)
+            ], schema=schema)
+    finally:
+        conn.close()
+
+
+def split_months(batch):
+    """Split a batch ordered by date into `(month, batch)` slices"""
+    months = [date[:7] for date in batch.column(1).to_pylist()]
+    start = 0
+    for i in range(1, len(months) + 1):
+        if i == len(months) or months[i] != months[start]:
+            yield months[start], batch.slice(start, i - start)
+            start = i
+
+
+def export(output):
+    """Export all the results to `output`/month=YYYY-MM/results.parquet
+
+    The export is written aside, then replaces the previous one. Return the
+    count of rows by month.
+    """
+    schema = get_schema()
+    output = output.rstrip(os.sep)
+    tmp = output + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    writers = {}
+    counts = {}
+    try:
+        for path in get_sources():
+            for batch in iter_batches(path, schema):
+                for month, rows in split_months(batch):
+                    if month not in writers:
+                        directory = os.path.join(tmp, 'month=%s' % month)
+                        os.makedirs(directory)
+                        writers[month] = pq.ParquetWriter(
+                            os.path.join(directory, 'results.parquet'), schema
+                        )
+                    writers[month].write_batch(rows)
+                    counts[month] = counts.get(month, 0) + rows.num_rows
+    finally:
+        for writer in writers.values():
+            writer.close()
+    shutil.rmtree(output, ignore_errors=True)
+    os.rename(tmp, output)
+    return counts
+
+
+@click.command()
+@click.option('--output', default=None, help='Export directory (default: EXPORT_DIR)')
+def run(output):
+    """Export the results, archives included, to Parquet files by month"""
+    if pa is None:
+        raise click.UsageError('pyarrow is required: pip install pyarrow')
+    output = output or settings.EXPORT_DIR
+    counts = export(output)
+    click.echo('Exported %s results of %s months to %s' % (
+        sum(counts.values()), len(counts), output
+    ))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
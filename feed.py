@@ -0,0 +1,59 @@
+"""Change feed: wake up the streaming clients when the results change"""
+
+import threading
+import time
+
+import click
+
+import database
+
+
+class GenerationWatcher(object):
+    """Watch the write generation (see `database.get_generation`)
+
+    A single thread polls the generation every `interval` seconds for all
+    the waiting clients, so that idle clients cost no query.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.generation = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        """Start the watching thread, if not running yet"""
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='feed', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        """Poll the generation, notify the waiting clients on change"""
+        while True:
+            db = database.get(read_only=True)
+            try:
+                generation = database.get_generation(db)
+            except Exception as exc: # pylint: disable=W0703
+                click.secho('ERROR while watching the generation: %r' % exc,
+                            err=True, bg='red')
+                generation = self.generation
+            finally:
+                database.release(db)
+            with self.condition:
+                if generation != self.generation:
+                    self.generation = generation
+                    self.condition.notify_all()
+            time.sleep(self.interval)
+
+    def wait(self, generation, timeout):
+        """Wait up to `timeout` seconds for a generation other than `generation`
+
+        Return the current generation, None if still unknown.
+        """
+        self.start()
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.generation not in (None, generation), timeout
+            )
+            return self.generation
@@ -1,23 +1,107 @@
 """Requests transilien API for live train schedule"""
 
+import base64
+import cProfile
+import heapq
+import json
+import pstats
+import signal
+import threading
+import time
 import xml.etree.ElementTree as ET
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 
 import click
 import requests
+from requests.adapters import HTTPAdapter
 
-import settings
+from config import settings
 import database
+import metrics
 import notifications
-from utils import get_datetime_from_iso, get_limit_date, convert_to_iso
+import queries
+import rollups
+import routes
+import schema
+from utils import get_datetime, get_datetime_from_iso, get_datestring, get_limit_date, \
+    get_timestamp, TokenBucket
 
 
 BASE_URL = 'http://api.transilien.com/gare/%s/depart/%s/'
+TIMEOUT = 30
+CHUNK_SIZE = 16 * 1024
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
+# pooled HTTP connections, shared by the poller threads
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_maxsize=settings.POLLER_WORKERS))
+# shared by the poller threads to stay under the API rate limit
+limiter = TokenBucket.per_minute(
+    settings.TRANSILIEN_API_RATE_LIMIT, burst=settings.TRANSILIEN_API_BURST
+)
 
-def record(data):
-    """Record a data row into DB and trigger alert if needed"""
-    table = database.get()['results']
 
+API_REQUESTS = metrics.Counter(
+    'transilien_api_requests', 'Transilien API requests, by status', ['status']
+)
+API_FETCH_SECONDS = metrics.Histogram(
+    'transilien_api_fetch_seconds', 'Duration of the API fetches, until the headers, '
+    'retries included'
+)
+API_REQUEST_SECONDS = metrics.Histogram(
+    'transilien_api_request_seconds', 'Duration of `api_request`, fetch to commit'
+)
+INGEST_SECONDS = metrics.Histogram(
+    'transilien_ingest_seconds', 'Duration of the ingestion stages of a response: parse '
+    '(w/ the body download), lookup of the recorded trains and write', ['stage']
+)
+ROWS = metrics.Counter(
+    'transilien_rows', 'Ingested trains, by outcome (unchanged and updated trains are '
+    'de-duplication hits)', ['result']
+)
+
+NOTIF_SUPPR = 'suppr'
+NOTIF_UNSUPPR = 'unsuppr'
+
+
+class Capture(object):
+    """Append the API responses to a JSONL file, to replay them
+
+    One response per line: capture `time`, `from_station`, `to_station`
+    and the XML `body` as received, base64 encoded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def tee(self, chunks, from_station, to_station):
+        """Yield the chunks of a response, then append it to the file"""
+        captured = get_datestring(datetime.now())
+        body = []
+        for chunk in chunks:
+            body.append(chunk)
+            yield chunk
+        line = json.dumps({
+            'time': captured,
+            'from_station': from_station,
+            'to_station': to_station,
+            'body': base64.b64encode(b''.join(body)).decode('ascii'),
+        })
+        with self.lock, open(self.path, 'a') as capture_file:
+            capture_file.write(line + '\n')
+
+
+# set by `run --capture`
+capture = None
+# set by `run --metrics`
+metrics_path = None
+
+
+def normalize(data):
+    """Compute `type`, ISO `date`, `weekday` and `ts` of a raw API row (in place)"""
     data['type'] = 'NORMAL'
     etat = data.get('etat', False)
     if etat:
@@ -30,90 +114,520 @@ def record(data):
     else:
         data['etat'] = ''
 
-    # convert to ISO
-    data['date'] = convert_to_iso(data['date'])
-    data['weekday'] = get_datetime_from_iso(data['date']).isoweekday()
+    # convert to ISO, parsing once
+    the_datetime = get_datetime(data['date'])
+    data['date'] = get_datestring(the_datetime)
+    data['weekday'] = the_datetime.isoweekday()
+    data['ts'] = get_timestamp(the_datetime)
+    return data
 
-    limit_date = get_limit_date()
-    # no duplicates
-    # date can change for same train, num supposed unique each day
-    try:
-        existing = table.find_one(table.table.columns.date > limit_date, num=data['num'])
-    # AttributeError on `date` when DB is empty (first run)
-    except AttributeError:
-        existing = None
 
-    do_notif = False
+def compare(data, existing):
+    """Compare a normalized row with the recorded one for the same train
+
+    Return a tuple `(changes, notif)`: the columns to update on the existing
+    row (None if nothing changed, e.g. a train polled again w/ the same
+    delay) and the notification to send, if any.
+    """
     if existing is None:
-        if data['type'] == 'SUPPR':
-            do_notif = True
-        table.insert(data)
+        return None, NOTIF_SUPPR if data['type'] == 'SUPPR' else None
     # type has changed, maybe suppr
-    elif data['type'] != existing.type and data['type'] == 'SUPPR':
-        do_notif = True
-        table.update({
-            'id': existing.id,
-            'etat': data['etat'],
-            'type': data['type']
-        }, ['id'])
+    if data['type'] != existing['type'] and data['type'] == 'SUPPR':
+        return {'etat': data['etat'], 'type': data['type']}, NOTIF_SUPPR
     # date has changed, compute delay
-    elif data['date'] != existing['date']:
+    if data['date'] != existing['date']:
         data['type'] = 'RETARD'
         delta = get_datetime_from_iso(data['date']) - get_datetime_from_iso(existing['date'])
         data['delay'] = delta.seconds
-        table.update({
-            'id': existing.id,
-            'etat': data['etat'],
-            'type': data['type'],
-            'delay': data['delay']
-        }, ['id'])
+        changes = {'etat': data['etat'], 'type': data['type'], 'delay': data['delay']}
+        if all(existing[key] == value for key, value in changes.items()):
+            return None, None
+        return changes, None
     # no delay but RETARD??
-    elif data['type'] != existing['type']:
-        table.update({
-            'id': existing.id,
-            'etat': data['etat'],
-            'type': data['type']
-        }, ['id'])
+    if data['type'] != existing['type']:
         # sometimes train are "uncancelled" apparently
-        if existing['type'] == 'SUPPR':
-            notifications.send(data, cancel=True)
+        notif = NOTIF_UNSUPPR if existing['type'] == 'SUPPR' else None
+        return {'etat': data['etat'], 'type': data['type']}, notif
+    return None, None
 
-    if do_notif:
-        notifications.send(data)
 
+def get_train_key(data):
+    """Key of a train: its num and route (see `routes.get_key`)
 
-def api_request(from_station, to_station):
-    """Request Transilien API"""
+    A train stops at many stations, and shows up w/ the same num in the
+    responses of all the monitored pairs it serves: each is recorded.
+    """
+    return str(data['num']), routes.get_key(data['from_gare'], data['to_gare'])
+
+
+def get_recent(db, keys, limit_date):
+    """Get the recorded trains newer than `limit_date` for the given train
+    keys (see `get_train_key`), in one query, indexed by key
+    """
+    recent = {}
+    if not keys:
+        return recent
+    rows = db.query(
+        queries.RECENT_TRAINS,
+        limit_ts=get_timestamp(limit_date),
+        nums=list({num for num, _ in keys})
+    )
+    for row in rows:
+        key = get_train_key(row)
+        if key in keys:
+            # keep the first match, as `find_one` would
+            recent.setdefault(key, row)
+    return recent
+
+
+class RecentIndex(object):
+    """In-memory index of the recorded trains of the de-duplication window
+
+    Stands in for `get_recent` in a long running poller: rows are indexed by
+    train key (see `get_train_key`), a lookup is a dict access. Loaded from the DB on first use, kept in
+    sync by `record_many` after each commit and caught up from the rows of
+    the other writers (e.g. a cron `flag.py`) w/ the write generation. Rows
+    are expired as they leave the window. Not thread-safe: used by the
+    recording thread only.
+    """
+
+    def __init__(self):
+        self.trains = {}
+        # (ts, id, train key) of the indexed rows, oldest first
+        self.expiry = []
+        self.generation = None
+        self.limit_ts = None
+
+    def add(self, row):
+        """Index a recorded row, the first recorded of a train key is kept"""
+        key = get_train_key(row)
+        current = self.trains.get(key)
+        if current is not None and current['id'] != row['id']:
+            return
+        self.trains[key] = dict(row)
+        if current is None:
+            heapq.heappush(self.expiry, (row['ts'], row['id'], key))
+
+    def expire(self, limit_ts):
+        """Drop the rows older than `limit_ts`"""
+        while self.expiry and self.expiry[0][0] <= limit_ts:
+            _, row_id, key = heapq.heappop(self.expiry)
+            if self.trains.get(key, {}).get('id') == row_id:
+                del self.trains[key]
+        self.limit_ts = limit_ts
+
+    def load(self, db, limit_ts):
+        """(Re)load the whole window from the DB"""
+        self.trains, self.expiry = {}, []
+        self.generation = database.get_generation(db)
+        for row in db.query(queries.RECENT_WINDOW, limit_ts=limit_ts):
+            self.add(row)
+        self.limit_ts = limit_ts
+
+    def get(self, db, keys, limit_date):
+        """Recorded trains newer than `limit_date` for the given train keys,
+        by key, as `get_recent`
+        """
+        limit_ts = get_timestamp(limit_date)
+        generation = database.get_generation(db)
+        if self.generation is None or generation is None or limit_ts < self.limit_ts:
+            self.load(db, limit_ts)
+        else:
+            self.expire(limit_ts)
+            if generation != self.generation:
+                for row in db.query(
+                        queries.RECENT_CHANGES, rev=self.generation, limit_ts=limit_ts):
+                    self.add(row)
+                self.generation = generation
+        recent = {}
+        for key in keys:
+            row = self.trains.get(key)
+            if row is not None:
+                recent[key] = dict(row)
+        return recent
+
+    def update(self, rows, generation):
+        """Index the rows written by a transaction, at `generation`
+
+        The indexed generation only moves to the next one: if another writer
+        committed since the last `get`, its rows are caught up by the next.
+        """
+        for row in rows:
+            self.add(row)
+        if generation is not None and self.generation is not None and \
+                generation == self.generation + 1:
+            self.generation = generation
+
+
+def record_many(rows, db=None, now=None, index=None, notify=True):
+    """Record data rows (e.g. a whole API response) into DB and trigger
+    alerts if needed
+
+    Existing trains are looked up in a single query, rows are diffed in
+    memory and all inserts/updates are written in one transaction, along
+    w/ the resulting rollups deltas and queued notifications (see
+    `notifications.drain`). Written rows are stamped w/ the new write
+    generation as `rev`, for the change feed of `web.api_stream`. `now`
+    is the clock of the de-duplication (e.g. when replaying), recorded
+    trains are looked up in `index` if given (see `RecentIndex`). No
+    notification is queued w/o `notify`.
+    """
+    if db is None:
+        db = database.get()
+    with INGEST_SECONDS.time(stage='parse'):
+        rows = [normalize(data) for data in rows]
+    limit_date = get_limit_date(now)
+    # no duplicates
+    # date can change for same train, num supposed unique each day and route
+    with INGEST_SECONDS.time(stage='lookup'):
+        keys = {get_train_key(data) for data in rows}
+        if index is not None:
+            recent = index.get(db, keys, limit_date)
+        else:
+            recent = get_recent(db, keys, limit_date)
+
+    deltas = Counter()
+    train_deltas = Counter()
+    rev = None
+    results = Counter()
+    written = []
+    with INGEST_SECONDS.time(stage='write'), db as tx:
+        table = tx['results']
+        for data in rows:
+            key = get_train_key(data)
+            existing = recent.get(key)
+            changes, notif = compare(data, existing)
+            if (existing is None or changes is not None) and rev is None:
+                rev = database.bump_generation(tx)
+            if existing is None:
+                data['rev'] = rev
+                row_id = table.insert(data)
+                rollups.add(deltas, data, data['type'])
+                rollups.add_train(train_deltas, data)
+                # a train can show up twice in the same response
+                if data['ts'] > get_timestamp(limit_date):
+                    recent[key] = dict(data, id=row_id)
+                    written.append(recent[key])
+                results['inserted'] += 1
+            elif changes is not None:
+                changes['rev'] = rev
+                table.update(dict(changes, id=existing['id']), ['id'])
+                rollups.move(deltas, existing, existing['type'], changes['type'])
+                rollups.add_train(train_deltas, existing, -1)
+                existing.update(changes)
+                rollups.add_train(train_deltas, existing)
+                written.append(existing)
+                results['updated'] += 1
+            else:
+                results['unchanged'] += 1
+            if notify and notif is not None:
+                notifications.enqueue(tx, data, cancel=notif == NOTIF_UNSUPPR)
+        rollups.update(tx, deltas)
+        rollups.update_trains(tx, train_deltas)
+    if index is not None:
+        index.update(written, rev)
+    for result, count in results.items():
+        ROWS.inc(count, result=result)
+
+
+def record(data):
+    """Record a data row into DB and trigger alert if needed"""
+    record_many([data])
+
+
+def fetch(from_station, to_station):
+    """Request Transilien API
+
+    Rate limiting (429) and server errors are retried w/ exponential backoff.
+    Return the response, or None on failure.
+    """
     url = BASE_URL % (from_station, to_station)
-    req = requests.get(url, auth=(settings.TRANSILIEN_API_LOGIN, settings.TRANSILIEN_API_PWD))
-    if req.status_code == 200:
-        root = ET.fromstring(req.text.encode('utf-8'))
-        for train in root.iter('train'):
-            data = {
-                'from_gare': from_station,
-                'to_gare': to_station
-            }
-            for info in train:
-                data[info.tag] = info.text
-            record(data)
-    else:
-        click.secho('ERROR for %s to %s, status %s : %s' % (
-            from_station, to_station, req.status_code, req.text
-        ), err=True, bg='red')
+    with API_FETCH_SECONDS.time():
+        for attempt in range(settings.TRANSILIEN_API_RETRIES + 1):
+            limiter.acquire()
+            try:
+                req = session.get(
+                    url,
+                    auth=(settings.TRANSILIEN_API_LOGIN, settings.TRANSILIEN_API_PWD),
+                    timeout=TIMEOUT,
+                    stream=True
+                )
+            except requests.RequestException as exc:
+                req, error = None, exc
+                API_REQUESTS.inc(status='error')
+            else:
+                API_REQUESTS.inc(status=req.status_code)
+                if req.status_code == 200:
+                    return req
+                error = 'status %s : %s' % (req.status_code, req.text)
+                if req.status_code not in RETRY_STATUSES:
+                    break
+            if attempt < settings.TRANSILIEN_API_RETRIES:
+                time.sleep(get_backoff(attempt, req))
+
+    click.secho('ERROR for %s to %s, %s' % (
+        from_station, to_station, error
+    ), err=True, bg='red')
+    return None
+
+
+def get_backoff(attempt, req=None):
+    """Seconds to wait before retrying, honouring `Retry-After` if any, up
+    to the backoff of the last retry
+    """
+    retry_after = req.headers.get('Retry-After') if req is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(
+            int(retry_after), settings.TRANSILIEN_API_BACKOFF * 2 ** settings.TRANSILIEN_API_RETRIES
+        )
+    return settings.TRANSILIEN_API_BACKOFF * 2 ** attempt
+
+
+def parse(req, from_station, to_station):
+    """Parse an API response incrementally, yielding raw trains one at a time
+
+    The response is read by chunks, and captured if requested.
+    """
+    chunks = req.iter_content(chunk_size=CHUNK_SIZE)
+    if capture is not None:
+        chunks = capture.tee(chunks, from_station, to_station)
+    try:
+        for data in parse_chunks(chunks, from_station, to_station):
+            yield data
+    finally:
+        req.close()
+
+
+def parse_chunks(chunks, from_station, to_station):
+    """Parse the chunks of an XML response, yielding raw trains one at a time
+
+    Parsed elements are dropped as soon as their train has been yielded.
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if root is None:
+                root = elem
+            if event == 'end' and elem.tag == 'train':
+                data = {
+                    'from_gare': from_station,
+                    'to_gare': to_station
+                }
+                for info in elem:
+                    data[info.tag] = info.text
+                yield data
+                root.clear()
+    parser.close()
+
+
+def api_request(from_station, to_station):
+    """Request Transilien API and record the trains"""
+    with API_REQUEST_SECONDS.time():
+        req = fetch(from_station, to_station)
+        if req is not None:
+            record_many(parse(req, from_station, to_station))
+
+
+def poll(pairs, db=None, index=None):
+    """Check all the station pairs both ways, w/ parallel API requests
+
+    Responses are recorded from the calling thread, as they come, w/ the
+    recent trains `index` if any.
+    """
+    routes = []
+    for from_station, to_station in pairs:
+        for route in ((from_station, to_station), (to_station, from_station)):
+            if route not in routes:
+                routes.append(route)
+
+    with ThreadPoolExecutor(max_workers=settings.POLLER_WORKERS) as executor:
+        futures = {executor.submit(fetch, *route): route for route in routes}
+        for future in as_completed(futures):
+            req = future.result()
+            if req is not None:
+                record_many(parse(req, *futures[future]), db=db, index=index)
+
+
+def iter_capture(path):
+    """Responses of a capture file, see `Capture`"""
+    with open(path) as capture_file:
+        for line in capture_file:
+            if line.strip():
+                yield json.loads(line)
+
 
+def replay(responses, db=None, speed=None):
+    """Record captured responses, the clock set to their capture time
 
-@click.command()
+    `speed` accelerates the clock (e.g. 60 for a minute per second),
+    responses are recorded as fast as possible otherwise. No notification
+    is queued: the trains are long gone. Return the counts of responses
+    and trains.
+    """
+    first = start = None
+    count = trains = 0
+    index = RecentIndex()
+    for response in responses:
+        now = get_datetime_from_iso(response['time'])
+        if speed:
+            if first is None:
+                first, start = now, time.monotonic()
+            delay = (now - first).total_seconds() / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        rows = list(parse_chunks(
+            [base64.b64decode(response['body'])], response['from_station'],
+            response['to_station']
+        ))
+        record_many(rows, db=db, now=now, index=index, notify=False)
+        count += 1
+        trains += len(rows)
+    return count, trains
+
+
+def get_poll_interval(now):
+    """Seconds until the next poll according to `POLL_SCHEDULE`
+
+    Never sleep past the start of the next schedule slot, so that a
+    sparse overnight interval does not delay the morning peak.
+    """
+    schedule = sorted(settings.POLL_SCHEDULE)
+    interval = schedule[-1][1]
+    next_start = schedule[0][0] + 24
+    for start, slot_interval in schedule:
+        if start <= now.hour:
+            interval = slot_interval
+        elif start < next_start:
+            next_start = start
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    until_next_slot = (midnight + timedelta(hours=next_start) - now).total_seconds()
+    return min(interval, until_next_slot)
+
+
+def serve(pairs, stop, db=None):
+    """Poll the station pairs on schedule until `stop` is set
+
+    The DB and HTTP connections are kept open between polls, and the
+    trains of the de-duplication window are indexed in memory, loaded by
+    the first poll.
+    """
+    if db is None:
+        db = database.get()
+    index = RecentIndex()
+    while not stop.is_set():
+        try:
+            poll(pairs, db=db, index=index)
+        except Exception as exc: # pylint: disable=W0703
+            click.secho('ERROR while polling: %r' % exc, err=True, bg='red')
+            # reloaded by the next poll
+            index.generation = None
+        if metrics_path:
+            metrics.dump(metrics_path)
+        stop.wait(get_poll_interval(datetime.now()))
+
+
+def start_profile(path):
+    """Profile the calling thread, return the function stopping it
+
+    The stats are written to `path`, for pstats or snakeviz, and the top
+    calls by cumulative time are printed to stderr.
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+
+    def stop():
+        profile.disable()
+        profile.dump_stats(path)
+        stats = pstats.Stats(path, stream=click.get_text_stream('stderr'))
+        stats.sort_stats('cumulative').print_stats(20)
+
+    return stop
+
+
+@click.group(invoke_without_command=True)
 @click.option('--from-station', default=None, help='From station (override config)')
 @click.option('--to-station', default=None, help='To station (override config)')
-def run(from_station, to_station):
-    """CLI cmd"""
+@click.option('--capture', 'capture_path', default=None, type=click.Path(),
+              help='Append the API responses to a file, to replay them')
+@click.option('--metrics', 'dump_path', default=None, type=click.Path(),
+              help='Write the metrics to a file at exit (after each poll for the '
+              'daemon), - for stdout')
+@click.option('--profile', 'profile_path', default=None, type=click.Path(),
+              help='Profile the run, write the stats to a file and print the top calls')
+@click.pass_context
+def run(ctx, from_station, to_station, capture_path, dump_path, profile_path): # pylint: disable=R0913
+    """CLI cmd, checks the default route by default"""
+    global capture, metrics_path # pylint: disable=W0603
+    if capture_path:
+        capture = Capture(capture_path)
+    if dump_path:
+        metrics_path = dump_path
+        ctx.call_on_close(lambda: metrics.dump(dump_path))
+    if profile_path:
+        ctx.call_on_close(start_profile(profile_path))
+    # replay records to a scratch database only
+    if ctx.invoked_subcommand != 'replay':
+        schema.migrate(database.get())
+    if ctx.invoked_subcommand is not None:
+        return
+    route = routes.get_route()
     if not from_station:
-        from_station = settings.FROM_STATION_CODE
+        from_station = route.from_station
     if not to_station:
-        to_station = settings.TO_STATION_CODE
+        to_station = route.to_station
 
     api_request(from_station, to_station)
     api_request(to_station, from_station)
+    notifications.drain(database.get())
+
+
+@run.command('poll')
+def poll_command():
+    """Check all the monitored routes, in parallel"""
+    poll(routes.get_pairs())
+    notifications.drain(database.get())
+
+
+@run.command('replay')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--speed', default=0., help='Clock acceleration, e.g. 60 for a minute per '
+              'second (default: as fast as possible)')
+@click.option('--database', 'uri', required=True,
+              help='Scratch database to record to, not DATABASE_URI')
+def replay_command(path, speed, uri):
+    """Record the responses of a capture file, to measure ingestion"""
+    if database.is_same(uri, settings.DATABASE_URI):
+        raise click.UsageError('replay into a scratch database, not DATABASE_URI')
+    db = database.connect(uri)
+    schema.migrate(db)
+    start = time.perf_counter()
+    count, trains = replay(iter_capture(path), db=db, speed=speed)
+    elapsed = time.perf_counter() - start
+    click.echo('%s responses, %s trains in %.2fs: %.0f trains/s' % (
+        count, trains, elapsed, trains / elapsed if elapsed else 0
+    ))
+
+
+@run.command()
+def daemon():
+    """Keep polling the monitored routes, until SIGTERM"""
+    stop = threading.Event()
+
+    def shutdown(signum, frame): # pylint: disable=W0613
+        click.echo('Received signal %s, shutting down' % signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    # notifications are sent from their own thread, polling never waits on them
+    dispatcher = threading.Thread(
+        target=notifications.serve, args=(stop, database.get()), name='notifications'
+    )
+    dispatcher.start()
+    serve(routes.get_pairs(), stop)
+    dispatcher.join()
 
 
 if __name__ == "__main__":
@@ -1,15 +1,28 @@
 import Vue from 'vue'
 
 export default {
-  query (since) {
+  // w/ the `rev` of a previous query, only the trains changed since
+  query (since, rev) {
     let url = process.env.API_ENDPOINT
-    if (since) url += '?since=' + since
+    if (rev !== undefined) url += '?after_rev=' + rev
+    else if (since) url += '?since=' + since
     return Vue.http.get(url).then(res => {
       return res.body
     }).catch(err => {
       console.error('Error fetching trains:', err)
     })
   },
+  // push updates through Server-Sent Events, after the `rev` of a query
+  // the browser reconnects by itself, w/ the id of the last event received
+  stream (rev, callback) {
+    let url = process.env.API_ENDPOINT + '/stream'
+    if (rev !== undefined) url += '?last_event_id=' + rev
+    const source = new EventSource(url)
+    source.addEventListener('results', event => {
+      callback(JSON.parse(event.data))
+    })
+    return source
+  },
   queryAggregate (frequency, since) {
     let url = process.env.API_ENDPOINT + '/aggregate/' + frequency
     if (since) url += '?since=' + since
@@ -14,7 +14,8 @@ export default new Vuex.Store({
       retour: []
     },
     lastHistoryDate: undefined,
-    lastUpdated: undefined
+    lastUpdated: undefined,
+    rev: undefined
   },
   mutations: {
     add (state, trains) {
@@ -31,6 +32,7 @@ export default new Vuex.Store({
         state.trains.retour = [...state.trains.retour]
       }
       state.infos = trains.infos
+      if (trains.rev !== undefined) state.rev = trains.rev
     },
     recordLastUpdated (state) {
       state.lastUpdated = Date.now() / 1000 | 0
@@ -38,7 +40,13 @@ export default new Vuex.Store({
   },
   actions: {
     fetch (context) {
-      return TrainsService.query(context.state.lastUpdated).then((trains) => {
+      return TrainsService.query(context.state.lastUpdated, context.state.rev).then((trains) => {
+        context.commit('add', trains)
+        context.commit('recordLastUpdated')
+      })
+    },
+    subscribe (context) {
+      return TrainsService.stream(context.state.rev, (trains) => {
         context.commit('add', trains)
         context.commit('recordLastUpdated')
       })
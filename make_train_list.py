@@ -1,68 +1,89 @@
 """Generate a list of trains and export to JSON"""
 
 import json
+from collections import Counter
 
 import click
 
 import database
-import settings
+import queries
+import routes
 
 
-def get_nominal_hour(train_num):
-    """Get the nominal hour for a train num (most frequent)"""
-    res = database.get().query("""
-        SELECT count(*) as count, substr(date, 12, 5) as hour
-        FROM results WHERE num = '%s'
-        GROUP BY hour ORDER BY count DESC LIMIT 1;
-    """ % train_num)
-    return next(res).hour
+WEEK = (1, 2, 3, 4, 5)
+WEEKEND = (6, 7)
 
 
-@click.command()
-def make_train_list():
-    """Compute a distinct train list for a typical day"""
-    res_db = database.get()
-    table = res_db['results']
-
-    def get_count_days(weekdays_list, num):
-        """Return the count of this trains on given weekdays"""
-        res = res_db.query("SELECT count(*) as count from results \
-            where num = '%s' and weekday in (%s)" % (
-                num,
-                ','.join([str(w) for w in weekdays_list])
-            ))
-        return next(res).count
-
-    trains = {}
+def get_nominal_hour(hours):
+    """Get the nominal hour from a `Counter` of hours (most frequent, earliest first)"""
+    return max(sorted(hours.items()), key=lambda item: item[1])[0]
+
+
+def get_trains(res_db):
+    """Compute a distinct train list for a typical day
+
+    Two grouped queries over `results` instead of a handful of queries per
+    train: counts by train, hour and weekday, then the first NORMAL
+    occurrence of each train, for its direction.
+    """
+    if 'results' not in res_db:
+        return []
+    return build_trains(
+        res_db.query(queries.TRAIN_COUNTS), res_db.query(queries.TRAIN_DIRECTIONS)
+    )
+
+
+def build_trains(counts, directions):
+    """Build the train list from grouped rows
+
+    `counts` are `num, hour, weekday, count` rows and `directions` the
+    `num, from_gare, to_gare` of the first NORMAL occurrence of each train,
+    by num. Trains are listed w/ their route, if monitored, and the label
+    of their destination as direction.
+    """
+    stats = {}
+    for res in counts:
+        train = stats.setdefault(res['num'], {
+            'hours': Counter(),
+            'count': 0,
+            'count_weekend': 0,
+            'count_week': 0,
+        })
+        train['hours'][res['hour']] += res['count']
+        train['count'] += res['count']
+        if res['weekday'] in WEEKEND:
+            train['count_weekend'] += res['count']
+        elif res['weekday'] in WEEK:
+            train['count_week'] += res['count']
+
     # use NORMAL to get the nominal hour
-    for train in table.find(type='NORMAL'):
-        existing = trains.get(train.num)
-        if not existing:
-            trains[train.num] = {
-                'hour': get_nominal_hour(train.num),
-                'count': len(list(table.find(num=train.num))),
-                'direction': 'poissy' if train.to_gare == str(settings.FROM_STATION_CODE) \
-                    else 'paris',
-                'count_weekend': get_count_days([6, 7], train.num),
-                'count_week': get_count_days([1, 2, 3, 4, 5], train.num),
-            }
-
-    # restructure as list
-    # in Python3, spread or something would be great :-(
-    trains_list = [
-        {
-            'num': k,
-            'hour': v['hour'],
-            'direction': v['direction'],
-            'count': v['count'],
-            'count_weekend': v['count_weekend'],
-            'count_week': v['count_week'],
-        } for k, v in trains.items()
-    ]
+    trains = []
+    for train in directions:
+        train_stats = stats[train['num']]
+        route = routes.find(train['from_gare'], train['to_gare'])
+        trains.append({
+            'num': train['num'],
+            'hour': get_nominal_hour(train_stats['hours']),
+            'route': route and route.name,
+            'direction': routes.get_label(train['to_gare']),
+            'count': train_stats['count'],
+            'count_weekend': train_stats['count_weekend'],
+            'count_week': train_stats['count_week'],
+        })
+    return trains
 
+
+def write(trains_list):
+    """Write the train list to trains.json"""
     with open('trains.json', 'w') as jsonfile:
         jsonfile.write(json.dumps(trains_list, indent=2))
 
 
+@click.command()
+def make_train_list():
+    """Compute a distinct train list for a typical day"""
+    write(get_trains(database.get(read_only=True)))
+
+
 if __name__ == '__main__':
     make_train_list()
@@ -0,0 +1,162 @@
+"""In-process metrics, rendered in the Prometheus text format
+
+Counters and histograms are registered by the modules they instrument and
+are cheap enough to stay always on. The web interface serves them on
+/metrics, `flag.py --metrics` dumps those of a run.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# seconds
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+
+def format_labels(names, values, extra=()):
+    """Prometheus label set, e.g. `{route="/api",status="200"}`"""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    ) for name, value in pairs)
+
+
+class Metric(object):
+    """Base of the metrics: a value per label values, registered at creation"""
+
+    kind = None
+    # of the metric family name, e.g. the `_total` of the counters
+    suffix = ''
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def get_key(self, labels):
+        """Label values of the keyword `labels`, in order"""
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get_samples(self):
+        """`(suffix, labels, value)` samples of the metric"""
+        raise NotImplementedError
+
+    def render(self):
+        """Text exposition of the metric"""
+        family = self.name + self.suffix
+        lines = [
+            '# HELP %s %s' % (family, self.description),
+            '# TYPE %s %s' % (family, self.kind),
+        ]
+        for suffix, labels, value in self.get_samples():
+            lines.append('%s%s%s %s' % (family, suffix, labels, value))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonic count, e.g. of requests"""
+
+    kind = 'counter'
+    suffix = '_total'
+
+    def inc(self, amount=1, **labels):
+        """Increment the count of the `labels`"""
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Set the count of the `labels`, for counts kept elsewhere"""
+        with self.lock:
+            self.values[self.get_key(labels)] = value
+
+    def get(self, **labels):
+        """Current count of the `labels`"""
+        with self.lock:
+            return self.values.get(self.get_key(labels), 0)
+
+    def get_samples(self):
+        with self.lock:
+            return [
+                ('', format_labels(self.labelnames, key), value)
+                for key, value in sorted(self.values.items())
+            ]
+
+
+class Histogram(Metric):
+    """Distribution of durations (seconds), in cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Record a value for the `labels`"""
+        key = self.get_key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_count(self, **labels):
+        """Count of the values recorded for the `labels`"""
+        with self.lock:
+            counts, _ = self.values.get(self.get_key(labels), ([0], 0))
+            return sum(counts)
+
+    def get_samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    samples.append((
+                        '_bucket', format_labels(self.labelnames, key, [('le', bound)]),
+                        cumulative
+                    ))
+                samples.append(('_sum', format_labels(self.labelnames, key), total))
+                samples.append(('_count', format_labels(self.labelnames, key), cumulative))
+        return samples
+
+
+def render():
+    """Text exposition of all the registered metrics"""
+    return ''.join(metric.render() + '\n' for metric in REGISTRY)
+
+
+def dump(path):
+    """Write the metrics to a file, e.g. for the node exporter, '-' for stdout"""
+    if path == '-':
+        print(render(), end='')
+        return
+    # atomic, for the collectors reading the file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as metrics_file:
+        metrics_file.write(render())
+    os.replace(tmp, path)
@@ -1,43 +1,93 @@
-"""Notifications module"""
+"""Notifications module
 
+Notifications are queued in the `outbox` table by `enqueue`, in the same
+transaction as the results, and sent later by `drain`: recording never
+waits on the network, pending notifications of a channel are coalesced in
+a single digest message and failed sends are retried.
+"""
+
+import json
+from datetime import datetime
+from functools import lru_cache
+
+import click
 from pushbullet import Pushbullet
 from mailthon import postman, email
 
-import settings
+import metrics
+import queries
+from config import settings
+from routes import get_label
 
 
-def translate_station(code):
-    """Translate station name from code"""
-    if code == settings.FROM_STATION_CODE:
-        return settings.FROM_STATION_LABEL
-    elif code == settings.TO_STATION_CODE:
-        return settings.TO_STATION_LABEL
-    else:
-        raise Exception('Unknown station code %s' % code)
+PAYLOAD_KEYS = ('date', 'num', 'from_gare', 'to_gare')
+
+SENT = metrics.Counter(
+    'transilien_notifications', 'Notifications, by channel and outcome', ['channel', 'result']
+)
+SEND_SECONDS = metrics.Histogram(
+    'transilien_notification_send_seconds', 'Duration of the sends, by channel', ['channel']
+)
+
+
+def describe(data, cancel=False):
+    """One line description of a notification"""
+    return u'Le train de %s (%s - %s) a été %s.' % (
+        data['date'],
+        get_label(data['from_gare']),
+        get_label(data['to_gare']),
+        u'supprimé' if not cancel else u'remis en service'
+    )
+
+
+def get_channels():
+    """Enabled notification channels"""
+    channels = []
+    if settings.MAIL_ENABLED:
+        channels.append('mail')
+    if settings.PUSHBULLET_ENABLED:
+        channels.append('push')
+    return channels
+
+
+def enqueue(db, data, cancel=False):
+    """Queue the notifications of a train, one per enabled channel"""
+    payload = json.dumps({key: data[key] for key in PAYLOAD_KEYS})
+    created = datetime.now().isoformat(' ')
+    for channel in get_channels():
+        db['outbox'].insert({
+            'created': created,
+            'channel': channel,
+            'cancel': cancel,
+            'payload': payload,
+            'attempts': 0,
+            'sent': None,
+            'error': None,
+        })
 
 
 def send(data, cancel=False):
-    """Send notifications"""
+    """Send notifications right away, w/o the outbox"""
 
     if settings.MAIL_ENABLED:
-        send_mail(data, cancel=cancel)
+        with SEND_SECONDS.time(channel='mail'):
+            send_mail([(data, cancel)])
 
     if settings.PUSHBULLET_ENABLED:
-        send_push(data, cancel=cancel)
+        with SEND_SECONDS.time(channel='push'):
+            send_push([(data, cancel)])
 
 
-def send_mail(data, cancel=False):
-    """Send an email"""
-    body = "Le train de %s (%s - %s) a été %s." % (
-        data['date'],
-        translate_station(data['from_gare']),
-        translate_station(data['to_gare']),
-        u'supprimé' if not cancel else u'remis en service'
-    )
+def send_mail(notifs):
+    """Send an email, a digest for several `(data, cancel)` notifications"""
+    if len(notifs) == 1:
+        subject = '%sSuppression Transilien' % (u'[ANNULATION] ' if notifs[0][1] else '')
+    else:
+        subject = 'Suppressions Transilien (%s trains)' % len(notifs)
 
     the_email = email(
-        subject='%sSuppression Transilien' % (u'[ANNULATION] ' if cancel else ''),
-        content=body,
+        subject=subject,
+        content='<br>\n'.join(describe(data, cancel) for data, cancel in notifs),
         sender=settings.MAIL_DEFAULT_SENDER,
         receivers=settings.MAIL_RECIPIENTS
     )
@@ -47,21 +97,70 @@ def send_mail(data, cancel=False):
         smtp.send(the_email)
 
 
-def send_push(data, cancel=False):
-    """Send a message through Pushbullet"""
-    title = u'%s%s %s > %s' % (
-        u'[ANNULATION] ' if cancel else '',
-        data['date'],
-        translate_station(data['from_gare']),
-        translate_station(data['to_gare'])
-    )
-    body = u'Le train de %s (%s - %s) a été %s.' % (
-        data['date'],
-        translate_station(data['from_gare']),
-        translate_station(data['to_gare']),
-        u'supprimé' if not cancel else u'remis en service'
-    )
+@lru_cache(maxsize=1)
+def get_pushbullet_channel():
+    """Pushbullet channel, looked up once per process"""
+    pushb = Pushbullet(settings.PUSHBULLET_API_KEY)
+    return pushb.get_channel(settings.PUSHBULLET_CHANNEL)
+
+
+def send_push(notifs):
+    """Send a message through Pushbullet, a digest for several notifications"""
+    if len(notifs) == 1:
+        data, cancel = notifs[0]
+        title = u'%s%s %s > %s' % (
+            u'[ANNULATION] ' if cancel else '',
+            data['date'],
+            get_label(data['from_gare']),
+            get_label(data['to_gare'])
+        )
+    else:
+        title = u'Suppressions Transilien (%s trains)' % len(notifs)
+    body = u'\n'.join(describe(data, cancel) for data, cancel in notifs)
     if not settings.TESTING:
-        pushb = Pushbullet(settings.PUSHBULLET_API_KEY)
-        channel = pushb.get_channel(settings.PUSHBULLET_CHANNEL)
-        channel.push_note(title, body)
+        get_pushbullet_channel().push_note(title, body)
+
+
+def drain(db):
+    """Send the pending notifications of the outbox, one message per channel
+
+    Failed sends are retried on the next drain, up to
+    NOTIFICATIONS_MAX_ATTEMPTS attempts. Return the count of sent rows.
+    """
+    if 'outbox' not in db:
+        return 0
+    pending = list(db.query(
+        queries.OUTBOX_PENDING, max_attempts=settings.NOTIFICATIONS_MAX_ATTEMPTS
+    ))
+    senders = {'mail': send_mail, 'push': send_push}
+    sent = 0
+    for channel, sender in senders.items():
+        items = [row for row in pending if row['channel'] == channel]
+        if not items:
+            continue
+        ids = [row['id'] for row in items]
+        try:
+            with SEND_SECONDS.time(channel=channel):
+                sender([(json.loads(row['payload']), bool(row['cancel'])) for row in items])
+        except Exception as exc: # pylint: disable=W0703
+            click.secho('ERROR while sending %s notifications: %r' % (channel, exc),
+                        err=True, bg='red')
+            db.query(queries.OUTBOX_FAILED, ids=ids, error=repr(exc))
+            SENT.inc(len(ids), channel=channel, result='failed')
+        else:
+            db.query(queries.OUTBOX_SENT, ids=ids, sent=datetime.now().isoformat(' '))
+            sent += len(ids)
+            SENT.inc(len(ids), channel=channel, result='sent')
+    return sent
+
+
+def serve(stop, db):
+    """Drain the outbox every NOTIFICATIONS_INTERVAL seconds until `stop` is set"""
+    while True:
+        try:
+            drain(db)
+        except Exception as exc: # pylint: disable=W0703
+            click.secho('ERROR while draining notifications: %r' % exc, err=True, bg='red')
+        if stop.is_set():
+            return
+        stop.wait(settings.NOTIFICATIONS_INTERVAL)
@@ -0,0 +1,290 @@
+"""Named SQL statements, parameterized and compiled once
+
+Values are always passed as bind parameters so that SQLAlchemy's compiled
+cache and SQLite's statement cache can reuse the statements.
+"""
+
+from sqlalchemy import bindparam, text
+
+
+# SQL bucket of a result for each aggregate frequency
+FREQUENCIES = {
+    'hour': 'substr(date, 0, 15)',
+    'day': 'substr(date, 0, 11)',
+    'month': 'substr(date, 0, 8)',
+    'year': 'substr(date, 0, 5)',
+    'hour_overall': 'substr(date, 12, 2)',
+    'weekday': 'weekday',
+}
+
+# SQL key of the route of a result, either way, as routes.get_key: the
+# expression of the route indexes
+ROUTE = """(CASE WHEN from_gare < to_gare THEN from_gare || '-' || to_gare
+    ELSE to_gare || '-' || from_gare END)"""
+
+# SQL bucket of a result for each per train dimension: weekday, departure
+# hour and delay in minutes (capped, see rollups.DELAY_MAX)
+TRAIN_DIMENSIONS = {
+    'weekday': 'CAST(weekday AS TEXT)',
+    'hour': 'substr(date, 12, 2)',
+    'delay': 'CAST(MIN(COALESCE(delay, 0) / 60, 120) AS TEXT)',
+}
+
+
+# flag.py
+
+RECENT_TRAINS = text("""
+    SELECT * FROM results
+    WHERE ts > :limit_ts AND num IN :nums
+    ORDER BY id;
+""").bindparams(bindparam('nums', expanding=True))
+
+RECENT_WINDOW = text("""
+    SELECT * FROM results
+    WHERE ts > :limit_ts
+    ORDER BY id;
+""")
+
+# written since a write generation
+RECENT_CHANGES = text("""
+    SELECT * FROM results
+    WHERE rev > :rev AND ts > :limit_ts
+    ORDER BY id;
+""")
+
+
+# web.py
+
+API_TRAINS = text("""
+    SELECT * FROM results
+    WHERE %(route)s = :route AND ts > :since
+    ORDER BY ts DESC;
+""" % {'route': ROUTE})
+
+API_STREAM = text("""
+    SELECT * FROM results
+    WHERE %(route)s = :route AND ts > :since
+    ORDER BY ts DESC, id DESC
+    LIMIT :limit;
+""" % {'route': ROUTE})
+
+# keyset pagination, after the row of id `cursor`
+API_STREAM_AFTER = text("""
+    SELECT * FROM results
+    WHERE %(route)s = :route AND ts > :since
+    AND (ts < :cursor_ts OR (ts = :cursor_ts AND id < :cursor))
+    ORDER BY ts DESC, id DESC
+    LIMIT :limit;
+""" % {'route': ROUTE})
+
+CURSOR_TS = text("SELECT ts FROM results WHERE id = :cursor;")
+
+# rows written by the generations in (rev, until]
+API_CHANGES = text("""
+    SELECT * FROM results
+    WHERE rev > :rev AND rev <= :until AND %(route)s = :route
+    ORDER BY rev, id;
+""" % {'route': ROUTE})
+
+
+# database.py
+
+GET_GENERATION = text("SELECT value FROM meta WHERE key = 'generation';")
+
+BUMP_GENERATION = text("UPDATE meta SET value = value + 1 WHERE key = 'generation';")
+
+GET_META = text("SELECT value FROM meta WHERE key = :key;")
+
+SET_META = text("""
+    INSERT INTO meta (key, value) VALUES (:key, :value)
+    ON CONFLICT (key) DO UPDATE SET value = excluded.value;
+""")
+
+
+# notifications.py
+
+OUTBOX_PENDING = text("""
+    SELECT * FROM outbox
+    WHERE sent IS NULL AND attempts < :max_attempts
+    ORDER BY id;
+""")
+
+OUTBOX_SENT = text("""
+    UPDATE outbox SET sent = :sent, attempts = attempts + 1, error = NULL
+    WHERE id IN :ids;
+""").bindparams(bindparam('ids', expanding=True))
+
+OUTBOX_FAILED = text("""
+    UPDATE outbox SET attempts = attempts + 1, error = :error
+    WHERE id IN :ids;
+""").bindparams(bindparam('ids', expanding=True))
+
+
+# rollups.py
+
+# rollups of all the routes have an empty `route`
+ROLLUPS_UPSERT = text("""
+    INSERT INTO rollups (route, frequency, bucket, type, count)
+    VALUES (:route, :frequency, :bucket, :type, :count)
+    ON CONFLICT (route, frequency, bucket, type) DO UPDATE SET count = count + excluded.count;
+""")
+
+ROLLUPS_DELETE = text("DELETE FROM rollups;")
+
+ROLLUPS_REBUILD = {
+    frequency: text("""
+        INSERT INTO rollups (route, frequency, bucket, type, count)
+        SELECT '', :frequency, CAST(%(group_by)s AS TEXT), type, COUNT(*)
+        FROM results
+        GROUP BY %(group_by)s, type;
+    """ % {'group_by': group_by})
+    for frequency, group_by in FREQUENCIES.items()
+}
+
+ROLLUPS_REBUILD_ROUTES = {
+    frequency: text("""
+        INSERT INTO rollups (route, frequency, bucket, type, count)
+        SELECT %(route)s, :frequency, CAST(%(group_by)s AS TEXT), type, COUNT(*)
+        FROM results
+        GROUP BY %(route)s, %(group_by)s, type;
+    """ % {'group_by': group_by, 'route': ROUTE})
+    for frequency, group_by in FREQUENCIES.items()
+}
+
+ROLLUPS = text("""
+    SELECT bucket as date, type, count
+    FROM rollups
+    WHERE route = :route AND frequency = :frequency AND count > 0
+    ORDER BY bucket, type;
+""")
+
+ROLLUPS_AFTER = text("""
+    SELECT bucket as date, type, count
+    FROM rollups
+    WHERE route = :route AND frequency = :frequency AND count > 0 AND bucket > :bucket
+    ORDER BY bucket, type;
+""")
+
+AGGREGATE_SINCE = {
+    frequency: text("""
+        SELECT
+        %(group_by)s as date, type, COUNT(*) as count
+        FROM results
+        WHERE date > :since
+        GROUP BY %(group_by)s, type;
+    """ % {'group_by': group_by})
+    for frequency, group_by in FREQUENCIES.items()
+}
+
+AGGREGATE_BETWEEN = {
+    frequency: text("""
+        SELECT
+        %(group_by)s as date, type, COUNT(*) as count
+        FROM results
+        WHERE date > :since AND date < :until
+        GROUP BY %(group_by)s, type;
+    """ % {'group_by': group_by})
+    for frequency, group_by in FREQUENCIES.items()
+}
+
+ROUTE_AGGREGATE_SINCE = {
+    frequency: text("""
+        SELECT
+        %(group_by)s as date, type, COUNT(*) as count
+        FROM results
+        WHERE %(route)s = :route AND date > :since
+        GROUP BY %(group_by)s, type;
+    """ % {'group_by': group_by, 'route': ROUTE})
+    for frequency, group_by in FREQUENCIES.items()
+}
+
+ROUTE_AGGREGATE_BETWEEN = {
+    frequency: text("""
+        SELECT
+        %(group_by)s as date, type, COUNT(*) as count
+        FROM results
+        WHERE %(route)s = :route AND date > :since AND date < :until
+        GROUP BY %(group_by)s, type;
+    """ % {'group_by': group_by, 'route': ROUTE})
+    for frequency, group_by in FREQUENCIES.items()
+}
+
+# counts by route, bucket and type, of the archives
+ROUTE_AGGREGATE = {
+    frequency: text("""
+        SELECT
+        %(route)s AS route, %(group_by)s as date, type, COUNT(*) as count
+        FROM results
+        GROUP BY %(route)s, %(group_by)s, type;
+    """ % {'group_by': group_by, 'route': ROUTE})
+    for frequency, group_by in FREQUENCIES.items()
+}
+
+TRAIN_ROLLUPS_UPSERT = text("""
+    INSERT INTO train_rollups (num, dimension, bucket, type, count)
+    VALUES (:num, :dimension, :bucket, :type, :count)
+    ON CONFLICT (num, dimension, bucket, type) DO UPDATE SET count = count + excluded.count;
+""")
+
+TRAIN_ROLLUPS_DELETE = text("DELETE FROM train_rollups;")
+
+TRAIN_ROLLUPS_REBUILD = {
+    dimension: text("""
+        INSERT INTO train_rollups (num, dimension, bucket, type, count)
+        SELECT num, :dimension, %(group_by)s, type, COUNT(*)
+        FROM results
+        GROUP BY num, %(group_by)s, type;
+    """ % {'group_by': group_by})
+    for dimension, group_by in TRAIN_DIMENSIONS.items()
+}
+
+TRAIN_ROLLUPS = text("""
+    SELECT num, dimension, bucket, type, count
+    FROM train_rollups
+    WHERE num = :num AND count > 0;
+""")
+
+# totals and delays of every train, w/o the other breakdowns
+TRAIN_ROLLUPS_SUMMARY = text("""
+    SELECT num, dimension, bucket, type, count
+    FROM train_rollups
+    WHERE dimension IN ('weekday', 'delay') AND count > 0
+    ORDER BY num;
+""")
+
+# per train counts by dimension, of the archives
+TRAIN_AGGREGATE = {
+    dimension: text("""
+        SELECT num, %(group_by)s AS bucket, type, COUNT(*) AS count
+        FROM results
+        GROUP BY num, %(group_by)s, type;
+    """ % {'group_by': group_by})
+    for dimension, group_by in TRAIN_DIMENSIONS.items()
+}
+
+
+# archive.py
+
+ARCHIVE_MONTHS = text("""
+    SELECT DISTINCT substr(date, 0, 8) AS month FROM results
+    WHERE date < :before
+    ORDER BY month;
+""")
+
+ARCHIVE_DELETE = text("DELETE FROM results WHERE date >= :since AND date < :until;")
+
+
+# make_train_list.py
+
+TRAIN_COUNTS = text("""
+    SELECT num, substr(date, 12, 5) as hour, weekday, count(*) as count
+    FROM results GROUP BY num, hour, weekday;
+""")
+
+TRAIN_DIRECTIONS = text("""
+    SELECT results.num, results.from_gare, results.to_gare FROM results
+    JOIN (
+        SELECT min(id) as id FROM results WHERE type = 'NORMAL' GROUP BY num
+    ) AS first ON results.id = first.id
+    ORDER BY results.num;
+""")
@@ -0,0 +1,269 @@
+"""Materialized aggregates of `results`, by frequency and type
+
+Aggregates are rolled up for all the routes (w/ an empty route key) and
+for each route (see routes.get_key). Per train rollups count the results
+of each train by weekday, departure hour and delay (a histogram by
+minute), for the train statistics.
+"""
+
+from collections import Counter
+
+import click
+
+import archive
+import database
+import queries
+from queries import FREQUENCIES, TRAIN_DIMENSIONS
+from routes import get_key
+
+
+# delays from this many minutes on share the last bucket of the histogram
+DELAY_MAX = 120
+
+PERCENTILES = (50, 90, 99)
+
+# frequencies whose buckets are prefixes of the ISO date, i.e. ordered in time
+PREFIXES = {
+    'hour': 14,
+    'day': 10,
+    'month': 7,
+    'year': 4,
+}
+
+
+def get_buckets(date, weekday):
+    """Buckets of an ISO date for each frequency, as computed by SQL"""
+    buckets = {frequency: date[:length] for frequency, length in PREFIXES.items()}
+    buckets['hour_overall'] = date[11:13]
+    buckets['weekday'] = str(weekday)
+    return buckets
+
+
+def add(deltas, row, train_type, count=1):
+    """Add a row of a given type to a `Counter` of deltas, for all the
+    routes and its own
+    """
+    route = get_key(row['from_gare'], row['to_gare'])
+    for frequency, bucket in get_buckets(row['date'], row['weekday']).items():
+        deltas[('', frequency, bucket, train_type)] += count
+        deltas[(route, frequency, bucket, train_type)] += count
+
+
+def move(deltas, row, old_type, new_type):
+    """Record the change of type of a row in a `Counter` of deltas"""
+    if old_type != new_type:
+        add(deltas, row, old_type, -1)
+        add(deltas, row, new_type)
+
+
+def update(db, deltas):
+    """Apply a `Counter` of deltas to the rollups"""
+    params = [
+        {'route': route, 'frequency': frequency, 'bucket': bucket, 'type': train_type,
+         'count': count}
+        for (route, frequency, bucket, train_type), count in deltas.items() if count
+    ]
+    if params:
+        db.executable.execute(queries.ROLLUPS_UPSERT, params)
+
+
+def get_train_buckets(row):
+    """Per train buckets of a row for each dimension, as computed by SQL"""
+    return {
+        'weekday': str(row['weekday']),
+        'hour': row['date'][11:13],
+        'delay': str(min((row.get('delay') or 0) // 60, DELAY_MAX)),
+    }
+
+
+def add_train(deltas, row, count=1):
+    """Add a row, w/ its type and delay, to a `Counter` of per train deltas"""
+    for dimension, bucket in get_train_buckets(row).items():
+        deltas[(str(row['num']), dimension, bucket, row['type'])] += count
+
+
+def update_trains(db, deltas):
+    """Apply a `Counter` of deltas to the per train rollups"""
+    params = [
+        {'num': num, 'dimension': dimension, 'bucket': bucket, 'type': train_type,
+         'count': count}
+        for (num, dimension, bucket, train_type), count in deltas.items() if count
+    ]
+    if params:
+        db.executable.execute(queries.TRAIN_ROLLUPS_UPSERT, params)
+
+
+def invalidate(db):
+    """Bump the write generation, if any, so that the cached responses of
+    the rollups are dropped
+    """
+    if 'meta' in db:
+        database.bump_generation(db)
+
+
+def rebuild(db):
+    """Recompute all the rollups from `results`"""
+    invalidate(db)
+    db.query(queries.ROLLUPS_DELETE)
+    for frequency in FREQUENCIES:
+        db.query(queries.ROLLUPS_REBUILD[frequency], frequency=frequency)
+        db.query(queries.ROLLUPS_REBUILD_ROUTES[frequency], frequency=frequency)
+
+
+def rebuild_trains(db):
+    """Recompute all the per train rollups from `results`"""
+    invalidate(db)
+    db.query(queries.TRAIN_ROLLUPS_DELETE)
+    for dimension in TRAIN_DIMENSIONS:
+        db.query(queries.TRAIN_ROLLUPS_REBUILD[dimension], dimension=dimension)
+
+
+def rebuild_archives(db):
+    """Add the results of the archives to the rollups, after a rebuild"""
+    deltas = Counter()
+    for frequency in FREQUENCIES:
+        for row in archive.query(queries.ROUTE_AGGREGATE[frequency]):
+            for route in ('', row['route']):
+                deltas[(route, frequency, str(row['date']), row['type'])] += row['count']
+    update(db, deltas)
+    train_deltas = Counter()
+    for dimension in TRAIN_DIMENSIONS:
+        for row in archive.query(queries.TRAIN_AGGREGATE[dimension]):
+            train_deltas[(row['num'], dimension, row['bucket'], row['type'])] += row['count']
+    update_trains(db, train_deltas)
+
+
+def merge(rows):
+    """Sum aggregate rows of the same bucket and type"""
+    counts = Counter()
+    for row in rows:
+        counts[(row['date'], row['type'])] += row['count']
+    return [
+        {'date': date, 'type': train_type, 'count': count}
+        for (date, train_type), count in sorted(counts.items())
+    ]
+
+
+def convert(rows, frequency):
+    """Format aggregate rows as returned by the API"""
+    return [{
+        'date': int(r['date']) if frequency == 'weekday' else r['date'],
+        'type': r['type'],
+        'count': r['count'],
+    } for r in rows]
+
+
+def query(db, frequency, since=None, route=''):
+    """Aggregate results by type on given frequency, newer than `since`, of
+    a route key (see routes.get_key) or all the routes
+
+    Whole buckets are read from the rollups. Only the part of the bucket of
+    `since` which is newer than `since` is computed from `results`, unless
+    the buckets are not ordered in time (hour_overall, weekday). The
+    archives are included when `since` is older than their horizon.
+    """
+    if not since:
+        return convert(db.query(queries.ROLLUPS, frequency=frequency, route=route), frequency)
+    horizon = archive.get_horizon(db)
+    archived = horizon is not None and since < horizon
+    params = {'since': since}
+    if route:
+        params['route'] = route
+    if frequency not in PREFIXES:
+        statements = queries.ROUTE_AGGREGATE_SINCE if route else queries.AGGREGATE_SINCE
+    else:
+        bucket = since[:PREFIXES[frequency]]
+        # every date of the bucket starts w/ its key
+        statements = queries.ROUTE_AGGREGATE_BETWEEN if route else queries.AGGREGATE_BETWEEN
+        params['until'] = bucket + '~'
+    statement = statements[frequency]
+
+    rows = list(db.query(statement, **params))
+    if archived:
+        rows = merge(rows + archive.query(statement, since[:7], **params))
+    if frequency in PREFIXES:
+        rows += db.query(
+            queries.ROLLUPS_AFTER, frequency=frequency, bucket=bucket, route=route
+        )
+    return convert(rows, frequency)
+
+
+def get_percentiles(histogram):
+    """PERCENTILES of a `{minutes: count}` delay histogram, to the minute"""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    percentiles = {}
+    minutes = sorted(histogram)
+    for percentile in PERCENTILES:
+        # nearest rank
+        rank = -(-percentile * total // 100)
+        seen = 0
+        for minute in minutes:
+            seen += histogram[minute]
+            if seen >= rank:
+                percentiles['p%s' % percentile] = minute
+                break
+    return percentiles
+
+
+def summarize(rows):
+    """Statistics of a train from its rollups rows
+
+    Delays are those of the trains which ran, NORMAL ones being on time.
+    """
+    stats = {'count': 0, 'types': {}, 'weekday': {}, 'hour': {}}
+    delays = {}
+    for row in rows:
+        if row['dimension'] == 'delay':
+            if row['type'] != 'SUPPR':
+                minute = int(row['bucket'])
+                delays[minute] = delays.get(minute, 0) + row['count']
+            continue
+        if row['dimension'] == 'weekday':
+            stats['count'] += row['count']
+            stats['types'][row['type']] = stats['types'].get(row['type'], 0) + row['count']
+        bucket = int(row['bucket']) if row['dimension'] == 'weekday' else row['bucket']
+        breakdown = stats[row['dimension']].setdefault(bucket, {})
+        breakdown[row['type']] = row['count']
+    stats['cancellation_rate'] = stats['types'].get('SUPPR', 0) / stats['count'] \
+        if stats['count'] else None
+    stats['delay'] = get_percentiles(delays)
+    return stats
+
+
+def query_train(db, num):
+    """Statistics of a train, w/ its weekday and hour breakdowns
+
+    None if the train is unknown.
+    """
+    rows = list(db.query(queries.TRAIN_ROLLUPS, num=num))
+    if not rows:
+        return None
+    return dict(summarize(rows), num=num)
+
+
+def query_trains(db):
+    """Statistics of every train, w/o the breakdowns"""
+    trains = {}
+    for row in db.query(queries.TRAIN_ROLLUPS_SUMMARY):
+        trains.setdefault(row['num'], []).append(row)
+    stats = []
+    for num, rows in trains.items():
+        train = summarize(rows)
+        del train['weekday'], train['hour']
+        stats.append(dict(train, num=num))
+    return stats
+
+
+@click.command()
+def run():
+    """Rebuild the rollups from scratch"""
+    with database.get() as tx:
+        rebuild(tx)
+        rebuild_trains(tx)
+        rebuild_archives(tx)
+
+
+if __name__ == '__main__':
+    run()
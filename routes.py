@@ -0,0 +1,64 @@
+"""Registry of the monitored routes, see ROUTES and STATIONS in settings
+
+A route is checked both ways. Its results, whatever their direction, share
+a key (see queries.ROUTE) by which they are indexed and rolled up. W/o
+ROUTES and STATIONS (the settings.py of an older install), the stations of
+FROM_STATION_CODE and TO_STATION_CODE are the only route.
+"""
+
+from collections import namedtuple
+
+from config import settings
+
+
+def get_key(from_station, to_station):
+    """Key of the route between two stations, either way, as queries.ROUTE"""
+    return '-'.join(sorted((str(from_station), str(to_station))))
+
+
+class Route(namedtuple('Route', ('name', 'from_station', 'to_station'))):
+    """A monitored route: name, from and to station codes"""
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """Key of the results of the route, see `get_key`"""
+        return get_key(self.from_station, self.to_station)
+
+
+def get_routes():
+    """Monitored routes, the default one first"""
+    default = [('default', settings.FROM_STATION_CODE, settings.TO_STATION_CODE)]
+    return [Route(*route) for route in getattr(settings, 'ROUTES', default)]
+
+
+def get_pairs():
+    """`(from station, to station)` of the monitored routes"""
+    return [(route.from_station, route.to_station) for route in get_routes()]
+
+
+def get_route(name=None):
+    """Route of a name, the default one w/o name, None if unknown"""
+    for route in get_routes():
+        if name is None or route.name == name:
+            return route
+    return None
+
+
+def find(from_station, to_station):
+    """Monitored route between two stations, either way, None if none is"""
+    key = get_key(from_station, to_station)
+    for route in get_routes():
+        if route.key == key:
+            return route
+    return None
+
+
+def get_label(code):
+    """Label of a station, its code if unknown"""
+    stations = getattr(settings, 'STATIONS', {
+        settings.FROM_STATION_CODE: settings.FROM_STATION_LABEL,
+        settings.TO_STATION_CODE: settings.TO_STATION_LABEL,
+    })
+    return stations.get(int(code), str(code))
@@ -0,0 +1,80 @@
+"""Compact rows for the read path
+
+The read-only connectors of database.py build a `Row` per row instead of a
+`stuf`: the values are kept in a tuple, the keys in the class shared by
+all the rows of the same columns. Rows read as mappings and attributes,
+and are JSON encoded w/ `to_json`.
+"""
+
+from collections.abc import Mapping
+from functools import lru_cache
+
+
+class Row(Mapping):
+    """Read-only row of a query result, by key (`row['num']`) or attribute
+    (`row.num`)
+    """
+
+    __slots__ = ('_values',)
+    # set by `get_row_class`, for the rows of a given set of columns
+    _keys = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return 'Row(%r)' % self._asdict()
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else self._values[index]
+
+    def _asdict(self):
+        """Dict of the row, e.g. to add keys to it"""
+        return dict(zip(self._keys, self._values))
+
+
+@lru_cache(maxsize=128)
+def get_row_class(keys):
+    """`Row` subclass for the rows of the given columns"""
+    return type('Row', (Row,), {
+        '__slots__': (),
+        '_keys': keys,
+        '_index': {key: idx for idx, key in enumerate(keys)},
+    })
+
+
+def make_row(items):
+    """Build a `Row` from the `(key, value)` pairs of a row, as `dataset`
+    does w/ its `row_type`
+    """
+    keys, values = zip(*items)
+    return get_row_class(keys)(values)
+
+
+def to_json(obj):
+    """`default` of the JSON encoders, for rows"""
+    if isinstance(obj, Row):
+        return obj._asdict() # pylint: disable=W0212
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
@@ -0,0 +1,268 @@
+"""Database schema, w/ versioned migrations"""
+
+from datetime import datetime
+
+import click
+from sqlalchemy import Index
+
+import archive
+import database
+
+
+# SQL of the migrations, as of their writing: migrations are not changed
+# by the later changes of queries.py and rollups.py
+
+# bucket of a result for each aggregate frequency
+FREQUENCIES = {
+    'hour': 'substr(date, 0, 15)',
+    'day': 'substr(date, 0, 11)',
+    'month': 'substr(date, 0, 8)',
+    'year': 'substr(date, 0, 5)',
+    'hour_overall': 'substr(date, 12, 2)',
+    'weekday': 'weekday',
+}
+
+# bucket of a result for each per train dimension
+TRAIN_DIMENSIONS = {
+    'weekday': 'CAST(weekday AS TEXT)',
+    'hour': 'substr(date, 12, 2)',
+    'delay': 'CAST(MIN(COALESCE(delay, 0) / 60, 120) AS TEXT)',
+}
+
+# key of the route of a result, either way
+ROUTE = """(CASE WHEN from_gare < to_gare THEN from_gare || '-' || to_gare
+    ELSE to_gare || '-' || from_gare END)"""
+
+
+def create_columns(db, table_name, columns):
+    """Create a table w/ the given `(name, type)` columns, if missing"""
+    table = db.create_table(table_name)
+    for name, column_type in columns:
+        table.create_column(name, column_type)
+
+
+def create_indexes(db, table_name, indexes, unique=False):
+    """Create the missing `{name: columns}` indexes of a table"""
+    table = db[table_name].table
+    for name, columns in indexes.items():
+        Index(name, *[table.c[c] for c in columns], unique=unique).create(
+            bind=db.executable, checkfirst=True
+        )
+
+
+def create_results(db):
+    """Create the `results` table, which used to be created implicitly"""
+    create_columns(db, 'results', (
+        ('date', db.types.text),
+        ('num', db.types.text),
+        ('miss', db.types.text),
+        ('term', db.types.integer),
+        ('etat', db.types.text),
+        ('type', db.types.text),
+        ('from_gare', db.types.text),
+        ('to_gare', db.types.text),
+        ('delay', db.types.integer),
+        ('weekday', db.types.integer),
+    ))
+
+
+def index_results(db):
+    """Index the hot predicates of `results`"""
+    create_indexes(db, 'results', {
+        # dedup in flag.record, per train queries
+        'ix_results_num_date': ('num', 'date'),
+        # /api
+        'ix_results_from_gare_date': ('from_gare', 'date'),
+        # aggregates, w/ or w/o `since`
+        'ix_results_date_type': ('date', 'type'),
+        'ix_results_weekday_type': ('weekday', 'type'),
+        # train list
+        'ix_results_type_num': ('type', 'num'),
+    })
+
+
+def create_rollups(db):
+    """Create and fill the materialized aggregates, see rollups.py"""
+    create_columns(db, 'rollups', (
+        ('frequency', db.types.text),
+        ('bucket', db.types.text),
+        ('type', db.types.text),
+        ('count', db.types.integer),
+    ))
+    create_indexes(db, 'rollups', {
+        'ux_rollups_frequency_bucket_type': ('frequency', 'bucket', 'type'),
+    }, unique=True)
+    for frequency, group_by in FREQUENCIES.items():
+        db.query("""
+            INSERT INTO rollups (frequency, bucket, type, count)
+            SELECT :frequency, CAST(%(group_by)s AS TEXT), type, COUNT(*)
+            FROM results
+            GROUP BY %(group_by)s, type;
+        """ % {'group_by': group_by}, frequency=frequency)
+
+
+def create_meta(db):
+    """Create the key/value `meta` table, w/ the write generation"""
+    create_columns(db, 'meta', (
+        ('key', db.types.text),
+        ('value', db.types.integer),
+    ))
+    create_indexes(db, 'meta', {'ux_meta_key': ('key',)}, unique=True)
+    db['meta'].insert({'key': 'generation', 'value': 0})
+
+
+def add_timestamps(db):
+    """Store dates as epochs too, for cheap range filters on integers"""
+    create_columns(db, 'results', (('ts', db.types.integer),))
+    # dates are local, as `time.mktime` expects them
+    db.query("""
+        UPDATE results SET ts = CAST(strftime('%s', date, 'utc') AS INTEGER)
+        WHERE ts IS NULL
+    """)
+    db.query('DROP INDEX IF EXISTS ix_results_num_date')
+    db.query('DROP INDEX IF EXISTS ix_results_from_gare_date')
+    # whole table weekday aggregates are served by the rollups, and the
+    # planner would pick it over the date range of a `since` aggregate
+    db.query('DROP INDEX IF EXISTS ix_results_weekday_type')
+    create_indexes(db, 'results', {
+        'ix_results_num_ts': ('num', 'ts'),
+        'ix_results_from_gare_ts': ('from_gare', 'ts'),
+    })
+
+
+def create_outbox(db):
+    """Create the queue of notifications to send, see notifications.py"""
+    create_columns(db, 'outbox', (
+        ('created', db.types.text),
+        ('channel', db.types.text),
+        ('cancel', db.types.boolean),
+        ('payload', db.types.text),
+        ('attempts', db.types.integer),
+        ('sent', db.types.text),
+        ('error', db.types.text),
+    ))
+    create_indexes(db, 'outbox', {'ix_outbox_sent': ('sent',)})
+
+
+def add_revisions(db):
+    """Stamp results w/ the write generation that last changed them"""
+    create_columns(db, 'results', (('rev', db.types.integer),))
+    db.query('UPDATE results SET rev = 0 WHERE rev IS NULL')
+    create_indexes(db, 'results', {'ix_results_rev': ('rev',)})
+
+
+def create_train_rollups(db):
+    """Create and fill the per train rollups, see rollups.py"""
+    create_columns(db, 'train_rollups', (
+        ('num', db.types.text),
+        ('dimension', db.types.text),
+        ('bucket', db.types.text),
+        ('type', db.types.text),
+        ('count', db.types.integer),
+    ))
+    create_indexes(db, 'train_rollups', {
+        'ux_train_rollups_num_dimension_bucket_type': ('num', 'dimension', 'bucket', 'type'),
+    }, unique=True)
+    for dimension, group_by in TRAIN_DIMENSIONS.items():
+        db.query("""
+            INSERT INTO train_rollups (num, dimension, bucket, type, count)
+            SELECT num, :dimension, %(group_by)s, type, COUNT(*)
+            FROM results
+            GROUP BY num, %(group_by)s, type;
+        """ % {'group_by': group_by}, dimension=dimension)
+
+
+def add_routes(db):
+    """Index the results by route, and roll them up by route too
+
+    The rollups so far are the ones of all the routes, w/ an empty route.
+    The rollups of each route are counted from the results and archives.
+    """
+    # on the expression of the route key, as queried
+    db.query('CREATE INDEX IF NOT EXISTS ix_results_route_ts ON results (%s, ts)' % ROUTE)
+    db.query('CREATE INDEX IF NOT EXISTS ix_results_route_date ON results (%s, date)' % ROUTE)
+    db.query('DROP INDEX IF EXISTS ix_results_from_gare_ts')
+    create_columns(db, 'rollups', (('route', db.types.text),))
+    db.query("UPDATE rollups SET route = '' WHERE route IS NULL")
+    db.query('DROP INDEX IF EXISTS ux_rollups_frequency_bucket_type')
+    create_indexes(db, 'rollups', {
+        'ux_rollups_route_frequency_bucket_type': ('route', 'frequency', 'bucket', 'type'),
+    }, unique=True)
+    for frequency, group_by in FREQUENCIES.items():
+        params = {'group_by': group_by, 'route': ROUTE}
+        db.query("""
+            INSERT INTO rollups (route, frequency, bucket, type, count)
+            SELECT %(route)s, :frequency, CAST(%(group_by)s AS TEXT), type, COUNT(*)
+            FROM results
+            GROUP BY %(route)s, %(group_by)s, type;
+        """ % params, frequency=frequency)
+        for row in archive.query("""
+                SELECT %(route)s AS route, CAST(%(group_by)s AS TEXT) AS bucket, type,
+                COUNT(*) AS count
+                FROM results
+                GROUP BY %(route)s, %(group_by)s, type;
+        """ % params):
+            db.query("""
+                INSERT INTO rollups (route, frequency, bucket, type, count)
+                VALUES (:route, :frequency, :bucket, :type, :count)
+                ON CONFLICT (route, frequency, bucket, type)
+                DO UPDATE SET count = count + excluded.count;
+            """, frequency=frequency, **row)
+    # drop the cached responses
+    db.query("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+
+# append only: a migration's version is its position in the list
+MIGRATIONS = [
+    create_results,
+    index_results,
+    create_rollups,
+    create_meta,
+    add_timestamps,
+    create_outbox,
+    add_revisions,
+    create_train_rollups,
+    add_routes,
+]
+
+
+def get_version(db):
+    """Current schema version, 0 for a new database"""
+    if 'migrations' not in db:
+        return 0
+    res = next(db.query('SELECT MAX(version) AS version FROM migrations'))
+    return res['version'] or 0
+
+
+def migrate(db, version=None):
+    """Apply the pending migrations, up to `version` (default: latest)
+
+    Return the list of applied versions.
+    """
+    if version is None:
+        version = len(MIGRATIONS)
+    applied = []
+    for migration_version in range(get_version(db) + 1, version + 1):
+        with db as tx:
+            MIGRATIONS[migration_version - 1](tx)
+            tx['migrations'].insert({
+                'version': migration_version,
+                'name': MIGRATIONS[migration_version - 1].__name__,
+                'applied': datetime.now().isoformat(' ')
+            })
+        applied.append(migration_version)
+    return applied
+
+
+@click.command()
+@click.option('--version', default=None, type=int, help='Target version (default: latest)')
+def run(version):
+    """Migrate the database schema"""
+    db = database.get()
+    for applied in migrate(db, version=version):
+        click.echo('Applied migration %s: %s' % (applied, MIGRATIONS[applied - 1].__name__))
+    click.echo('Schema version %s' % get_version(db))
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120
@@ -0,0 +1,80 @@
+"""Tests module"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+TOPDIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(TOPDIR)
+
+import analytics
+import archive
+import export
+import make_train_list
+import rollups
+import settings
+from test_flag import FlagBaseTestCase
+
+
+@unittest.skipIf(export.pa is None, 'pyarrow is not installed')
+class AnalyticsTestCase(FlagBaseTestCase):
+
+    def setUp(self):
+        super(AnalyticsTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        settings.ARCHIVE_DIR = os.path.join(self.tmp_dir, 'archives')
+        self.output = os.path.join(self.tmp_dir, 'export')
+        for month in range(1, 4):
+            for num in range(3):
+                self._create_record(date=datetime(2016, month, 10 + num, 8, 5), num=num)
+        self._create_record(date=datetime(2016, 2, 20, 8, 5), num=4, etat='S')
+        now = datetime.now().replace(second=0, microsecond=0)
+        self._create_record(date=now, num=1)
+        self._create_record(date=now + timedelta(minutes=4), num=1)
+        self._create_record(date=now, num=2, from_gare=settings.TO_STATION_CODE,
+                            to_gare=settings.FROM_STATION_CODE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(AnalyticsTestCase, self).tearDown()
+
+    def test_export(self):
+        """Results are exported by month, archives included"""
+        archive.archive(self.database, 1, now=datetime(2016, 3, 15))
+        counts = export.export(self.output)
+        self.assertEqual(counts['2016-01'], 3)
+        self.assertEqual(counts['2016-02'], 4)
+        self.assertEqual(sum(counts.values()), 12)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output, 'month=2016-01', 'results.parquet')
+        ))
+        table = analytics.load(self.output)
+        self.assertEqual(table.num_rows, 12)
+        self.assertEqual(sorted(table['id'].to_pylist()), list(range(1, 13)))
+        # replaced by a new export
+        self.assertEqual(export.export(self.output), counts)
+
+    def test_analytics(self):
+        """Analytics on the export match the database"""
+        export.export(self.output)
+        table = analytics.load(self.output)
+        for frequency in rollups.FREQUENCIES:
+            for since in (None, '2016-02-11 00:00:00'):
+                key = lambda row: (str(row['date']), row['type'])
+                self.assertEqual(
+                    sorted(analytics.aggregate(table, frequency, since), key=key),
+                    sorted(rollups.query(self.database, frequency, since), key=key)
+                )
+        self.assertEqual(
+            analytics.get_trains(table), make_train_list.get_trains(self.database)
+        )
+        self.assertEqual(
+            analytics.get_train_stats(table),
+            sorted(rollups.query_trains(self.database), key=lambda train: train['num'])
+        )
+        self.assertEqual(
+            analytics.get_train_stats(table, '1'), [rollups.query_train(self.database, '1')]
+        )
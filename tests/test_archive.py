@@ -0,0 +1,98 @@
+"""Tests module"""
+
+import os
+import sys
+import shutil
+import tempfile
+from datetime import datetime
+
+TOPDIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(TOPDIR)
+
+import archive
+import database
+import rollups
+import schema
+import settings
+from test_flag import FlagBaseTestCase
+
+
+class ArchiveTestCase(FlagBaseTestCase):
+
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+        self.archive_dir = tempfile.mkdtemp()
+        settings.ARCHIVE_DIR = self.archive_dir
+        # three trains a month, from January to April
+        for month in range(1, 5):
+            for num in range(3):
+                self._create_record(date=datetime(2016, month, 10 + num, 8, 5), num=num)
+        self._create_record(date=datetime(2016, 2, 20, 8, 5), num=4, etat='S')
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+        super(ArchiveTestCase, self).tearDown()
+
+    def _aggregates(self):
+        """All the aggregates, w/ and w/o since"""
+        return {
+            (frequency, since): rollups.query(self.database, frequency, since)
+            for frequency in rollups.FREQUENCIES
+            for since in (None, '2016-01-11 00:00:00', '2016-02-15 00:00:00')
+        }
+
+    def test_get_cutoff(self):
+        """Test the first month to keep"""
+        self.assertEqual(archive.get_cutoff(datetime(2016, 4, 15), 2), '2016-02')
+        self.assertEqual(archive.get_cutoff(datetime(2016, 1, 15), 1), '2015-12')
+        self.assertEqual(archive.get_cutoff(datetime(2016, 1, 15), 12), '2015-01')
+        self.assertEqual(archive.get_next_month('2015-12'), '2016-01')
+
+    def test_archive(self):
+        """Old months are moved to their archive"""
+        moved = archive.archive(self.database, 1, now=datetime(2016, 4, 15))
+        self.assertEqual(moved, {'2016-01': 3, '2016-02': 4})
+        self.assertEqual(self.database['results'].count(), 6)
+        self.assertEqual(
+            [month for month, _ in archive.get_files()], ['2016-01', '2016-02']
+        )
+        rows = archive.query('SELECT * FROM results ORDER BY id')
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[-1]['type'], 'SUPPR')
+        self.assertEqual(archive.get_horizon(self.database), '2016-03-01 00:00:00')
+        # nothing left to move, the horizon does not go back
+        self.assertEqual(archive.archive(self.database, 6, now=datetime(2016, 4, 15)), {})
+        self.assertEqual(archive.get_horizon(self.database), '2016-03-01 00:00:00')
+
+    def test_archive_aggregates(self):
+        """Aggregates still cover the archived results"""
+        before = self._aggregates()
+        trains = rollups.query_trains(self.database)
+        archive.archive(self.database, 1, now=datetime(2016, 4, 15))
+        self.assertEqual(self._aggregates(), before)
+        with self.database as tx:
+            rollups.rebuild(tx)
+            rollups.rebuild_trains(tx)
+            rollups.rebuild_archives(tx)
+        self.assertEqual(self._aggregates(), before)
+        self.assertEqual(rollups.query_trains(self.database), trains)
+
+    def test_add_routes_migration(self):
+        """Rollups by route are counted from the results and archives"""
+        archive.archive(self.database, 1, now=datetime(2016, 4, 15))
+
+        def get_rollups():
+            return (
+                sorted(tuple(row.values())[1:] for row in self.database['rollups'].all()),
+                sorted(tuple(row.values())[1:] for row in self.database['train_rollups'].all()),
+            )
+
+        before = get_rollups()
+        # back to the rollups of all the routes, w/o route
+        self.database.query("DELETE FROM rollups WHERE route != ''")
+        self.database.query('UPDATE rollups SET route = NULL')
+        self.database['migrations'].delete(name='add_routes')
+        generation = database.get_generation(self.database)
+        schema.migrate(self.database)
+        self.assertEqual(get_rollups(), before)
+        self.assertEqual(database.get_generation(self.database), generation + 1)
@@ -0,0 +1,180 @@
+"""Tests module"""
+
+import asyncio
+import os
+import sys
+import json
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+TOPDIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(TOPDIR)
+
+import asgi
+import web
+import utils
+from test_flag import FlagBaseTestCase
+
+
+class AsgiTestCase(FlagBaseTestCase):
+
+    def setUp(self):
+        super(AsgiTestCase, self).setUp()
+        self.client = web.app.test_client()
+        web.response_cache.clear()
+
+    def _request(self, path, query_string='', method='GET', headers=()):
+        """Helper: status, headers and body of a request to the ASGI app"""
+        return asyncio.run(self._send(path, query_string, method, headers))
+
+    async def _send(self, path, query_string='', method='GET', headers=()):
+        """Helper: `_request` from a running loop, the body messages joined"""
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await asgi.app({
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string.encode('latin-1'),
+            'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers],
+        }, receive, send)
+        start, bodies = messages[0], messages[1:]
+        self.assertFalse(bodies[-1].get('more_body', False))
+        self.body_messages = len(bodies)
+        return start['status'], dict(start['headers']), b''.join(body['body'] for body in bodies)
+
+    def _assert_same(self, path, query_string=''):
+        """Same status and payload as web.py"""
+        rv = self.client.get(path + (query_string and '?' + query_string))
+        status, _, body = self._request(path, query_string)
+        self.assertEqual(status, rv.status_code)
+        if status == 200:
+            self.assertEqual(json.loads(body), json.loads(rv.data))
+
+    def test_api(self):
+        """/api as web.py"""
+        self._assert_same('/api')
+        now = datetime.now()
+        self._create_record(date=now, num=1)
+        self._create_record(date=now - timedelta(days=2), num=2, etat='S')
+        self._assert_same('/api')
+        self._assert_same('/api', 'since=%s' % int(utils.get_timestamp(now - timedelta(days=3))))
+        self._assert_same('/api', 'after_rev=0')
+        self._assert_same('/api', 'route=nope')
+        self._assert_same('/api', 'since=nope')
+
+    def test_api_ndjson(self):
+        """/api as NDJSON, as web.py"""
+        now = datetime.now()
+        for num in range(3):
+            self._create_record(date=now - timedelta(minutes=num), num=num)
+        status, headers, body = self._request('/api', 'format=ndjson&limit=2')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/x-ndjson')
+        self.assertEqual(body, self.client.get('/api?format=ndjson&limit=2').data)
+        status, _, _ = self._request('/api', 'format=ndjson&cursor=1234')
+        self.assertEqual(status, 400)
+        status, _, _ = self._request('/api', 'format=ndjson&limit=0')
+        self.assertEqual(status, 400)
+
+    def test_api_ndjson_batches(self):
+        """NDJSON bodies are streamed a batch of rows at a time"""
+        now = datetime.now()
+        for num in range(5):
+            self._create_record(date=now - timedelta(minutes=num), num=num)
+        cursor = json.loads(self.client.get('/api?format=ndjson&limit=1').data)['id']
+        with mock.patch.object(asgi, 'NDJSON_BATCH', 2):
+            for query_string, messages in (('', 4), ('limit=3', 3), ('limit=4', 3),
+                                           ('cursor=%s' % cursor, 3)):
+                query_string = 'format=ndjson&' + query_string
+                status, headers, body = self._request('/api', query_string)
+                self.assertEqual(status, 200)
+                self.assertNotIn(b'content-length', headers)
+                self.assertEqual(body, self.client.get('/api?' + query_string).data)
+                self.assertEqual(self.body_messages, messages)
+
+    def test_api_aggregate(self):
+        """Aggregates as web.py"""
+        start_date = utils.get_datetime_from_iso('2017-02-12 01:01:01')
+        self._create_record(date=start_date)
+        self._create_record(num=256, etat='R', date=start_date)
+        self._create_record(num=789, etat='S', date=start_date - timedelta(days=1))
+        for frequency in asgi.rollups.FREQUENCIES:
+            self._assert_same('/api/aggregate/%s' % frequency)
+        since = int(utils.get_timestamp(start_date - timedelta(hours=1)))
+        self._assert_same('/api/aggregate/day', 'since=%s' % since)
+        self._assert_same('/api/aggregate/day', 'route=poissy')
+        self._assert_same('/api/aggregate/minute')
+
+    def test_api_etag(self):
+        """Cached responses revalidated w/ their ETag until the next write"""
+        self._create_record(num=1)
+        status, headers, _ = self._request('/api/aggregate/day')
+        self.assertEqual(status, 200)
+        etag = headers[b'etag'].decode('latin-1')
+        status, _, body = self._request('/api/aggregate/day', headers=[('if-none-match', etag)])
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(web.response_cache.get_stats()['not_modified'], 1)
+        # same ETag as web.py
+        rv = self.client.get('/api/aggregate/day', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self._create_record(num=2)
+        status, _, _ = self._request('/api/aggregate/day', headers=[('if-none-match', etag)])
+        self.assertEqual(status, 200)
+
+    def test_api_watched_generation(self):
+        """Cached responses of the watched generation are served w/o query"""
+        self._create_record(num=1)
+        _, _, body = self._request('/api/aggregate/day')
+        generation = web.database.get_generation(self.database)
+        self.addCleanup(setattr, asgi.generation_watcher, 'generation', None)
+        asgi.generation_watcher.generation = generation
+        self._create_record(num=2)
+        hits = web.response_cache.get_stats()['hits']
+        # not watched yet
+        self.assertEqual(self._request('/api/aggregate/day')[2], body)
+        self.assertEqual(web.response_cache.get_stats()['hits'], hits + 1)
+        asgi.generation_watcher.generation = generation + 1
+        self.assertNotEqual(self._request('/api/aggregate/day')[2], body)
+
+    def test_errors(self):
+        """Unknown paths and methods"""
+        self.assertEqual(self._request('/nope')[0], 404)
+        self.assertEqual(self._request('/api', method='POST')[0], 405)
+
+    def test_concurrent(self):
+        """Concurrent clients are served from the pool"""
+        self._create_record(num=1)
+
+        async def requests():
+            return await asyncio.gather(*[
+                self._send('/api/aggregate/day', 'since=%s' % (num * 60))
+                for num in range(50)
+            ])
+
+        responses = asyncio.run(requests())
+        self.assertEqual([status for status, _, _ in responses], [200] * 50)
+
+    def test_metrics(self):
+        """Requests are counted by rule, as web.py"""
+        count = web.HTTP_REQUESTS.get(route='/api/aggregate/<frequency>', status=200)
+        self._request('/api/aggregate/day')
+        self.assertEqual(
+            web.HTTP_REQUESTS.get(route='/api/aggregate/<frequency>', status=200), count + 1
+        )
+        status, _, body = self._request('/metrics')
+        self.assertEqual(status, 200)
+        self.assertIn(b'transilien_http_requests_total', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+"""Tests module"""
+
+import os
+import sys
+import types
+import unittest
+
+TOPDIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(TOPDIR)
+
+import config
+
+
+class ConfigTestCase(unittest.TestCase):
+
+    def test_apply(self):
+        """Missing settings are set from the defaults, set ones are kept"""
+        module = config.apply(types.SimpleNamespace(CACHE_SIZE=1))
+        self.assertEqual(module.CACHE_SIZE, 1)
+        self.assertEqual(module.POLLER_WORKERS, config.DEFAULTS['POLLER_WORKERS'])
+        self.assertEqual(module.STREAM_INTERVAL, config.DEFAULTS['STREAM_INTERVAL'])
+
+
+if __name__ == '__main__':
+    unittest.main()
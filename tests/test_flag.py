@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 """Tests module"""
 
+import base64
+import json
 import os
 import sys
 import unittest
 import tempfile
 from datetime import datetime, timedelta
+from unittest import mock
+from click.testing import CliRunner
 import requests_mock
 
 TOPDIR = os.path.join(os.path.dirname(__file__), "..")
@@ -14,6 +18,10 @@ sys.path.append(TOPDIR)
 import settings
 import database
 import flag
+import notifications
+import queries
+import rows
+import schema
 import utils
 
 
@@ -44,8 +52,10 @@ class FlagBaseTestCase(unittest.TestCase):
             'week': 1, 'on_time': 1, 'late': 1, 'canceled': 1, 'total_late': 1
         })
         self.database['aggregate'].delete()
+        schema.migrate(self.database)
 
     def tearDown(self):
+        database.close()
         os.close(self.db_fd)
         os.unlink(self.db_file_path)
 
@@ -53,7 +63,7 @@ class FlagBaseTestCase(unittest.TestCase):
         """Translate a datetime to the internal transilien format"""
         return thedatetime.strftime('%d/%m/%Y %H:%M')
 
-    def _create_record(
+    def _make_record(
             self,
             date=datetime.now(),
             num=123,
@@ -63,17 +73,132 @@ class FlagBaseTestCase(unittest.TestCase):
             from_gare=settings.FROM_STATION_CODE,
             to_gare=settings.TO_STATION_CODE
         ):
-        """Helper to create a record, w/ default values"""
-        date = self._get_transilien_datestring(date)
-        flag.record({
-            'date': date,
+        """Helper to build a raw API record, w/ default values"""
+        return {
+            'date': self._get_transilien_datestring(date),
             'num': num,
             'miss': miss,
             'term': term,
             'etat': etat,
             'from_gare': from_gare,
             'to_gare': to_gare
-        })
+        }
+
+    def _create_record(
+            self,
+            date=datetime.now(),
+            num=123,
+            miss='LOL',
+            term=87384008,
+            etat=None,
+            from_gare=settings.FROM_STATION_CODE,
+            to_gare=settings.TO_STATION_CODE
+        ):
+        """Helper to create a record, w/ default values"""
+        flag.record(self._make_record(
+            date=date, num=num, miss=miss, term=term, etat=etat,
+            from_gare=from_gare, to_gare=to_gare
+        ))
+
+
+class SchemaTestCase(FlagBaseTestCase):
+
+    def test_migrate(self):
+        """Migrations are applied once, up to the latest version"""
+        self.assertEqual(schema.get_version(self.database), len(schema.MIGRATIONS))
+        self.assertEqual(schema.migrate(self.database), [])
+        indexes = self.database.inspect.get_indexes('results')
+        self.assertIn(
+            ['num', 'ts'],
+            [index['column_names'] for index in indexes]
+        )
+
+    def test_migrate_rollups(self):
+        """The rollups of an old database match a rebuild"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        db = database.connect('sqlite:///%s' % path)
+        self.addCleanup(db.close)
+        schema.migrate(db, version=2)
+        for num, etat in ((1, ''), (2, 'Supprimé')):
+            db['results'].insert(flag.normalize(self._make_record(num=num, etat=etat)))
+        schema.migrate(db)
+
+        def get_rollups():
+            return (
+                sorted(tuple(row.values())[1:] for row in db['rollups'].all()),
+                sorted(tuple(row.values())[1:] for row in db['train_rollups'].all()),
+            )
+
+        migrated = get_rollups()
+        self.assertTrue(all(migrated))
+        with db as tx:
+            flag.rollups.rebuild(tx)
+            flag.rollups.rebuild_trains(tx)
+        self.assertEqual(get_rollups(), migrated)
+
+    def test_add_routes_invalidates(self):
+        """Rebuilding the rollups by route drops the cached responses"""
+        self.database['migrations'].delete(name='add_routes')
+        generation = database.get_generation(self.database)
+        self.assertEqual(schema.migrate(self.database), [len(schema.MIGRATIONS)])
+        self.assertEqual(database.get_generation(self.database), generation + 1)
+
+    def test_route_index(self):
+        """Queries by route use the expression index"""
+        plan = ' '.join(row['detail'] for row in self.database.query(
+            'EXPLAIN QUERY PLAN SELECT * FROM results WHERE %s = :route AND ts > 0'
+            % queries.ROUTE, route='1-2'
+        ))
+        self.assertIn('ix_results_route_ts', plan)
+
+    def test_add_timestamps(self):
+        """Epochs are backfilled from the (local) dates"""
+        train_date = datetime(2017, 2, 12, 1, 1)
+        self.database['results'].insert({'date': utils.get_datestring(train_date)})
+        schema.add_timestamps(self.database)
+        res = self.database['results'].find_one()
+        self.assertEqual(res.ts, utils.get_timestamp(train_date))
+
+
+class DatabaseTestCase(FlagBaseTestCase):
+
+    def test_get(self):
+        """Connectors are shared, w/ WAL journaling"""
+        self.assertIs(database.get(), self.database)
+        self.assertIsNot(database.get(read_only=True), self.database)
+        res = next(self.database.query('PRAGMA journal_mode'))
+        self.assertEqual(res['journal_mode'], 'wal')
+
+    def test_read_only(self):
+        """Read only connector sees the writes but can not write"""
+        read_only = database.get(read_only=True)
+        self._create_record()
+        self.assertEqual(read_only['results'].count(), 1)
+        with self.assertRaises(Exception):
+            read_only.query("DELETE FROM results")
+        database.release(read_only)
+        self.assertEqual(read_only['results'].count(), 1)
+
+    def test_read_only_rows(self):
+        """Read only connector returns compact rows, read as mappings"""
+        self._create_record(num=1, miss='LOL')
+        row = next(database.get(read_only=True).query('SELECT * FROM results'))
+        self.assertIsInstance(row, rows.Row)
+        self.assertFalse(hasattr(row, '__dict__'))
+        self.assertEqual(row['miss'], 'LOL')
+        self.assertEqual(row.miss, 'LOL')
+        self.assertEqual(row.get('nope', 1), 1)
+        self.assertIn('num', row)
+        with self.assertRaises(AttributeError):
+            row.nope
+        with self.assertRaises(KeyError):
+            row['nope']
+        written = self.database['results'].find_one(num=1)
+        self.assertEqual(row, written)
+        self.assertEqual(dict(row, miss='X'), dict(written, miss='X'))
+        self.assertEqual(json.loads(json.dumps([row], default=rows.to_json)), [dict(written)])
 
 
 class FlagRecordTestCase(FlagBaseTestCase):
@@ -112,6 +237,7 @@ class FlagRecordTestCase(FlagBaseTestCase):
             self.assertEqual(train['miss'], 'LOL')
             self.assertEqual(train['term'], 87384008)
             self.assertEqual(train.weekday, train_date.isoweekday())
+            self.assertEqual(train.ts, utils.get_timestamp(expected_date))
 
     def test_record_existing_w_delay(self):
         """Existing train w/ a different date, delay computed"""
@@ -216,6 +342,240 @@ class FlagRecordTestCase(FlagBaseTestCase):
             self.assertEqual(train['etat'], 'X' * 50)
 
 
+class FlagRecordManyTestCase(FlagBaseTestCase):
+
+    def test_record_many(self):
+        """Record a batch w/ new, duplicated and updated trains"""
+        start = database.get_generation(self.database)
+        train_date = datetime.now()
+        self._create_record(date=train_date, num=1)
+        self._create_record(date=train_date, num=2, etat='S')
+        with mock.patch.object(settings, 'MAIL_ENABLED', True):
+            flag.record_many([
+                # delayed
+                self._make_record(date=train_date + timedelta(minutes=2), num=1),
+                # put back on service
+                self._make_record(date=train_date, num=2),
+                # new, then cancelled in the same batch
+                self._make_record(date=train_date, num=3),
+                self._make_record(date=train_date, num=3, etat='S'),
+            ])
+        self.assertEqual(self.database['results'].count(), 3)
+        trains = {t.num: t for t in self.database['results'].all()}
+        self.assertEqual(trains['1'].type, 'RETARD')
+        self.assertEqual(trains['1'].delay, 120)
+        self.assertEqual(trains['2'].type, 'NORMAL')
+        self.assertEqual(trains['3'].type, 'SUPPR')
+        # stamped w/ the generation of the batch, after the two single records
+        generation = database.get_generation(self.database)
+        self.assertEqual(generation, start + 3)
+        self.assertEqual({t.rev for t in trains.values()}, {generation})
+        outbox = list(self.database['outbox'].all())
+        self.assertEqual(len(outbox), 2)
+        self.assertEqual(json.loads(outbox[0]['payload'])['num'], 2)
+        self.assertTrue(outbox[0]['cancel'])
+        self.assertEqual(json.loads(outbox[1]['payload'])['num'], 3)
+        self.assertFalse(outbox[1]['cancel'])
+        self.assertEqual({row['channel'] for row in outbox}, {'mail'})
+
+    def test_record_many_empty(self):
+        """Record an empty batch"""
+        flag.record_many([])
+        self.assertEqual(self.database['results'].count(), 0)
+
+    def test_record_many_metrics(self):
+        """Ingested trains are counted by outcome, stages and statements timed"""
+        counts = {result: flag.ROWS.get(result=result)
+                  for result in ('inserted', 'updated', 'unchanged')}
+        writes = flag.INGEST_SECONDS.get_count(stage='write')
+        inserts = database.STATEMENT_SECONDS.get_count(statement='INSERT')
+        train_date = datetime.now()
+        self._create_record(date=train_date, num=1)
+        flag.record_many([
+            self._make_record(date=train_date, num=1),
+            self._make_record(date=train_date, num=2),
+            self._make_record(date=train_date, num=2, etat='S'),
+        ])
+        self.assertEqual(flag.ROWS.get(result='inserted'), counts['inserted'] + 2)
+        self.assertEqual(flag.ROWS.get(result='updated'), counts['updated'] + 1)
+        self.assertEqual(flag.ROWS.get(result='unchanged'), counts['unchanged'] + 1)
+        self.assertEqual(flag.INGEST_SECONDS.get_count(stage='write'), writes + 2)
+        self.assertGreater(database.STATEMENT_SECONDS.get_count(statement='INSERT'), inserts)
+
+
+    def test_record_many_same_delay(self):
+        """A delayed train polled again w/ the same delay is not rewritten"""
+        train_date = datetime.now()
+        self._create_record(date=train_date, num=1)
+        delayed = self._make_record(date=train_date + timedelta(minutes=2), num=1)
+        flag.record_many([dict(delayed)])
+        generation = database.get_generation(self.database)
+        updated = flag.ROWS.get(result='updated')
+        for _ in range(2):
+            flag.record_many([dict(delayed)])
+        self.assertEqual(database.get_generation(self.database), generation)
+        self.assertEqual(flag.ROWS.get(result='updated'), updated)
+        train = self.database['results'].find_one(num=1)
+        self.assertEqual((train.type, train.delay), ('RETARD', 120))
+        # delayed further
+        flag.record_many([self._make_record(date=train_date + timedelta(minutes=5), num=1)])
+        self.assertEqual(database.get_generation(self.database), generation + 1)
+        self.assertEqual(self.database['results'].find_one(num=1).delay, 300)
+
+
+class FlagRecentIndexTestCase(FlagBaseTestCase):
+
+    def test_record_many_w_index(self):
+        """Recorded trains are looked up in the index, w/o querying them"""
+        index = flag.RecentIndex()
+        train_date = datetime.now()
+        self._create_record(date=train_date, num=1)
+        with mock.patch('flag.get_recent') as get_recent:
+            flag.record_many([
+                self._make_record(date=train_date + timedelta(minutes=2), num=1),
+                self._make_record(date=train_date, num=2),
+            ], index=index)
+            flag.record_many([
+                self._make_record(date=train_date + timedelta(minutes=2), num=1),
+                self._make_record(date=train_date, num=2, etat='S'),
+            ], index=index)
+        get_recent.assert_not_called()
+        self.assertEqual(self.database['results'].count(), 2)
+        trains = {t.num: t for t in self.database['results'].all()}
+        self.assertEqual(trains['1'].type, 'RETARD')
+        self.assertEqual(trains['2'].type, 'SUPPR')
+        route = flag.routes.get_key(settings.FROM_STATION_CODE, settings.TO_STATION_CODE)
+        self.assertEqual(index.trains[('2', route)]['type'], 'SUPPR')
+        self.assertEqual(index.generation, database.get_generation(self.database))
+
+    def test_index_other_writer(self):
+        """Rows written w/o the index are caught up w/ the write generation"""
+        index = flag.RecentIndex()
+        train_date = datetime.now()
+        flag.record_many([self._make_record(date=train_date, num=1)], index=index)
+        self._create_record(date=train_date, num=2)
+        flag.record_many([self._make_record(date=train_date, num=2, etat='S')], index=index)
+        self.assertEqual(self.database['results'].count(), 2)
+        self.assertEqual(self.database['results'].find_one(num=2).type, 'SUPPR')
+        # not reloaded
+        with mock.patch.object(index, 'load') as load:
+            flag.record_many([self._make_record(date=train_date, num=1)], index=index)
+        load.assert_not_called()
+
+    def test_index_interleaved_writer(self):
+        """Rows committed between the lookup and the write are caught up"""
+        index = flag.RecentIndex()
+        train_date = datetime.now()
+        flag.record_many([self._make_record(date=train_date, num=1)], index=index)
+        get = index.get
+
+        def get_then_write(*args):
+            recent = get(*args)
+            self._create_record(date=train_date, num=2)
+            return recent
+
+        with mock.patch.object(index, 'get', get_then_write):
+            flag.record_many([self._make_record(date=train_date, num=3)], index=index)
+        self.assertEqual(index.generation, database.get_generation(self.database) - 2)
+        flag.record_many([self._make_record(date=train_date, num=2, etat='S')], index=index)
+        self.assertEqual(self.database['results'].count(num=2), 1)
+        self.assertEqual(self.database['results'].find_one(num=2).type, 'SUPPR')
+        self.assertEqual(index.generation, database.get_generation(self.database))
+
+    def test_index_shared_num(self):
+        """Trains are indexed by num and route, as looked up in the DB"""
+        index = flag.RecentIndex()
+        train_date = datetime.now()
+        for _ in range(2):
+            for from_gare, to_gare, minutes in ((1, 2, 0), (1, 3, 0), (4, 2, 15)):
+                flag.record_many([self._make_record(
+                    date=train_date + timedelta(minutes=minutes), num=123,
+                    from_gare=from_gare, to_gare=to_gare
+                )], index=index)
+        trains = list(self.database['results'].find(num='123'))
+        self.assertEqual(len(trains), 3)
+        self.assertEqual({(t.type, t.delay) for t in trains}, {('NORMAL', None)})
+        self.assertEqual(
+            sorted(key for key in index.trains if key[0] == '123'),
+            [('123', '1-2'), ('123', '1-3'), ('123', '2-4')]
+        )
+
+    def test_index_expiry(self):
+        """Rows are expired as they leave the de-duplication window"""
+        index = flag.RecentIndex()
+        train_date = datetime(2017, 2, 12, 8, 0)
+        flag.record_many([self._make_record(date=train_date, num=1)], index=index,
+                         now=train_date)
+        route = flag.routes.get_key(settings.FROM_STATION_CODE, settings.TO_STATION_CODE)
+        self.assertIn(('1', route), index.trains)
+        flag.record_many([self._make_record(date=train_date, num=2)], index=index,
+                         now=train_date + timedelta(hours=5))
+        self.assertNotIn(('1', route), index.trains)
+        # a new train w/ the same num
+        flag.record_many([self._make_record(date=train_date + timedelta(hours=5), num=1)],
+                         index=index, now=train_date + timedelta(hours=5))
+        self.assertEqual(self.database['results'].count(num=1), 2)
+
+
+class NotificationsTestCase(FlagBaseTestCase):
+
+    def _enqueue(self, *nums):
+        for num in nums:
+            notifications.enqueue(self.database, {
+                'date': '2016-03-01 08:00:00',
+                'num': num,
+                'from_gare': settings.FROM_STATION_CODE,
+                'to_gare': settings.TO_STATION_CODE,
+            })
+
+    def test_enqueue_disabled(self):
+        """Nothing is queued w/o an enabled channel"""
+        self._enqueue(1)
+        self.assertEqual(self.database['outbox'].count(), 0)
+
+    def test_drain_digest(self):
+        """Pending notifications are sent as one message per channel"""
+        with mock.patch.object(settings, 'MAIL_ENABLED', True), \
+                mock.patch.object(settings, 'PUSHBULLET_ENABLED', True):
+            self._enqueue(1, 2)
+        with mock.patch('notifications.send_mail') as send_mail, \
+                mock.patch('notifications.send_push') as send_push:
+            self.assertEqual(notifications.drain(self.database), 4)
+            self.assertEqual(notifications.drain(self.database), 0)
+        self.assertEqual(send_mail.call_count, 1)
+        self.assertEqual([data['num'] for data, _ in send_mail.call_args[0][0]], [1, 2])
+        self.assertEqual(send_push.call_count, 1)
+        self.assertEqual(self.database['outbox'].count(sent=None), 0)
+
+    def test_drain_retry(self):
+        """Failed sends are retried, up to NOTIFICATIONS_MAX_ATTEMPTS"""
+        with mock.patch.object(settings, 'MAIL_ENABLED', True):
+            self._enqueue(1)
+        with mock.patch('notifications.send_mail', side_effect=OSError('down')) as send_mail, \
+                mock.patch.object(settings, 'NOTIFICATIONS_MAX_ATTEMPTS', 2):
+            self.assertEqual(notifications.drain(self.database), 0)
+            self.assertEqual(notifications.drain(self.database), 0)
+            self.assertEqual(notifications.drain(self.database), 0)
+        self.assertEqual(send_mail.call_count, 2)
+        row = self.database['outbox'].find_one()
+        self.assertEqual(row['attempts'], 2)
+        self.assertIn('down', row['error'])
+        self.assertIsNone(row['sent'])
+
+    def test_digest_messages(self):
+        """Digests of several notifications, w/ the network disabled"""
+        notifs = [
+            ({'date': 'X', 'from_gare': settings.FROM_STATION_CODE,
+              'to_gare': settings.TO_STATION_CODE}, cancel)
+            for cancel in (False, True)
+        ]
+        with mock.patch('notifications.email') as email:
+            notifications.send_mail(notifs)
+        self.assertEqual(email.call_args[1]['subject'], 'Suppressions Transilien (2 trains)')
+        self.assertIn('remis en service', email.call_args[1]['content'])
+        notifications.send_push(notifs)
+
+
 class FlagParserTestCase(FlagBaseTestCase):
 
     response_text = """<?xml version="1.0" encoding="UTF-8"?>
@@ -269,6 +629,211 @@ class FlagParserTestCase(FlagBaseTestCase):
                 self.assertEqual(train.date, '2012-05-23 12:14:00')
                 self.assertEqual(train.num, '148614')
 
+    def test_parse_chunks(self):
+        """Trains are parsed from a response read in small chunks"""
+        body = self.response_text.replace('<etat>S</etat>', u'<etat>Supprimé</etat>')
+        body = body.encode('utf-8')
+        req = mock.Mock()
+        req.iter_content.return_value = (body[i:i + 7] for i in range(0, len(body), 7))
+        trains = flag.parse(req, 1, 2)
+        first = next(trains)
+        self.assertEqual(first, {
+            'from_gare': 1,
+            'to_gare': 2,
+            'date': '23/05/2012 12:14',
+            'num': '148614',
+            'miss': 'VICK',
+            'term': '87393157',
+            'etat': u'Supprimé',
+        })
+        self.assertEqual([t.get('etat') for t in trains], ['R', None])
+        req.close.assert_called_once_with()
+
+    def test_capture_replay(self):
+        """Captured responses are replayed w/ the clock of their capture"""
+        path = self.db_file_path + '.jsonl'
+        self.addCleanup(os.unlink, path)
+        with requests_mock.Mocker() as mocker, \
+                mock.patch.object(flag, 'capture', flag.Capture(path)):
+            mocker.get(
+                flag.BASE_URL % (settings.TO_STATION_CODE, settings.FROM_STATION_CODE),
+                text=self.response_text
+            )
+            flag.api_request(settings.TO_STATION_CODE, settings.FROM_STATION_CODE)
+        responses = list(flag.iter_capture(path))
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(
+            base64.b64decode(responses[0]['body']), self.response_text.encode('utf-8')
+        )
+        self.assertEqual(responses[0]['from_station'], settings.TO_STATION_CODE)
+
+        # at the time of the trains, the three updates are a single train
+        self.database['results'].delete()
+        responses[0]['time'] = '2012-05-23 12:00:00'
+        with mock.patch.object(settings, 'MAIL_ENABLED', True):
+            self.assertEqual(flag.replay(responses, db=self.database), (1, 3))
+        trains = list(self.database['results'].all())
+        self.assertEqual(len(trains), 1)
+        self.assertEqual(trains[0]['type'], 'NORMAL')
+        # put back on service, but not notified
+        self.assertEqual(self.database['outbox'].count(), 0)
+
+    def test_capture_raw(self):
+        """Responses are captured as received, whatever their encoding"""
+        path = self.db_file_path + '.jsonl'
+        self.addCleanup(os.unlink, path)
+        body = self.response_text.encode('iso-8859-1')
+        chunks = flag.Capture(path).tee([body[:10], body[10:]], 1, 2)
+        self.assertEqual(b''.join(chunks), body)
+        response, = flag.iter_capture(path)
+        self.assertEqual(base64.b64decode(response['body']), body)
+
+    def test_replay_command(self):
+        """Replay requires a database other than DATABASE_URI"""
+        path = self.db_file_path + '.jsonl'
+        self.addCleanup(os.unlink, path)
+        open(path, 'w').close()
+        result = CliRunner().invoke(flag.run, ['replay', path])
+        self.assertEqual(result.exit_code, 2)
+        # the same file, relative to the working directory
+        relative = 'sqlite:///%s' % os.path.relpath(self.db_file_path)
+        for uri in (settings.DATABASE_URI, relative):
+            with mock.patch('flag.schema.migrate') as migrate:
+                result = CliRunner().invoke(flag.run, ['replay', path, '--database', uri])
+            self.assertEqual(result.exit_code, 2)
+            self.assertIn('scratch database', result.output)
+            migrate.assert_not_called()
+        scratch = self.db_file_path + '.replay'
+        self.addCleanup(os.unlink, scratch)
+        result = CliRunner().invoke(
+            flag.run, ['replay', path, '--database', 'sqlite:///%s' % scratch]
+        )
+        self.assertEqual(result.exit_code, 0)
+
+
+class FlagPollTestCase(FlagBaseTestCase):
+
+    response_text = """<?xml version="1.0" encoding="UTF-8"?>
+    <passages gare="%s">
+        <train>
+            <date mode="R">23/05/2012 12:14</date>
+            <num>%s</num>
+            <miss>VICK</miss>
+            <term>87393157</term>
+        </train>
+    </passages>"""
+
+    def setUp(self):
+        super(FlagPollTestCase, self).setUp()
+        # no rate limiting nor backoff while testing
+        self.limiter = mock.patch('flag.limiter', utils.TokenBucket(1000, capacity=1000))
+        self.limiter.start()
+        self.sleep = mock.patch('flag.time.sleep')
+        self.sleep.start()
+
+    def tearDown(self):
+        self.limiter.stop()
+        self.sleep.stop()
+        super(FlagPollTestCase, self).tearDown()
+
+    def test_poll(self):
+        """Poll several pairs, both ways"""
+        pairs = [(1, 2), (1, 3), (2, 1)]
+        with requests_mock.Mocker() as mock_req:
+            for idx, (from_station, to_station) in enumerate([(1, 2), (2, 1), (1, 3), (3, 1)]):
+                mock_req.get(
+                    flag.BASE_URL % (from_station, to_station),
+                    text=self.response_text % (from_station, idx)
+                )
+            flag.poll(pairs)
+            self.assertEqual(mock_req.call_count, 4)
+        self.assertEqual(self.database['results'].count(), 4)
+        routes = {(t.from_gare, t.to_gare) for t in self.database['results'].all()}
+        self.assertEqual(routes, {('1', '2'), ('2', '1'), ('1', '3'), ('3', '1')})
+
+    def test_poll_shared_num(self):
+        """A train is recorded for each monitored pair it serves"""
+        pairs = [(1, 2), (1, 3), (4, 2)]
+        train_date = datetime.now()
+        with requests_mock.Mocker() as mock_req:
+            for from_station, to_station in pairs:
+                # 15 minutes later at station 4
+                date = train_date + timedelta(minutes=15 if from_station == 4 else 0)
+                mock_req.get(
+                    flag.BASE_URL % (from_station, to_station),
+                    text=self.response_text.replace(
+                        '23/05/2012 12:14', self._get_transilien_datestring(date)
+                    ) % (from_station, 123)
+                )
+                mock_req.get(
+                    flag.BASE_URL % (to_station, from_station),
+                    text='<passages gare="%s"></passages>' % to_station
+                )
+            flag.poll(pairs)
+            flag.poll(pairs)
+        trains = list(self.database['results'].find(num='123'))
+        self.assertEqual(
+            sorted((t.from_gare, t.to_gare) for t in trains),
+            [('1', '2'), ('1', '3'), ('4', '2')]
+        )
+        self.assertEqual({(t.type, t.delay) for t in trains}, {('NORMAL', None)})
+
+    def test_fetch_retry(self):
+        """Server errors and rate limiting are retried"""
+        with requests_mock.Mocker() as mock_req:
+            mock_req.get(flag.BASE_URL % (1, 2), [
+                {'status_code': 503, 'text': 'KO'},
+                {'status_code': 429, 'text': 'KO', 'headers': {'Retry-After': '7'}},
+                {'status_code': 200, 'text': self.response_text % (1, 1)},
+            ])
+            flag.api_request(1, 2)
+            self.assertEqual(mock_req.call_count, 3)
+        self.assertEqual(self.database['results'].count(), 1)
+        self.assertEqual(
+            [c[0][0] for c in flag.time.sleep.call_args_list],
+            [settings.TRANSILIEN_API_BACKOFF, 7]
+        )
+
+    def test_fetch_retry_after_cap(self):
+        """Retry-After is capped at the backoff of the last retry"""
+        req = mock.Mock(headers={'Retry-After': '3600'})
+        self.assertEqual(
+            flag.get_backoff(0, req),
+            settings.TRANSILIEN_API_BACKOFF * 2 ** settings.TRANSILIEN_API_RETRIES
+        )
+
+    def test_fetch_error(self):
+        """Client errors are not retried"""
+        with requests_mock.Mocker() as mock_req:
+            mock_req.get(flag.BASE_URL % (1, 2), status_code=404, text='KO')
+            self.assertIsNone(flag.fetch(1, 2))
+            self.assertEqual(mock_req.call_count, 1)
+
+
+class FlagDaemonTestCase(FlagBaseTestCase):
+
+    schedule = [(0, 1800), (6, 120), (10, 300)]
+
+    def test_poll_interval(self):
+        """Poll interval follows the schedule"""
+        with mock.patch('settings.POLL_SCHEDULE', self.schedule):
+            self.assertEqual(flag.get_poll_interval(datetime(2017, 2, 12, 7, 0)), 120)
+            self.assertEqual(flag.get_poll_interval(datetime(2017, 2, 12, 12, 0)), 300)
+            self.assertEqual(flag.get_poll_interval(datetime(2017, 2, 12, 2, 0)), 1800)
+            # do not oversleep the next slot
+            self.assertEqual(flag.get_poll_interval(datetime(2017, 2, 12, 5, 50)), 600)
+            self.assertEqual(flag.get_poll_interval(datetime(2017, 2, 12, 23, 59)), 60)
+
+    def test_serve(self):
+        """Serve until stopped, w/ the same DB connection"""
+        stop = mock.Mock()
+        stop.is_set.side_effect = [False, False, True]
+        with mock.patch('flag.poll', side_effect=[Exception('KO'), None]) as poll:
+            flag.serve([(1, 2)], stop, db=self.database)
+        self.assertEqual(poll.call_count, 2)
+        poll.assert_called_with([(1, 2)], db=self.database, index=mock.ANY)
+        self.assertEqual(stop.wait.call_count, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
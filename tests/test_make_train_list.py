@@ -0,0 +1,58 @@
+"""Tests module"""
+
+import os
+import sys
+import unittest
+from datetime import timedelta
+
+TOPDIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(TOPDIR)
+
+import settings
+import utils
+import make_train_list
+from test_flag import FlagBaseTestCase
+
+
+class MakeTrainListTestCase(FlagBaseTestCase):
+
+    def test_get_trains_empty(self):
+        """No trains w/o data"""
+        self.assertEqual(make_train_list.get_trains(self.database), [])
+
+    def test_get_trains(self):
+        """Trains w/ their nominal hour, route, destination and counts"""
+        # sunday
+        start_date = utils.get_datetime_from_iso('2017-02-12 08:10:00')
+        for days in range(3):
+            self._create_record(date=start_date + timedelta(days=days), num=1)
+        # once at another hour
+        self._create_record(date=start_date + timedelta(days=3, hours=1), num=1)
+        self._create_record(
+            date=start_date, num=2,
+            from_gare=settings.TO_STATION_CODE, to_gare=settings.FROM_STATION_CODE
+        )
+        # never NORMAL, not listed
+        self._create_record(date=start_date, num=3, etat='S')
+
+        self.assertEqual(make_train_list.get_trains(self.database), [{
+            'num': '1',
+            'hour': '08:10',
+            'route': 'poissy',
+            'direction': 'St Lazare',
+            'count': 4,
+            'count_weekend': 1,
+            'count_week': 3,
+        }, {
+            'num': '2',
+            'hour': '08:10',
+            'route': 'poissy',
+            'direction': 'Poissy',
+            'count': 1,
+            'count_weekend': 1,
+            'count_week': 0,
+        }])
+
+
+if __name__ == '__main__':
+    unittest.main()
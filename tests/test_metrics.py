@@ -0,0 +1,63 @@
+"""Tests module"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+TOPDIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(TOPDIR)
+
+import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = list(metrics.REGISTRY)
+
+    def tearDown(self):
+        metrics.REGISTRY[:] = self.registry
+
+    def test_counter(self):
+        """Counters are rendered by label values, escaped"""
+        counter = metrics.Counter('test_events', 'Test events', ['kind'])
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='"b"')
+        self.assertEqual(counter.get(kind='a'), 3)
+        self.assertEqual(counter.render(), '\n'.join([
+            '# HELP test_events_total Test events',
+            '# TYPE test_events_total counter',
+            'test_events_total{kind="\\"b\\""} 1',
+            'test_events_total{kind="a"} 3',
+        ]))
+
+    def test_histogram(self):
+        """Histogram buckets are cumulative"""
+        histogram = metrics.Histogram('test_seconds', 'Test durations', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.7, 5):
+            histogram.observe(value)
+        with histogram.time():
+            pass
+        self.assertEqual(histogram.get_count(), 5)
+        lines = histogram.render().split('\n')
+        self.assertEqual(lines[2:5], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 4',
+            'test_seconds_bucket{le="+Inf"} 5',
+        ])
+        self.assertTrue(lines[5].startswith('test_seconds_sum 6.25'))
+        self.assertEqual(lines[6], 'test_seconds_count 5')
+
+    def test_dump(self):
+        """All the metrics are dumped to a file"""
+        metrics.Counter('test_dumped', 'Test dump').inc()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            metrics.dump(path)
+            with open(path) as metrics_file:
+                self.assertIn('test_dumped_total 1\n', metrics_file.read())
+        finally:
+            os.unlink(path)
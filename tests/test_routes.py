@@ -0,0 +1,41 @@
+"""Tests module"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+TOPDIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(TOPDIR)
+
+import settings
+import routes
+
+
+class RoutesTestCase(unittest.TestCase):
+
+    def test_routes(self):
+        """Routes of ROUTES, the default one first"""
+        with mock.patch.object(settings, 'ROUTES', [('a', 1, 2), ('b', 3, 1)], create=True):
+            self.assertEqual(routes.get_route(), ('a', 1, 2))
+            self.assertEqual(routes.get_route('b').key, '1-3')
+            self.assertIsNone(routes.get_route('c'))
+            self.assertEqual(routes.find(1, 3).name, 'b')
+            self.assertEqual(routes.get_pairs(), [(1, 2), (3, 1)])
+
+    def test_defaults(self):
+        """W/o ROUTES and STATIONS, the route of the FROM/TO stations"""
+        with mock.patch.dict(settings.__dict__):
+            del settings.ROUTES, settings.STATIONS
+            route = routes.get_route()
+            self.assertEqual(route.name, 'default')
+            self.assertEqual(routes.get_pairs(), [
+                (settings.FROM_STATION_CODE, settings.TO_STATION_CODE)
+            ])
+            self.assertEqual(routes.get_label(settings.TO_STATION_CODE),
+                             settings.TO_STATION_LABEL)
+            self.assertEqual(routes.get_label('123'), '123')
+
+
+if __name__ == '__main__':
+    unittest.main()
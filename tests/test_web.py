@@ -6,12 +6,15 @@ import json
 import unittest
 import time
 from datetime import datetime, timedelta
+from unittest import mock
 
 TOPDIR = os.path.join(os.path.dirname(__file__), "..")
 sys.path.append(TOPDIR)
 
 import web
 import utils
+import rollups
+import settings
 from test_flag import FlagBaseTestCase
 
 
@@ -21,6 +24,8 @@ class WebTestCase(FlagBaseTestCase):
         super(WebTestCase, self).setUp()
         self.app = web.app.test_client()
         web.app.config['TESTING'] = True
+        # each test has its own database
+        web.response_cache.clear()
 
     def _get_api(self, since=None):
         """Helper"""
@@ -65,6 +70,103 @@ class WebTestCase(FlagBaseTestCase):
         self.assertEqual(len(trains), 1)
         self.assertEqual(trains[0]['miss'], 'LOL')
 
+    def _get_ndjson(self, query=''):
+        """Helper"""
+        rv = self.app.get('/api?format=ndjson' + query)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in rv.data.decode('utf-8').splitlines()]
+
+    def test_api_ndjson(self):
+        """Test /api streamed as NDJSON, newest first"""
+        now = datetime.now()
+        self._create_record(date=now - timedelta(hours=1), num=1)
+        self._create_record(
+            date=now, num=2,
+            from_gare=web.settings.TO_STATION_CODE, to_gare=web.settings.FROM_STATION_CODE
+        )
+        self._create_record(date=now - timedelta(days=2), num=3)
+        rows = self._get_ndjson()
+        self.assertEqual([r['num'] for r in rows], ['2', '1'])
+        self.assertEqual([r['direction'] for r in rows], ['retour', 'aller'])
+
+    def test_api_ndjson_pagination(self):
+        """Test /api NDJSON w/ limit and cursor"""
+        now = datetime.now()
+        for num in range(5):
+            # two trains per date
+            self._create_record(date=now - timedelta(minutes=num // 2), num=num)
+        pages = []
+        query = '&limit=2'
+        while True:
+            rows = self._get_ndjson(query)
+            if not rows:
+                break
+            pages.append([r['num'] for r in rows])
+            query = '&limit=2&cursor=%s' % rows[-1]['id']
+        self.assertEqual(pages, [['1', '0'], ['3', '2'], ['4']])
+
+    def test_api_ndjson_bad_args(self):
+        """Test /api NDJSON w/ wrong args"""
+        rv = self.app.get('/api?format=ndjson&limit=X')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.get('/api?format=ndjson&cursor=12345')
+        self.assertEqual(rv.status_code, 400)
+        for limit in (0, -1):
+            rv = self.app.get('/api?format=ndjson&limit=%s' % limit)
+            self.assertEqual(rv.status_code, 400)
+
+    def test_api_after_rev(self):
+        """Test /api w/ after_rev lists the rows changed since, even old ones"""
+        self._create_record(num=1, date=datetime.now() - timedelta(days=2))
+        self._create_record(num=2)
+        rev = self._get_api()['rev']
+        rv = self.app.get('/api?after_rev=%s' % rev)
+        data = json.loads(rv.data)
+        self.assertEqual(data['aller'] + data['retour'], [])
+        self.assertEqual(data['rev'], rev)
+        # cancelled after departure, out of the default `since` window
+        self._create_record(num=1, date=datetime.now() - timedelta(days=2), etat='S')
+        rv = self.app.get('/api?after_rev=%s' % rev)
+        data = json.loads(rv.data)
+        self.assertEqual([(t['num'], t['type']) for t in data['aller']], [('1', 'SUPPR')])
+        self.assertEqual(data['retour'], [])
+        self.assertEqual(data['rev'], rev + 1)
+        rv = self.app.get('/api?after_rev=X')
+        self.assertEqual(rv.status_code, 400)
+
+    def _read_event(self, rv):
+        """Helper: next SSE event of a stream, skipping heartbeats"""
+        while True:
+            chunk = next(rv.response)
+            chunk = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+            if not chunk.startswith(':'):
+                fields = dict(line.split(': ', 1) for line in chunk.strip().splitlines())
+                return fields['id'], fields['event'], json.loads(fields['data'])
+
+    def test_api_stream(self):
+        """Test /api/stream pushes the rows written after the given rev"""
+        self._create_record(num=1)
+        rev = self._get_api()['rev']
+        self._create_record(num=2)
+        self._create_record(num=1, etat='S')
+        rv = self.app.get('/api/stream?last_event_id=%s' % rev)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        try:
+            event_id, event, data = self._read_event(rv)
+        finally:
+            rv.close()
+        self.assertEqual(event, 'results')
+        self.assertEqual(int(event_id), rev + 2)
+        self.assertEqual(data['rev'], rev + 2)
+        self.assertEqual([(t['num'], t['type']) for t in data['aller']],
+                         [('2', 'NORMAL'), ('1', 'SUPPR')])
+
+    def test_api_stream_bad_args(self):
+        """Test /api/stream w/ a wrong event id"""
+        rv = self.app.get('/api/stream', headers={'Last-Event-ID': 'X'})
+        self.assertEqual(rv.status_code, 400)
+
     def test_api_aggregate_bad_args(self):
         """Test api aggregate w/ wrong url arg"""
         rv = self.app.get('/api/aggregate')
@@ -251,5 +353,206 @@ class WebTestCase(FlagBaseTestCase):
         }])
 
 
+    def test_api_cache(self):
+        """Responses are cached until the next write, w/ ETags"""
+        stats = web.response_cache.get_stats()
+        self._create_record(miss='LOL')
+        rv = self.app.get('/api')
+        etag = rv.headers['ETag']
+        self.assertEqual(len(json.loads(rv.data)['aller']), 1)
+        rv = self.app.get('/api')
+        self.assertEqual(rv.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(rv.data)['aller']), 1)
+        rv = self.app.get('/api', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        rv = self.app.get('/api/cache')
+        new_stats = json.loads(rv.data)
+        self.assertEqual(new_stats['misses'], stats['misses'] + 1)
+        self.assertEqual(new_stats['hits'], stats['hits'] + 1)
+        self.assertEqual(new_stats['not_modified'], stats['not_modified'] + 1)
+
+        # invalidated by a write
+        self._create_record(num=256)
+        rv = self.app.get('/api', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(rv.data)['aller']), 2)
+
+    def test_metrics(self):
+        """Requests and cache events are exposed in the Prometheus format"""
+        self._create_record(miss='LOL')
+        self.app.get('/api')
+        self.app.get('/api')
+        self.app.get('/api/trains/256/stats')
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        text = rv.data.decode('utf-8')
+        self.assertIn('# TYPE transilien_http_request_seconds histogram', text)
+        self.assertIn(
+            'transilien_http_requests_total{route="/api/trains/<num>/stats",status="404"}', text
+        )
+        stats = web.response_cache.get_stats()
+        self.assertIn('transilien_cache_events_total{event="hits"} %s' % stats['hits'], text)
+        self.assertIn('transilien_http_request_seconds_bucket{route="/api",le="+Inf"}', text)
+
+    def test_api_train_stats(self):
+        """Test /api/trains/<num>/stats from the per train rollups"""
+        now = datetime.now().replace(second=0, microsecond=0)
+        for week in range(1, 5):
+            self._create_record(date=now - timedelta(weeks=week), num=1)
+        self._create_record(date=now - timedelta(weeks=5), num=1, etat='S')
+        # delayed by 7 minutes
+        self._create_record(date=now, num=1)
+        self._create_record(date=now + timedelta(minutes=7), num=1)
+        rv = self.app.get('/api/trains/1/stats')
+        self.assertEqual(rv.status_code, 200)
+        stats = json.loads(rv.data)
+        self.assertEqual(stats['num'], '1')
+        self.assertEqual(stats['count'], 6)
+        self.assertEqual(stats['types'], {'NORMAL': 4, 'RETARD': 1, 'SUPPR': 1})
+        self.assertAlmostEqual(stats['cancellation_rate'], 1 / 6)
+        self.assertEqual(stats['delay'], {'p50': 0, 'p90': 7, 'p99': 7})
+        self.assertEqual(stats['weekday'], {
+            str(now.isoweekday()): {'NORMAL': 4, 'RETARD': 1, 'SUPPR': 1}
+        })
+        self.assertEqual(list(stats['hour']), [now.strftime('%H')])
+
+        rv = self.app.get('/api/trains')
+        trains = json.loads(rv.data)['trains']
+        self.assertEqual([t['num'] for t in trains], ['1'])
+        self.assertNotIn('hour', trains[0])
+        self.assertEqual(trains[0]['delay'], stats['delay'])
+
+        rv = self.app.get('/api/trains/2/stats')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_api_train_stats_rebuild(self):
+        """Incremental per train rollups match a full rebuild"""
+        now = datetime.now()
+        for num in range(3):
+            self._create_record(date=now - timedelta(days=num), num=num)
+        self._create_record(date=now - timedelta(days=1, minutes=-3), num=1)
+        self._create_record(date=now - timedelta(days=2), num=2, etat='S')
+        incremental = rollups.query_trains(self.database)
+        with self.database as tx:
+            rollups.rebuild_trains(tx)
+        self.assertEqual(incremental, rollups.query_trains(self.database))
+
+    def test_api_aggregate_rebuild_invalidates(self):
+        """A rebuild drops the cached aggregates"""
+        self._create_record(num=1)
+        etag = self.app.get('/api/aggregate/day').headers['ETag']
+        with self.database as tx:
+            rollups.rebuild(tx)
+        rv = self.app.get('/api/aggregate/day', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_api_since_bucket(self):
+        """Requests sharing a cache entry get the rows of the rounded `since`"""
+        bucket = 3600
+        start = int(time.time()) // bucket * bucket
+        self._create_record(date=datetime.fromtimestamp(start + 600))
+        with mock.patch.object(settings, 'CACHE_SINCE_BUCKET', bucket):
+            # the later `since` first
+            for since in (start + 1200, start + 300):
+                data = self._get_api(since=since)
+                self.assertEqual(len(data['aller'] + data['retour']), 1)
+
+    def test_api_aggregate_rollups(self):
+        """Incremental rollups match a full rebuild"""
+        start_date = utils.get_datetime_from_iso('2017-02-12 01:01:01')
+        now = datetime.now()
+        self._create_record(date=start_date)
+        self._create_record(num=256, etat='S', date=start_date)
+        # cancelled, then back w/ a delay, then cancelled again
+        self._create_record(num=789, date=now)
+        self._create_record(num=789, etat='S', date=now)
+        self._create_record(num=789, date=now + timedelta(minutes=2))
+        self._create_record(num=789, etat='S', date=now)
+        incremental = {
+            frequency: rollups.query(self.database, frequency)
+            for frequency in rollups.FREQUENCIES
+        }
+        with self.database as tx:
+            rollups.rebuild(tx)
+        for frequency in rollups.FREQUENCIES:
+            self.assertCountEqual(
+                incremental[frequency], rollups.query(self.database, frequency)
+            )
+
+
+class WebRoutesTestCase(FlagBaseTestCase):
+
+    def setUp(self):
+        super(WebRoutesTestCase, self).setUp()
+        self.app = web.app.test_client()
+        web.response_cache.clear()
+        patcher = mock.patch.multiple(settings, ROUTES=settings.ROUTES + [
+            ('versailles', 87393009, settings.TO_STATION_CODE),
+        ], STATIONS=dict(settings.STATIONS, **{'87393009': 'Versailles'}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.start_date = utils.get_datetime_from_iso('2017-02-12 01:01:01')
+        self._create_record(date=self.start_date, num=1)
+        self._create_record(date=self.start_date, num=2, etat='S')
+        self._create_record(date=self.start_date, num=3, from_gare=87393009)
+        self._create_record(
+            date=self.start_date, num=4,
+            from_gare=settings.TO_STATION_CODE, to_gare=87393009
+        )
+
+    def test_api_route(self):
+        """/api lists the trains of the default route or of `route`, both ways"""
+        since = utils.get_timestamp(self.start_date - timedelta(days=1))
+        data = json.loads(self.app.get('/api?since=%s' % since).data)
+        self.assertCountEqual([train['num'] for train in data['aller']], ['1', '2'])
+        self.assertEqual(data['retour'], [])
+        self.assertEqual(data['infos']['route'], 'poissy')
+
+        data = json.loads(self.app.get('/api?route=versailles&since=%s' % since).data)
+        self.assertEqual([train['num'] for train in data['aller']], ['3'])
+        self.assertEqual([train['num'] for train in data['retour']], ['4'])
+        self.assertEqual(data['infos'], {
+            'route': 'versailles', 'from_station': '87393009', 'to_station': 'St Lazare'
+        })
+
+        rv = self.app.get('/api?route=nope')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_api_aggregate_route(self):
+        """Aggregates of all the routes by default, of a route w/ `route`"""
+        data = json.loads(self.app.get('/api/aggregate/day').data)
+        self.assertCountEqual(data, [
+            {'count': 3, 'date': '2017-02-12', 'type': 'NORMAL'},
+            {'count': 1, 'date': '2017-02-12', 'type': 'SUPPR'},
+        ])
+        data = json.loads(self.app.get('/api/aggregate/day?route=versailles').data)
+        self.assertEqual(data, [{'count': 2, 'date': '2017-02-12', 'type': 'NORMAL'}])
+        since = utils.get_timestamp(self.start_date - timedelta(days=1))
+        data = json.loads(self.app.get('/api/aggregate/day?route=poissy&since=%s' % since).data)
+        self.assertCountEqual(data, [
+            {'count': 1, 'date': '2017-02-12', 'type': 'NORMAL'},
+            {'count': 1, 'date': '2017-02-12', 'type': 'SUPPR'},
+        ])
+
+    def test_api_aggregate_route_rebuild(self):
+        """Incremental rollups of the routes match a full rebuild"""
+        incremental = {
+            route: rollups.query(self.database, 'day', route=route)
+            for route in ('', '87384008-87386573', '87384008-87393009')
+        }
+        with self.database as tx:
+            rollups.rebuild(tx)
+        for route, expected in incremental.items():
+            self.assertCountEqual(expected, rollups.query(self.database, 'day', route=route))
+
+    def test_api_routes(self):
+        """Routes w/ the labels of their stations"""
+        data = json.loads(self.app.get('/api/routes').data)
+        self.assertEqual([route['route'] for route in data['routes']], ['poissy', 'versailles'])
+        self.assertEqual(data['routes'][0]['from_station'], 'Poissy')
+
+
 if __name__ == '__main__':
     unittest.main()
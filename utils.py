@@ -1,19 +1,36 @@
 """Utils"""
 
+import threading
+import time
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 
 def convert_to_iso(string):
     return get_datestring(get_datetime(string))
 
 
+@lru_cache(maxsize=1024)
 def get_datetime(string):
     "Format : 22/07/2015 10:23"
+    # fixed width, sliced rather than going through strptime
+    if len(string) == 16 and string[2] == string[5] == '/' and string[10:14:3] == ' :':
+        return datetime(
+            int(string[6:10]), int(string[3:5]), int(string[0:2]),
+            int(string[11:13]), int(string[14:16])
+        )
     dt_format = '%d/%m/%Y %H:%M'
     return datetime.strptime(string, dt_format)
 
 
+@lru_cache(maxsize=1024)
 def get_datetime_from_iso(string):
+    "Format : 2015-07-22 10:23:00"
+    if len(string) == 19 and string[4:8:3] == '--' and string[10:17:3] == ' ::':
+        return datetime(
+            int(string[0:4]), int(string[5:7]), int(string[8:10]),
+            int(string[11:13]), int(string[14:16]), int(string[17:19])
+        )
     dt_format = '%Y-%m-%d %H:%M:%S'
     return datetime.strptime(string, dt_format)
 
@@ -23,8 +40,47 @@ def get_datestring(thedatetime):
     return thedatetime.strftime(dt_format)
 
 
-def get_limit_date():
+def get_timestamp(thedatetime):
+    """Epoch of a (local) datetime, as stored in `results.ts`"""
+    return int(time.mktime(thedatetime.timetuple()))
+
+
+def get_limit_date(now=None):
     """Return `limit_date` for de-duplicating the trains
     i.e. now - max delay before considering a late train is a new train
     """
-    return datetime.now() - timedelta(hours=4)
+    return (now or datetime.now()) - timedelta(hours=4)
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter
+
+    Hands out at most `capacity + rate * T` tokens over any period of `T`
+    seconds, `rate` being in tokens per second.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, limit, burst=1):
+        """Bucket never exceeding `limit` tokens in any one-minute window"""
+        return cls((limit - burst) / 60., capacity=burst)
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
@@ -1,26 +1,63 @@
 """Web interface"""
+import json
+import time
 from datetime import datetime, timedelta
+from functools import wraps
 
-from flask import Flask, jsonify, request, g
-from werkzeug.exceptions import BadRequest
+import click
+from flask import Flask, jsonify, request, g, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import BadRequest, NotFound
+from werkzeug.middleware.profiler import ProfilerMiddleware
 from flask_cors import CORS
 
 import database
-import settings
-from utils import get_datestring
+import feed
+import metrics
+import queries
+import rollups
+import routes
+import rows
+from config import settings
+from cache import ResponseCache
+from utils import get_datestring, get_timestamp
 from frontend import frontend
 
 
+class JSONProvider(DefaultJSONProvider):
+    """JSON of the responses, w/ the rows of the read only connector"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, rows.Row):
+            return rows.to_json(o)
+        return DefaultJSONProvider.default(o)
+
+
 # define static_url_path to avoid conflict w/ blueprint static
 app = Flask(__name__, static_url_path='/static/core')
+app.json = JSONProvider(app)
 app.debug = settings.DEBUG
 app.register_blueprint(frontend)
 CORS(app)
 
+response_cache = ResponseCache(settings.CACHE_SIZE)
+generation_watcher = feed.GenerationWatcher(settings.STREAM_INTERVAL)
+
+HTTP_REQUESTS = metrics.Counter(
+    'transilien_http_requests', 'HTTP requests, by route and status', ['route', 'status']
+)
+HTTP_REQUEST_SECONDS = metrics.Histogram(
+    'transilien_http_request_seconds', 'Duration of the HTTP requests, by route', ['route']
+)
+CACHE_EVENTS = metrics.Counter(
+    'transilien_cache_events', 'Response cache hits, misses and 304 responses', ['event']
+)
+
 
 def connect_db():
-    """Connects to the specific database."""
-    return database.get()
+    """Connects to the specific database, read only."""
+    return database.get(read_only=True)
 
 
 def get_db():
@@ -32,9 +69,36 @@ def get_db():
     return g.sqlite_db
 
 
+@app.before_request
+def start_timer():
+    """Start timing the request"""
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """Count and time the request, by route"""
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HTTP_REQUESTS.inc(route=route, status=response.status_code)
+    if 'request_start' in g:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route=route)
+    return response
+
+
+@app.teardown_appcontext
+def release_db(error): # pylint: disable=W0613
+    """Return the connection of the request to the pool"""
+    if hasattr(g, 'sqlite_db'):
+        database.release(g.sqlite_db)
+
+
 def get_since(default_days_ago=1):
     """Get since from request or provide default date"""
-    since = request.args.get('since')
+    return parse_since(request.args.get('since'), default_days_ago)
+
+
+def parse_since(since, default_days_ago=1):
+    """Date of a `since` arg (epoch) or of the default"""
     if since:
         try:
             since_date = datetime.fromtimestamp(int(since))
@@ -44,70 +108,305 @@ def get_since(default_days_ago=1):
         since_date = datetime.now() - timedelta(days=default_days_ago)
     else:
         return None
+    return since_date
+
+
+def round_since(since):
+    """Round a `since` date down to CACHE_SINCE_BUCKET seconds, as cached
+
+    Cached views query w/ the rounded date, so that the requests sharing a
+    cache entry (see `get_cache_key`) get the same rows.
+    """
+    if since is None:
+        return None
+    bucket = settings.CACHE_SINCE_BUCKET
+    return datetime.fromtimestamp(get_timestamp(since) // bucket * bucket)
+
+
+def cached(default_days_ago):
+    """Cache the decorated JSON view until the next write, w/ ETag support
+
+    `default_days_ago` is the view's default for `get_since`.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            generation = database.get_generation(get_db())
+            if generation is None:
+                return view(*args, **kwargs)
+            key = get_cache_key(request.path, request.args, default_days_ago)
+            etag = response_cache.get_etag(key, generation)
+            if request.if_none_match.contains(etag):
+                response_cache.count('not_modified')
+                response = app.response_class(status=304)
+            else:
+                payload = response_cache.get(key, generation)
+                if payload is None:
+                    payload = view(*args, **kwargs).get_data()
+                    response_cache.set(key, generation, payload)
+                response = app.response_class(payload, mimetype='application/json')
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
 
-    return get_datestring(since_date)
+
+def get_cache_key(path, args, default_days_ago):
+    """Response cache key of a request
+
+    `since` is rounded down to CACHE_SINCE_BUCKET seconds, so that close
+    requests share a cache entry, see `round_since`.
+    """
+    since = round_since(parse_since(args.get('since'), default_days_ago))
+    if since is not None:
+        since = get_timestamp(since)
+    return (
+        path,
+        tuple(sorted((k, v) for k, v in args.items() if k != 'since')),
+        since
+    )
+
+
+def get_route():
+    """Route of the `route` arg, the default one w/o"""
+    route = routes.get_route(request.args.get('route'))
+    if route is None:
+        raise NotFound()
+    return route
 
 
 @app.route('/api')
 def api():
-    """API root (list last results)"""
-    table = get_db()['results']
-    since_date = get_since()
-
-    aller = table.find(
-        table.table.columns.date > since_date,
-        from_gare=settings.FROM_STATION_CODE,
-        order_by='-date'
+    """API root (list last results of a route, see `get_route`)
+
+    `format=ndjson` streams the results instead, see `api_ndjson`.
+    """
+    if request.args.get('format') == 'ndjson':
+        return api_ndjson()
+    return api_json()
+
+
+@cached(default_days_ago=1)
+def api_json():
+    """List last results, as one JSON document
+
+    `rev` is the write generation the results are up to date with. Given
+    the `rev` of a previous response as `after_rev`, only the rows written
+    since are listed, whatever their date: the delta to sync a client.
+    """
+    return jsonify(get_trains(
+        get_db(), get_route(), round_since(get_since()), get_int_arg('after_rev')
+    ))
+
+
+def get_trains(res_db, route, since, after_rev=None):
+    """Payload of `api_json`: the results of a route since a date, or
+    written after a generation
+    """
+    rev = database.get_generation(res_db)
+    if after_rev is not None:
+        results = res_db.query(queries.API_CHANGES, rev=after_rev, until=rev, route=route.key)
+    else:
+        results = res_db.query(queries.API_TRAINS, since=get_timestamp(since), route=route.key)
+    return dict(get_directions(results, route), infos=get_infos(route), rev=rev)
+
+
+def get_directions(results, route):
+    """Split the rows of a route by direction"""
+    trains = {'aller': [], 'retour': []}
+    for row in results:
+        if row['from_gare'] == str(route.from_station):
+            trains['aller'].append(row)
+        elif row['from_gare'] == str(route.to_station):
+            trains['retour'].append(row)
+    return trains
+
+
+def get_infos(route):
+    """Name and labels of the stations of a route"""
+    return {
+        'route': route.name,
+        'from_station': routes.get_label(route.from_station),
+        'to_station': routes.get_label(route.to_station),
+    }
+
+
+def get_int_arg(name):
+    """Get an optional integer arg from request"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest()
+
+
+def api_ndjson():
+    """Stream last results, one JSON document per line, w/ their direction
+
+    Rows are encoded as the cursor yields them, newest first. `limit` caps
+    the number of rows and `cursor`, the id of the last row received,
+    gets the next ones.
+    """
+    lines = iter_ndjson(
+        get_db(), get_route(), get_since(), get_int_arg('limit'), get_int_arg('cursor')
     )
-    retour = table.find(
-        table.table.columns.date > since_date,
-        from_gare=settings.TO_STATION_CODE,
-        order_by='-date'
+    return app.response_class(
+        stream_with_context(lines), mimetype='application/x-ndjson'
     )
 
-    return jsonify(
-        aller=[r for r in aller],
-        retour=[r for r in retour],
-        infos={
-            'from_station': settings.FROM_STATION_LABEL,
-            'to_station': settings.TO_STATION_LABEL
-        }
-    )
+
+def iter_ndjson(res_db, route, since, limit=None, cursor=None):
+    """Lines of `api_ndjson`, as the cursor yields the rows
+
+    The `cursor` row is looked up first, BadRequest if unknown. BadRequest
+    too if `limit` is not positive, -1 being SQLite's "no limit".
+    """
+    if limit is not None and limit < 1:
+        raise BadRequest()
+    params = {
+        'since': get_timestamp(since),
+        'route': route.key,
+        'limit': -1 if limit is None else limit,
+    }
+    statement = queries.API_STREAM
+    if cursor is not None:
+        res = next(res_db.query(queries.CURSOR_TS, cursor=cursor), None)
+        if res is None:
+            raise BadRequest()
+        statement = queries.API_STREAM_AFTER
+        params.update(cursor=cursor, cursor_ts=res['ts'])
+    directions = {str(route.from_station): 'aller', str(route.to_station): 'retour'}
+
+    def generate():
+        for row in res_db.query(statement, **params):
+            data = row._asdict() # pylint: disable=W0212
+            data['direction'] = directions[row['from_gare']]
+            yield json.dumps(data) + '\n'
+
+    return generate()
+
+
+@app.route('/api/stream')
+def api_stream():
+    """Push the new and changed results as Server-Sent Events
+
+    One `results` event per write generation, w/ the generation as event
+    id and the `/api` payload as data. The stream starts after the
+    `Last-Event-ID` header or `last_event_id` arg (e.g. the `rev` of
+    `/api`), at the current generation by default. A comment is sent when
+    idle for STREAM_HEARTBEAT seconds, to keep the connection alive.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id:
+        try:
+            rev = int(last_event_id)
+        except ValueError:
+            raise BadRequest()
+    else:
+        rev = database.get_generation(get_db()) or 0
+    route = get_route()
+    infos = get_infos(route)
+
+    def generate():
+        last = rev
+        while True:
+            generation = generation_watcher.wait(last, settings.STREAM_HEARTBEAT)
+            if generation is None or generation == last:
+                yield ': heartbeat\n\n'
+                continue
+            # a connection per event, not per client
+            res_db = database.get(read_only=True)
+            try:
+                changes = list(res_db.query(
+                    queries.API_CHANGES, rev=last, until=generation, route=route.key
+                ))
+            finally:
+                database.release(res_db)
+            last = generation
+            if not changes:
+                continue
+            yield 'id: %s\nevent: results\ndata: %s\n\n' % (generation, json.dumps(
+                dict(get_directions(changes, route), infos=infos, rev=generation),
+                default=rows.to_json
+            ))
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/api/aggregate/<frequency>')
+@cached(default_days_ago=None)
 def api_aggregate(frequency):
-    """Aggregate trains by type on given frequency"""
-    if frequency == 'hour':
-        group_by = 'substr(date, 0, 15)'
-    elif frequency == 'day':
-        group_by = 'substr(date, 0, 11)'
-    elif frequency == 'month':
-        group_by = 'substr(date, 0, 8)'
-    elif frequency == 'year':
-        group_by = 'substr(date, 0, 5)'
-    elif frequency == 'hour_overall':
-        group_by = 'substr(date, 12, 2)'
-    elif frequency == 'weekday':
-        group_by = 'weekday'
-    else:
+    """Aggregate trains by type on given frequency, of all the routes or of
+    the `route` arg
+    """
+    if frequency not in rollups.FREQUENCIES:
         raise BadRequest()
 
-    since = get_since(default_days_ago=None)
+    since = round_since(get_since(default_days_ago=None))
+    if since:
+        since = get_datestring(since)
+    route = get_route().key if 'route' in request.args else ''
 
-    res = get_db().query("""
-        SELECT
-        %(group_by)s as date, type, COUNT(*) as count
-        FROM results
-        %(since)s
-        GROUP BY %(group_by)s, type;
-    """ % {
-        'group_by': group_by,
-        'since': "WHERE date > '%s'" % since if since else ''
-    })
+    return jsonify(rollups.query(get_db(), frequency, since, route=route))
 
-    return jsonify([r for r in res])
 
+@app.route('/api/routes')
+def api_routes():
+    """Monitored routes, the default one first"""
+    return jsonify(routes=[get_infos(route) for route in routes.get_routes()])
 
-if __name__ == '__main__':
+
+@app.route('/api/trains')
+@cached(default_days_ago=None)
+def api_trains():
+    """Punctuality of every train: count, cancellation rate, delay percentiles"""
+    return jsonify(trains=rollups.query_trains(get_db()))
+
+
+@app.route('/api/trains/<num>/stats')
+@cached(default_days_ago=None)
+def api_train_stats(num):
+    """Punctuality of a train, w/ its weekday and hour breakdowns"""
+    stats = rollups.query_train(get_db(), num)
+    if stats is None:
+        raise NotFound()
+    return jsonify(stats)
+
+
+@app.route('/api/cache')
+def api_cache():
+    """Response cache counters"""
+    return jsonify(response_cache.get_stats())
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metrics of the process, in the Prometheus text format"""
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def render_metrics():
+    """Metrics of the process, w/ the current response cache counters"""
+    for event, count in response_cache.get_stats().items():
+        if event != 'size':
+            CACHE_EVENTS.set(count, event=event)
+    return metrics.render()
+
+
+@click.command()
+@click.option('--profile', 'profile_dir', default=None, type=click.Path(file_okay=False, exists=True),
+              help='Profile each request, writing the stats to this directory')
+def run(profile_dir):
+    """Serve the web interface"""
+    if profile_dir:
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, profile_dir=profile_dir)
     app.run(host='0.0.0.0')
+
+
+if __name__ == '__main__':
+    run() # pylint: disable=E1120